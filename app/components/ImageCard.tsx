@@ -7,7 +7,7 @@ const ImageCard = ({
   onFavoriteToggle,
   onSelect,
 }) => {
-  const { src, progress, isProcessing, isDone, isFavorite } = item;
+  const { src, thumbnail, preview, progress, isProcessing, isDone, isFavorite } = item;
   const showFavoriteButton = isHovered || isFavorite;
 
   return (
@@ -36,7 +36,7 @@ const ImageCard = ({
       )}
 
       {!isDone && (<img
-        src={src}
+        src={preview ?? thumbnail ?? src}
         alt="Style"
         className="w-full h-[120px] object-cover rounded-[10px] bg-[#f7f5f2]"
       />)}
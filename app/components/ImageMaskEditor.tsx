@@ -3,6 +3,33 @@ import { fetchWithErrorHandling, pollTaskStatus } from "../utils";
 
 const API_BASE_URL = process.env.NEXT_PUBLIC_API_BASE_URL || "http://localhost:8000";
 
+// The painted area as a 1-bit bitmap of its bounding box, MSB first (the server's 'bits' mask format),
+// instead of a full-canvas PNG. Returns null if nothing is painted.
+function encodeMaskBits(canvas: HTMLCanvasElement) {
+  const { width, height } = canvas;
+  const alpha = canvas.getContext('2d')!.getImageData(0, 0, width, height).data;
+  let x0 = width, y0 = height, x1 = 0, y1 = 0;
+  for (let y = 0; y < height; y++) {
+    for (let x = 0; x < width; x++) {
+      if (alpha[(y * width + x) * 4 + 3] > 0) {
+        x0 = Math.min(x0, x); x1 = Math.max(x1, x + 1);
+        y0 = Math.min(y0, y); y1 = Math.max(y1, y + 1);
+      }
+    }
+  }
+  if (x1 <= x0) return null;
+  const bits = new Uint8Array(Math.ceil(((x1 - x0) * (y1 - y0)) / 8));
+  let i = 0;
+  for (let y = y0; y < y1; y++) {
+    for (let x = x0; x < x1; x++, i++) {
+      if (alpha[(y * width + x) * 4 + 3] > 0) bits[i >> 3] |= 0x80 >> (i & 7);
+    }
+  }
+  let binary = '';
+  bits.forEach(byte => { binary += String.fromCharCode(byte); });
+  return { format: 'bits', size: [width, height], bbox: [x0, y0, x1, y1], data: btoa(binary) };
+}
+
 interface ImageMaskEditorProps {
   imageSrc: string;
   width?: number;
@@ -19,6 +46,8 @@ const ImageMaskEditor: React.FC<ImageMaskEditorProps> = ({ imageSrc, width = 500
   const [progress, setProgress] = useState(0);
   const [resultImage, setResultImage] = useState<string | null>(null);
   const [resultDimensions, setResultDimensions] = useState<{ width: number; height: number } | null>(null);
+  // The image is uploaded once; further edits of the same image only send its ID and the mask
+  const sourceRef = useRef<{ imageSrc: string; sourceImageId: string } | null>(null);
 
   useEffect(() => {
     const canvas = canvasRef.current;
@@ -90,18 +119,19 @@ const ImageMaskEditor: React.FC<ImageMaskEditorProps> = ({ imageSrc, width = 500
     setResultDimensions(null);
 
     try {
-      const maskData = canvasRef.current.toDataURL('image/png');
-      const response = await fetch(`${API_BASE_URL}/start/model_hair_reshape`, {
+      const mask = encodeMaskBits(canvasRef.current);
+      if (!mask) return;
+      if (sourceRef.current?.imageSrc !== imageSrc) {
+        const form = new FormData();
+        form.append('file', await (await fetch(imageSrc)).blob(), 'image');
+        const upload = await fetchWithErrorHandling(`${API_BASE_URL}/upload_source_image`, { method: 'POST', body: form });
+        sourceRef.current = { imageSrc, sourceImageId: upload.source_image_id };
+      }
+      const data = await fetchWithErrorHandling(`${API_BASE_URL}/start/model_hair_reshape`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ image: imageSrc, mask: maskData }),
+        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': crypto.randomUUID() },
+        body: JSON.stringify({ source_image_id: sourceRef.current.sourceImageId, mask }),
       });
-
-      if (!response.ok) {
-        throw new Error('Failed to send mask');
-      }
-
-      const data = await response.json();
       const { task_id } = data;
 
       // Poll task status for progress
@@ -5,9 +5,7 @@ import dynamic from 'next/dynamic';
 const HairColorSelector = dynamic(() => import('./HairColorSelector'), { ssr: false });
 const ImageMaskEditor = dynamic(() => import('./ImageMaskEditor'), { ssr: false });
 import { ModelProfile } from "../types";
-import { fetchWithErrorHandling, pollTaskStatus } from "../utils";
-
-const API_BASE_URL = process.env.NEXT_PUBLIC_API_BASE_URL || "http://localhost:8000";
+import { pollTaskStatus, startTaskMultipart } from "../utils";
 
 interface SelectedImageTabProps {
   imageSrc: string;
@@ -91,11 +89,11 @@ export default function SelectedImageTab({ imageSrc, title, modelProfile, onAppl
       setColorResultImage(null); // Reset previous result
       setColorProgress(0); // Reset progress
 
-      const response = await fetchWithErrorHandling(`${API_BASE_URL}/start/model_haircolor`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ image: imageSrc, color: color.Name, color_code: color.Code }),
-      });
+      // The image goes up as a file part: the server keys its hair-mask cache by the upload, so
+      // trying further colours on the same image skips the segmentation
+      const imageBlob = await (await fetch(imageSrc)).blob();
+      const response = await startTaskMultipart("model_haircolor", { image: imageBlob },
+        { color: color.Name, color_code: color.Code });
 
       const { task_id } = response;
       setColorTaskId(task_id);
@@ -29,8 +29,10 @@ function reducer(state: any, action: any) {
       return {
         ...state,
         isLoading: false,
-        items: action.payload.map((src: any) => ({
-          src,
+        items: action.payload.map((style: any) => ({
+          src: style.src,
+          thumbnail: style.thumbnail,
+          styleId: style.styleId,
           progress: 0,
           isProcessing: false,
           isDone: false,
@@ -68,6 +70,15 @@ function reducer(state: any, action: any) {
             : item
         ),
       };
+    case "PROCESS_PREVIEW":
+      return {
+        ...state,
+        items: state.items.map((item: any, index: any) =>
+          index === action.payload.index
+            ? { ...item, preview: action.payload.preview }
+            : item
+        ),
+      };
     case "PROCESS_SUCCESS":
       return {
         ...state,
@@ -198,10 +209,18 @@ export default function Home() {
           method: "POST",
           body: dataURLtoFormData(state.sourceImage),
         });
-        logger.log("data.sourceImageId=", data.sourceImageId);
-        dispatch({ type: "FETCH_INITIAL_IMAGES_START", payload: { sourceImageId: data.sourceImageId } });
-        dispatch({ type: "FETCH_INITIAL_IMAGES_SUCCESS", payload: data.images || [] });
-        logger.log("data.images=", data.images.length);
+        const sourceImageId = data.source_image_id ?? data.sourceImageId;
+        logger.log("sourceImageId=", sourceImageId);
+        // The server only sends style URLs; the images themselves are fetched (and browser-cached) from /styles/{hash}
+        const thumbnailSize = data.thumbnail_sizes?.[data.thumbnail_sizes.length - 1];
+        const styles = (data.styles || []).map((style: { id: string; url: string }) => ({
+          src: `${API_BASE_URL}${style.url}`,
+          thumbnail: thumbnailSize ? `${API_BASE_URL}${style.url}?size=${thumbnailSize}` : `${API_BASE_URL}${style.url}`,
+          styleId: style.id, // Stable ID: doesn't depend on the server's directory order
+        }));
+        dispatch({ type: "FETCH_INITIAL_IMAGES_START", payload: { sourceImageId } });
+        dispatch({ type: "FETCH_INITIAL_IMAGES_SUCCESS", payload: styles });
+        logger.log("data.images=", styles.length);
       } catch (err) {
         dispatch({ type: "FETCH_INITIAL_IMAGES_ERROR", payload: (err as Error).message });
       }
@@ -227,13 +246,14 @@ export default function Home() {
       try {
         const { task_id } = await fetchWithErrorHandling(`${API_BASE_URL}/start/model_ht`, {
           method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({ index, source_image_id: state.sourceImageId }),
+          headers: { "Content-Type": "application/json", "Idempotency-Key": crypto.randomUUID() },
+          body: JSON.stringify({ index, style_id: state.items[index]?.styleId, source_image_id: state.sourceImageId }),
         });
         dispatch({ type: "PROCESS_START", payload: { index, taskId: task_id } });
 
         const progData = await pollTaskStatus(task_id, progress =>
-          dispatch({ type: "PROCESS_PROGRESS", payload: { index, progress } }), "model_ht"
+          dispatch({ type: "PROCESS_PROGRESS", payload: { index, progress } }), "model_ht",
+          preview => dispatch({ type: "PROCESS_PREVIEW", payload: { index, preview } })
         );
 
         handleTaskStatus(
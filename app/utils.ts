@@ -11,8 +11,27 @@ export const logger = {
   },
 };
 
+const API_BASE = process.env.NEXT_PUBLIC_API_BASE_URL || "http://localhost:8000";
+
+// Image results are served as raw bytes from /result/{taskId}; expose them as a URL in `result`.
+function resolveResultUrl(progData: any) {
+  if (progData.result_url && !progData.result) {
+    progData.result = `${API_BASE}${progData.result_url}`;
+  }
+  return progData;
+}
+
+const MAX_BUSY_RETRIES = 3;
+
 export async function fetchWithErrorHandling(url: string, options?: RequestInit) {
-  const res = await fetch(url, options);
+  let res = await fetch(url, options);
+  // 429: the model's queue is full; wait as long as the server asks, then retry
+  for (let attempt = 0; res.status === 429 && attempt < MAX_BUSY_RETRIES; attempt++) {
+    const retryAfter = Number(res.headers.get("Retry-After")) || 1;
+    logger.log(`Server busy, retrying ${url} in ${retryAfter}s`);
+    await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+    res = await fetch(url, options);
+  }
   if (!res.ok) {
     const errorText = await res.text();
     throw new Error(`API error: ${res.status} - ${errorText}`);
@@ -20,16 +39,79 @@ export async function fetchWithErrorHandling(url: string, options?: RequestInit)
   return res.json();
 }
 
-export async function pollTaskStatus(taskId: string, onProgress: (progress: number) => void, context: string) {
+// Starts a task with images sent as multipart file parts instead of base64 JSON fields.
+export async function startTaskMultipart(modelName: string, files: Record<string, Blob>, params: Record<string, any> = {}) {
+  const form = new FormData();
+  form.append("params", JSON.stringify(params));
+  for (const [name, blob] of Object.entries(files)) {
+    form.append(name, blob, name);
+  }
+  // The key makes the busy retries (and any other resend) return the same task instead of starting another
+  return fetchWithErrorHandling(`${API_BASE}/start/${modelName}`, {
+    method: "POST",
+    headers: { "Idempotency-Key": crypto.randomUUID() },
+    body: form,
+  });
+}
+
+type PreviewHandler = (previewUrl: string) => void;
+
+// Hands a newly announced low-resolution preview (status.preview_url, while the task runs) to onPreview.
+function reportPreview(progData: any, lastPreviewUrl: string | null, onPreview?: PreviewHandler) {
+  if (onPreview && progData.preview_url && progData.preview_url !== lastPreviewUrl) {
+    onPreview(`${API_BASE}${progData.preview_url}`);
+  }
+  return progData.preview_url ?? lastPreviewUrl;
+}
+
+// Resolves with the final status pushed by the server over SSE (GET /events/{taskId}).
+function streamTaskStatus(taskId: string, onProgress: (progress: number) => void, onPreview?: PreviewHandler): Promise<any> {
+  return new Promise((resolve, reject) => {
+    const source = new EventSource(`${API_BASE}/events/${taskId}`);
+    let lastPreviewUrl: string | null = null;
+    source.onmessage = event => {
+      const progData = JSON.parse(event.data);
+      onProgress(progData.progress ?? 0);
+      lastPreviewUrl = reportPreview(progData, lastPreviewUrl, onPreview);
+      if (progData.done) {
+        source.close();
+        resolve(resolveResultUrl(progData));
+      }
+    };
+    source.onerror = () => {
+      source.close();
+      reject(new Error("Task event stream failed"));
+    };
+  });
+}
+
+export async function pollTaskStatus(
+  taskId: string,
+  onProgress: (progress: number) => void,
+  context: string,
+  onPreview?: PreviewHandler
+) {
+  if (!taskId) throw new Error(`Task ID is missing for context: ${context}`);
+  if (typeof EventSource !== "undefined") {
+    try {
+      const progData = await streamTaskStatus(taskId, onProgress, onPreview);
+      logger.log(`Task completed for ${context}:`, progData);
+      return progData;
+    } catch (e) {
+      logger.error(`Event stream failed for ${context}, falling back to polling:`, e);
+    }
+  }
+
   let isDone = false;
   let progData: any = {};
+  let lastPreviewUrl: string | null = null;
   while (!isDone) {
     await new Promise(resolve => setTimeout(resolve, 500));
-    if (!taskId) throw new Error(`Task ID is missing for context: ${context}`);
-    const progRes = await fetchWithErrorHandling(`${process.env.NEXT_PUBLIC_API_BASE_URL || "http://localhost:8000"}/status/${taskId}`);
-    progData = progRes;
+    const progRes = await fetchWithErrorHandling(`${API_BASE}/status/${taskId}`);
+    progData = resolveResultUrl(progRes);
     isDone = progData.done; // || (progData.progress >= 100);
     onProgress(progData.progress ?? 0);
+    lastPreviewUrl = reportPreview(progData, lastPreviewUrl, onPreview);
   }
   logger.log(`Task completed for ${context}:`, progData);
   return progData;
@@ -2,6 +2,10 @@ import type { NextConfig } from "next";
 
 const nextConfig: NextConfig = {
   /* config options here */
+  images: {
+    // Style images are served by the task server (GET /styles/{hash})
+    remotePatterns: [{ protocol: "http", hostname: "localhost", port: "8000" }],
+  },
 };
 
 export default nextConfig;
@@ -0,0 +1,433 @@
+# client_benchmark.py
+# Load test for the task server: virtual users run a weighted mix of upload / start / status / cancel
+# requests for a while, and the run is reported as JSON (latency percentiles per operation, throughput,
+# error rates, server RSS). Compared against a stored baseline, a regression makes the run fail.
+#   python client_benchmark.py                          in-process, stub models (no network, no GPU)
+#   python client_benchmark.py --spawn                  stub server in a subprocess, over localhost
+#   python client_benchmark.py --url http://host:8000   a running server, real models
+#   python client_benchmark.py --save-baseline bench.json
+#   python client_benchmark.py --baseline bench.json    exit code 1 on regression
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+import numpy as np
+from PIL import Image
+
+DEFAULT_MIX = "upload=1,start=3,status=10,cancel=1"
+DEFAULT_SIZES = "512,1024,2048"  # Longest side of the synthetic uploads
+IMAGE_VARIANTS = 8  # Distinct images per size; later uploads repeat them (and hit the source store)
+RSS_SAMPLE_SECONDS = 0.5
+# Regression thresholds for --baseline: relative slack for latencies / throughput / memory, absolute for error rates
+DEFAULT_TOLERANCE = 0.2
+ERROR_RATE_SLACK = 0.01
+
+
+# === Stub models ===
+def make_stub_models(latency, steps=2):
+    """
+    Stand-ins for model_ht / model_profile with a fixed per-task latency and a synthetic style
+    catalogue, so the whole request path (upload decode, admission, batching, results) runs offline.
+    :return: {model name: model}
+    """
+    from server_executors import cancellable_sleep
+    from server_gallery import GalleryStore
+    from server_images import ImageResult
+    from server_model_hairtransfer import ModelHairTransfer
+    from server_model_profile import ModelProfile
+
+    styles_dir = tempfile.mkdtemp(prefix="hairsfe_bench_styles_")
+    for i in range(8):
+        Image.fromarray(synthetic_pixels(256, seed=i)).save(os.path.join(styles_dir, f"style_{i}.jpg"), quality=85)
+
+    class StubHairTransfer(ModelHairTransfer):
+        def __init__(self):
+            super().__init__(spill_dir=False, bundle_dir=None)
+            self.target_styles = GalleryStore(styles_dir)
+            self.images_processed = GalleryStore(styles_dir, thumbnail_sizes=())
+
+        def run(self, params, progress_callback=None, cancel_check_callback=None):
+            for step in range(steps):
+                cancellable_sleep(latency / steps, cancel_check_callback)
+                if progress_callback:
+                    progress_callback((step + 1) / steps * 100)
+            return self.images_processed.image_result(params.get('index', 0) % len(self.images_processed))
+
+        def run_batch(self, params_list, progress_callbacks, cancel_check_callbacks):
+            # One sleep per step for the whole batch, like a batched forward pass
+            results = [None] * len(params_list)
+            active = list(range(len(params_list)))
+            for step in range(steps):
+                for i in list(active):
+                    try:
+                        cancel_check_callbacks[i]()  # Raises if canceled
+                    except Exception as e:
+                        results[i] = e
+                        active.remove(i)
+                if not active:
+                    break
+                time.sleep(latency / steps)
+                for i in active:
+                    progress_callbacks[i]((step + 1) / steps * 100)
+            for i in active:
+                results[i] = self.images_processed.image_result(params_list[i].get('index', 0)
+                                                                % len(self.images_processed))
+            return results
+
+    class StubProfile(ModelProfile):
+        async def run_async(self, params, progress_callback=None, cancel_check_callback=None):
+            await asyncio.sleep(latency)
+            return ImageResult(synthetic_jpeg(256, seed=0), 'image/jpeg')
+
+    return {'model_ht': StubHairTransfer(), 'model_profile': StubProfile()}
+
+
+def install_stub_models(latency):
+    from server_tasks import MODEL_REGISTRY
+    for name, model in make_stub_models(latency).items():
+        MODEL_REGISTRY[name] = model
+
+
+# === Synthetic images ===
+def synthetic_pixels(size, seed):
+    # Smooth gradient plus noise: compresses like a photo, not like a flat fill
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    base = np.stack([x * 255, y * 255, (1 - x) * 200], axis=-1)
+    return np.clip(base + rng.normal(0, 20, (size, size, 3)), 0, 255).astype(np.uint8)
+
+
+def synthetic_jpeg(size, seed):
+    buffer = io.BytesIO()
+    Image.fromarray(synthetic_pixels(size, seed)).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+# === Statistics ===
+def percentile(sorted_values, fraction):
+    # Nearest rank
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+
+def summarize(latencies, errors):
+    values = sorted(latencies)
+    count = len(values) + errors
+    return {
+        'count': count,
+        'errors': errors,
+        'error_rate': errors / count if count else 0.0,
+        'mean_ms': sum(values) / len(values) * 1000 if values else None,
+        'p50_ms': percentile(values, 0.50) * 1000 if values else None,
+        'p95_ms': percentile(values, 0.95) * 1000 if values else None,
+        'p99_ms': percentile(values, 0.99) * 1000 if values else None,
+        'max_ms': values[-1] * 1000 if values else None,
+    }
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}  # operation: [seconds]
+        self.errors = {}  # operation: count
+        self.rejected = 0  # 429s: the server shedding load, counted apart from errors
+        self.task_states = {}  # final state: count
+
+    def add(self, operation, seconds=None, error=False):
+        if error:
+            self.errors[operation] = self.errors.get(operation, 0) + 1
+        else:
+            self.latencies.setdefault(operation, []).append(seconds)
+
+    def report(self):
+        operations = sorted(set(self.latencies) | set(self.errors))
+        return {operation: summarize(self.latencies.get(operation, []), self.errors.get(operation, 0))
+                for operation in operations}
+
+
+# === Virtual users ===
+class VirtualUser:
+    """One client: keeps its own uploads and tasks, and runs a random operation from the mix at a time."""
+    def __init__(self, client, recorder, images, mix, args, rng):
+        self.client = client
+        self.recorder = recorder
+        self.images = images  # [(size, jpeg bytes)]
+        self.mix = mix
+        self.args = args
+        self.rng = rng
+        self.client_id = uuid.uuid4().hex[:8]
+        self.source_ids = []
+        self.tasks = {}  # task_id: start time
+
+    async def request(self, operation, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, headers={'X-Client-Id': self.client_id}, **kwargs)
+        except httpx.HTTPError:
+            self.recorder.add(operation, error=True)
+            return None
+        elapsed = time.perf_counter() - start
+        if response.status_code == 429:
+            self.recorder.rejected += 1
+            return None
+        self.recorder.add(operation, elapsed, error=response.status_code >= 400)
+        return response if response.status_code < 400 else None
+
+    async def upload(self):
+        size, data = self.rng.choice(self.images)
+        response = await self.request('upload', 'POST', '/upload_source_image',
+                                      files={'file': (f'bench_{size}.jpg', data, 'image/jpeg')})
+        if response is not None:
+            self.source_ids.append(response.json()['source_image_id'])
+
+    async def start(self):
+        if not self.source_ids:
+            return await self.upload()
+        params = {'source_image_id': self.rng.choice(self.source_ids), 'index': self.rng.randrange(8)}
+        if not self.args.allow_cache:
+            params['nonce'] = uuid.uuid4().hex  # Unique params: measure the model, not the result cache
+        response = await self.request('start', 'POST', f'/start/{self.args.model}', json=params)
+        if response is not None:
+            self.tasks[response.json()['task_id']] = time.perf_counter()
+
+    async def status(self):
+        if not self.tasks:
+            return await self.start()
+        task_id = self.rng.choice(list(self.tasks))
+        response = await self.request('status', 'GET', f'/status/{task_id}')
+        if response is None:
+            return
+        status = response.json()
+        if not status.get('done'):
+            return
+        self.recorder.task_states[status['status']] = self.recorder.task_states.get(status['status'], 0) + 1
+        started = self.tasks.pop(task_id)
+        if status['status'] == 'Completed':
+            self.recorder.add('task', time.perf_counter() - started)  # End to end, at polling resolution
+            if status.get('result_url'):
+                await self.request('result', 'GET', status['result_url'])
+
+    async def cancel(self):
+        if not self.tasks:
+            return await self.start()
+        task_id = self.rng.choice(list(self.tasks))
+        await self.request('cancel', 'POST', f'/cancel/{task_id}')
+
+    async def run(self, deadline):
+        operations, weights = zip(*self.mix.items())
+        while time.perf_counter() < deadline:
+            await getattr(self, self.rng.choices(operations, weights)[0])()
+            if self.args.think_time:
+                await asyncio.sleep(self.rng.expovariate(1 / self.args.think_time))
+
+
+# === Server RSS ===
+async def server_rss(client):
+    # process_resident_memory_bytes from the server's /metrics
+    try:
+        response = await client.get('/metrics')
+    except httpx.HTTPError:
+        return None
+    for line in response.text.splitlines():
+        if line.startswith('process_resident_memory_bytes '):
+            return float(line.split()[1])
+    return None
+
+
+async def sample_rss(client, samples, stop):
+    while not stop.is_set():
+        rss = await server_rss(client)
+        if rss is not None:
+            samples.append(rss)
+        try:
+            await asyncio.wait_for(stop.wait(), RSS_SAMPLE_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+# === Runner ===
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name.strip() not in ('upload', 'start', 'status', 'cancel'):
+            raise ValueError(f"Unknown operation '{name}' in mix")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def make_client(args):
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    if args.url:
+        return httpx.AsyncClient(base_url=args.url, timeout=timeout, limits=limits)
+    from server_dummy_app import app
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench', timeout=timeout)
+
+
+async def run_benchmark(args):
+    rng = random.Random(args.seed)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    images = [(size, synthetic_jpeg(size, seed=size * 100 + i)) for size in sizes for i in range(IMAGE_VARIANTS)]
+    mix = parse_mix(args.mix)
+    recorder = Recorder()
+    async with make_client(args) as client:
+        rss_samples, stop = [], asyncio.Event()
+        sampler = asyncio.create_task(sample_rss(client, rss_samples, stop))
+        users = [VirtualUser(client, recorder, images, mix, args, random.Random(rng.random()))
+                 for _ in range(args.concurrency)]
+        start = time.perf_counter()
+        await asyncio.gather(*(user.run(start + args.duration) for user in users))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await sampler
+        final_rss = await server_rss(client)
+    operations = recorder.report()
+    requests_total = sum(summary['count'] for name, summary in operations.items() if name != 'task')
+    errors_total = sum(summary['errors'] for name, summary in operations.items() if name != 'task')
+    rss_samples += [final_rss] if final_rss is not None else []
+    return {
+        'config': {'target': args.url or 'in-process', 'concurrency': args.concurrency, 'duration_s': args.duration,
+                   'mix': mix, 'sizes': sizes, 'model': args.model, 'stub_latency_s': None if args.url else args.latency,
+                   'allow_cache': args.allow_cache, 'seed': args.seed},
+        'elapsed_s': elapsed,
+        'throughput': {'requests_per_s': requests_total / elapsed,
+                       'tasks_per_s': operations.get('task', {}).get('count', 0) / elapsed},
+        'error_rate': errors_total / requests_total if requests_total else 0.0,
+        'rejected': recorder.rejected,
+        'tasks': recorder.task_states,
+        'operations': operations,
+        'server': {'rss_start_bytes': rss_samples[0] if rss_samples else None,
+                   'rss_end_bytes': rss_samples[-1] if rss_samples else None,
+                   'rss_peak_bytes': max(rss_samples) if rss_samples else None},
+    }
+
+
+def compare(report, baseline, tolerance):
+    """
+    :return: List of regressions (empty if none): slower percentiles, lower throughput, higher error
+             rates or peak RSS than the baseline allows.
+    """
+    regressions = []
+
+    def check(name, current, previous, higher_is_worse=True, slack=None):
+        if current is None or previous is None:
+            return
+        if slack is not None:
+            worse = current > previous + slack
+        elif higher_is_worse:
+            worse = current > previous * (1 + tolerance)
+        else:
+            worse = current < previous * (1 - tolerance)
+        if worse:
+            regressions.append({'metric': name, 'baseline': previous, 'current': current})
+
+    for operation, summary in report['operations'].items():
+        previous = baseline.get('operations', {}).get(operation)
+        if previous is None:
+            continue
+        for field in ('p50_ms', 'p95_ms', 'p99_ms'):
+            check(f"{operation}.{field}", summary[field], previous[field])
+        check(f"{operation}.error_rate", summary['error_rate'], previous['error_rate'], slack=ERROR_RATE_SLACK)
+    for field in ('requests_per_s', 'tasks_per_s'):
+        check(f"throughput.{field}", report['throughput'][field], baseline['throughput'][field], higher_is_worse=False)
+    check('error_rate', report['error_rate'], baseline['error_rate'], slack=ERROR_RATE_SLACK)
+    check('server.rss_peak_bytes', report['server']['rss_peak_bytes'], baseline['server']['rss_peak_bytes'])
+    return regressions
+
+
+def spawn_stub_server(args):
+    port = args.port
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve-stub', '--port', str(port),
+                                '--latency', str(args.latency)], cwd=os.path.dirname(os.path.abspath(__file__)))
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/healthz", timeout=1).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        if process.poll() is not None:
+            raise RuntimeError("Stub server exited during startup")
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Stub server did not come up")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the task server, with a JSON report.")
+    parser.add_argument("--url", help="Server to test (default: the app in-process, with stub models)")
+    parser.add_argument("--spawn", action="store_true", help="Start a stub-model server on localhost and test it")
+    parser.add_argument("--serve-stub", action="store_true", help=argparse.SUPPRESS)  # What --spawn runs
+    parser.add_argument("--port", type=int, default=8765, help="Port for --spawn")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="Virtual users")
+    parser.add_argument("-d", "--duration", type=float, default=20.0, help="Seconds to run")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Operation weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"Upload sizes in pixels (default: {DEFAULT_SIZES})")
+    parser.add_argument("--model", default="model_ht")
+    parser.add_argument("--latency", type=float, default=0.2, help="Stub model seconds per task")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Mean pause between a user's requests")
+    parser.add_argument("--allow-cache", action="store_true", help="Let repeated params hit the result cache")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Per-request timeout")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="Write the JSON report here (default: stdout)")
+    parser.add_argument("--baseline", help="Baseline report to compare against; regressions exit with 1")
+    parser.add_argument("--save-baseline", help="Also store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Allowed relative slowdown vs. the baseline (default: {DEFAULT_TOLERANCE})")
+    args = parser.parse_args()
+
+    if args.serve_stub:
+        import uvicorn
+        install_stub_models(args.latency)
+        from server_dummy_app import app
+        uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+        return
+
+    process = None
+    if args.spawn:
+        process, args.url = spawn_stub_server(args)
+    elif not args.url:
+        install_stub_models(args.latency)
+    try:
+        report = asyncio.run(run_benchmark(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        elif not args.url:
+            from server_dummy_app import task_manager
+            task_manager.shutdown()
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report['regressions'] = compare(report, json.load(f), args.tolerance)
+        exit_code = 1 if report['regressions'] else 0
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            f.write(text)
+    for regression in report.get('regressions', []):
+        print(f"REGRESSION {regression['metric']}: {regression['baseline']:.4g} -> {regression['current']:.4g}",
+              file=sys.stderr)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import base64
+import json
 
 import requests
 import time
@@ -19,12 +20,18 @@ def image_to_base64(image: Image.Image):
     image.save(buffered, format="JPEG")
     return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
+TEST_IMAGE = os.environ.get("HAIRSFE_TEST_IMAGE", r"C:\Users\ShayMoshe\OneDrive - vayyar.com\Documents\Personal\ML\HairSProject\pics\Shay\image_wh3.jpeg")
+
 def create_dummy_image():
     """
     Creates a dummy in-memory image for testing purposes.
     This simulates uploading an image without needing a real file.
+    Uses HAIRSFE_TEST_IMAGE if it exists, a generated gradient otherwise (load tests: client_benchmark.py).
     """
-    img = Image.open(r"C:\Users\ShayMoshe\OneDrive - vayyar.com\Documents\Personal\ML\HairSProject\pics\Shay\image_wh3.jpeg")
+    if os.path.exists(TEST_IMAGE):
+        img = Image.open(TEST_IMAGE)
+    else:
+        img = Image.linear_gradient('L').convert('RGB').resize((1024, 1024))
     img_byte_arr = BytesIO()
     img.save(img_byte_arr, format='JPEG')
     img_byte_arr.seek(0)
@@ -49,9 +56,9 @@ def test_upload_source_image_payload():
     if response.status_code == 200:
         data = response.json()
         print("Upload successful:")
-        # print(f"Images: {data.get('images')}")
+        # print(f"Styles: {data.get('styles')}")
         print(f"Source Image ID: {data.get('sourceImageId')}")
-        return data.get('sourceImageId'), data.get('images', [])
+        return data.get('sourceImageId'), [style['url'] for style in data.get('styles', [])]
     else:
         # print(f"Upload failed: {response.status_code} - {response.text}")
         print(f"Upload failed: {response.status_code}")
@@ -68,7 +75,7 @@ def test_upload_source_image():
     if response.status_code == 200:
         data = response.json()
         print(f"Source Image ID: {data.get('sourceImageId')}")
-        return data.get('sourceImageId'), data.get('images', [])
+        return data.get('sourceImageId'), [style['url'] for style in data.get('styles', [])]
     else:
         print(f"Upload failed: {response.status_code} ")
         return None, []
@@ -92,11 +99,32 @@ def test_start_task(model_name: str, params: dict):
 
 def test_get_status(task_id: str):
     """
-    Test getting the status of a task with the /status/{task_id} endpoint.
-    Polls until the task is completed or failed.
+    Test getting the status of a task with the /events/{task_id} endpoint.
+    Listens to the server-sent events until the task is done; falls back to polling /status.
     """
     print(f"Testing status for task: {task_id}")
 
+    try:
+        with requests.get(f"{BASE_URL}/events/{task_id}", stream=True) as response:
+            if response.status_code == 200:
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue  # Blank separators and keep-alive comments
+                    status = json.loads(line[len("data:"):])
+                    print(f"Current status: {status.get('status')}, Progress: {status.get('progress', 0)}%")
+                    if status.get('done'):
+                        print("Task completed or failed.")
+                        return status_result(status)
+    except requests.RequestException as e:
+        print(f"Event stream failed: {e}")
+
+    return poll_status(task_id)
+
+
+def poll_status(task_id: str):
+    """
+    Polls /status/{task_id} until the task is completed or failed.
+    """
     while True:
         response = requests.get(f"{BASE_URL}/status/{task_id}")
 
@@ -105,7 +133,7 @@ def test_get_status(task_id: str):
             print(f"Current status: {status.get('status')}, Progress: {status.get('progress', 0)}%")
             if status.get('status') in ['Completed', 'Failed']:
                 print("Task completed or failed.")
-                return status.get('result', None)
+                return status_result(status)
         else:
             print(f"Get status failed: {response.status_code}")
             return None
@@ -113,6 +141,20 @@ def test_get_status(task_id: str):
         time.sleep(2)  # Poll every 2 seconds
 
 
+def status_result(status: dict):
+    """
+    Image results are served as raw bytes from the status' result_url; anything else is inline.
+    """
+    if status.get('result_url'):
+        response = requests.get(f"{BASE_URL}{status['result_url']}")
+        if response.status_code == 200:
+            print(f"Downloaded result: {response.headers.get('content-type')}, {len(response.content)} bytes")
+            return response.content
+        print(f"Get result failed: {response.status_code}")
+        return None
+    return status.get('result', None)
+
+
 def test_cancel_task(task_id: str):
     """
     Test canceling a task with the /cancel/{task_id} endpoint.
@@ -151,7 +193,11 @@ if __name__ == "__main__":
             result = test_get_status(task_id)
 
     # convert result to an image if available
-            if result and isinstance(result, str) and result.startswith("data:image/jpeg;base64,"):
+            if isinstance(result, bytes):
+                image = Image.open(BytesIO(result))
+                image.show()
+                print("Image processing completed successfully.")
+            elif result and isinstance(result, str) and result.startswith("data:image/jpeg;base64,"):
                 # Decode base64 image data
                 image_data = result.split(",")[1]
                 image_bytes = BytesIO(base64.b64decode(image_data))
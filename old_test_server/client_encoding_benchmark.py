@@ -0,0 +1,101 @@
+# client_encoding_benchmark.py
+# Output encoding benchmark: for sample images, what each format / target costs to encode and saves on
+# the wire, against the PNG and default-quality JPEG the models used to return, and how close (SSIM)
+# each variant stays to the master. Runs server_encoding directly, no server needed.
+#   python client_encoding_benchmark.py                              the bundled sample portrait
+#   python client_encoding_benchmark.py a.jpg b.png --sizes 512,1024
+#   python client_encoding_benchmark.py -o encoding.json
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+from PIL import Image
+
+from server_encoding import AVAILABLE, MASTER_QUALITY, PREFERENCE, Encoder, __gray__, encode, ssim
+
+DEFAULT_IMAGES = (os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "public", "resources", "image_wh3.jpeg"),)
+DEFAULT_SIZES = "512"  # Downscaled variants (longest side), on top of full size
+DEFAULT_BUDGET = 64 * 1024
+
+
+def measure(encoder, master, reference, mime, size=None, max_bytes=None):
+    """
+    One variant, encoded cold and then served from the encoder's cache.
+    :return: Report row (dict).
+    """
+    encodes = encoder.counters['encodes']
+    start = time.perf_counter()
+    variant = encoder.variant(master, mime, size, max_bytes)
+    encode_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    encoder.variant(master, mime, size, max_bytes)
+    cached_ms = (time.perf_counter() - start) * 1000
+    decoded = Image.open(io.BytesIO(variant.data))
+    row = {'mime': mime, 'size': size, 'max_bytes': max_bytes, 'bytes': len(variant),
+           'encode_ms': round(encode_ms, 1), 'encodes': encoder.counters['encodes'] - encodes,
+           'cached_ms': round(cached_ms, 3)}
+    if size is None:  # SSIM against the master only makes sense at the same size
+        row['ssim'] = round(ssim(reference, __gray__(decoded)), 4)
+    return row
+
+
+def benchmark(path, sizes, budget):
+    image = Image.open(path).convert('RGB')
+    start = time.perf_counter()
+    master = encode(image, 'image/jpeg', MASTER_QUALITY)
+    master_ms = (time.perf_counter() - start) * 1000
+    png = encode(image, 'image/png')
+    default_jpeg = len(default_jpeg_save(image))
+    reference = __gray__(Image.open(io.BytesIO(master.data)))
+    encoder = Encoder()
+    rows = []
+    for mime in [mime for mime in PREFERENCE if mime in AVAILABLE]:
+        rows.append(measure(encoder, master, reference, mime))
+        rows.append(measure(encoder, master, reference, mime, max_bytes=budget))
+        for size in sizes:
+            rows.append(measure(encoder, master, reference, mime, size=size))
+    for row in rows:
+        row['saved_vs_master'] = round(1 - row['bytes'] / len(master), 3)
+        row['saved_vs_png'] = round(1 - row['bytes'] / len(png), 3)
+        row['saved_vs_default_jpeg'] = round(1 - row['bytes'] / default_jpeg, 3)
+    return {'image': os.path.basename(path), 'pixels': list(image.size), 'master_bytes': len(master),
+            'master_ms': round(master_ms, 1), 'png_bytes': len(png), 'default_jpeg_bytes': default_jpeg,
+            'variants': rows, 'encoder': encoder.stats()}
+
+
+def default_jpeg_save(image):
+    # What a bare image.save(format="JPEG") produced before (Pillow's default quality 75)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Output encoding benchmark: bytes, encode time and SSIM per variant.")
+    parser.add_argument("images", nargs="*", default=list(DEFAULT_IMAGES), help="Sample images (default: the bundled portrait)")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"Downscaled variant sizes (default: {DEFAULT_SIZES})")
+    parser.add_argument("--budget", type=int, default=DEFAULT_BUDGET, help=f"Byte budget variant (default: {DEFAULT_BUDGET})")
+    parser.add_argument("-o", "--output", help="Write the JSON report here (default: stdout)")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    report = {'formats': list(AVAILABLE), 'images': [benchmark(path, sizes, args.budget) for path in args.images]}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    for result in report['images']:
+        print(f"{result['image']}: master {result['master_bytes']} B, png {result['png_bytes']} B", file=sys.stderr)
+        for row in result['variants']:
+            target = f"size {row['size']}" if row['size'] else f"<= {row['max_bytes']} B" if row['max_bytes'] else "ssim"
+            print(f"  {row['mime']:<11} {target:<12} {row['bytes']:>8} B  {row['encode_ms']:>7.1f} ms "
+                  f"({row['encodes']} encodes)  -{row['saved_vs_master']:.0%} vs master", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
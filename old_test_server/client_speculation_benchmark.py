@@ -0,0 +1,115 @@
+# client_speculation_benchmark.py
+# First-click latency with and without speculative precompute, in-process with stub models: users upload
+# a new photo, look at the styles for a while, then click one (drawn from a skewed popularity), and the
+# time from that click to a completed result is measured (instant: under half a model run, i.e. served by
+# the result cache). Popularity is learned from a warm-up round.
+# Also reports the speculator's hit ratio and the share of model time it wasted.
+#   python client_speculation_benchmark.py
+#   python client_speculation_benchmark.py --users 40 --top-n 3 -o speculation.json
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+import httpx
+
+from client_benchmark import install_stub_models, summarize, synthetic_jpeg
+
+STYLES = 8
+DEFAULT_SKEW = 1.2  # Zipf exponent of style popularity
+
+
+async def click(client, source_image_id, index):
+    # Start the style and poll until it is done; seconds from the click to the result
+    start = time.perf_counter()
+    response = await client.post('/start/model_ht', json={'index': index, 'style_id': f"style_{index}",
+                                                          'source_image_id': source_image_id})
+    task_id = response.json()['task_id']
+    while not (await client.get(f'/status/{task_id}')).json()['done']:
+        await asyncio.sleep(0.01)
+    return time.perf_counter() - start
+
+
+async def user(client, rng, seed, think_time, weights):
+    response = await client.post('/upload_source_image',
+                                 files={'file': ('photo.jpg', synthetic_jpeg(256, seed), 'image/jpeg')})
+    await asyncio.sleep(rng.expovariate(1 / think_time) if think_time else 0)
+    return await click(client, response.json()['source_image_id'], rng.choices(range(STYLES), weights)[0])
+
+
+async def round_of(client, rng, users, first_seed, think_time, weights, stagger):
+    async def staggered(n):
+        await asyncio.sleep(n * stagger)
+        return await user(client, rng, first_seed + n, think_time, weights)
+    return await asyncio.gather(*(staggered(n) for n in range(users)))
+
+
+async def run(args):
+    from server_dummy_app import app, speculator
+    rng = random.Random(args.seed)
+    weights = [1 / (rank + 1) ** args.skew for rank in range(STYLES)]
+    report = {'config': {'users': args.users, 'warmup': args.warmup, 'top_n': args.top_n, 'latency_s': args.latency,
+                         'think_time_s': args.think_time, 'skew': args.skew}}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=60) as client:
+        speculator.top_n = args.top_n  # Learn popularity from the warm-up round
+        await round_of(client, rng, args.warmup, 10000, 0, weights, args.stagger / 4)
+        await asyncio.sleep(args.latency * 2)
+        speculator.claim_window = 0  # Warm-up leftovers don't count against either round
+        speculator.stats()
+        speculator.claim_window = args.claim_window
+        for mode, top_n in (('off', 0), ('on', args.top_n)):
+            speculator.top_n = top_n
+            before = speculator.stats()
+            seed = 20000 if mode == 'off' else 30000  # New photos every round: nothing is cached yet
+            latencies = await round_of(client, rng, args.users, seed, args.think_time, weights, args.stagger)
+            await asyncio.sleep(args.latency * 2)  # Let speculative runs nobody clicked finish
+            speculator.claim_window = 0  # ...and count them as wasted
+            after = speculator.stats()
+            speculator.claim_window = args.claim_window
+            report[mode] = {'first_click': summarize(latencies, 0),
+                            'instant_ratio': sum(latency < args.latency / 2 for latency in latencies) / len(latencies),
+                            'speculation': {name: after[name] - before[name] for name in
+                                            ('submitted', 'hits', 'wasted', 'preempted', 'skipped_busy',
+                                             'useful_seconds', 'wasted_seconds')}}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="First-click latency with and without speculative precompute.")
+    parser.add_argument("--users", type=int, default=48, help="Users per round")
+    parser.add_argument("--warmup", type=int, default=100, help="Clicks popularity is learned from first")
+    parser.add_argument("--top-n", type=int, default=2, help="Styles precomputed per upload")
+    parser.add_argument("--latency", type=float, default=0.5, help="Stub model seconds per run")
+    parser.add_argument("--think-time", type=float, default=1.5, help="Mean seconds between upload and click")
+    parser.add_argument("--stagger", type=float, default=0.4, help="Seconds between user arrivals")
+    parser.add_argument("--skew", type=float, default=DEFAULT_SKEW, help="Zipf exponent of style popularity")
+    parser.add_argument("--claim-window", type=float, default=900.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="Write the JSON report here (default: stdout)")
+    args = parser.parse_args()
+
+    install_stub_models(args.latency)
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        from server_dummy_app import task_manager
+        task_manager.shutdown()
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    for mode in ('off', 'on'):
+        first, spec = report[mode]['first_click'], report[mode]['speculation']
+        print(f"speculation {mode:>3}: first click mean {first['mean_ms']:.0f} ms, p95 {first['p95_ms']:.0f} ms, "
+              f"{report[mode]['instant_ratio']:.0%} instant; "
+              f"{spec['hits']} hits / {spec['submitted']} runs, {spec['wasted_seconds']:.1f} model s wasted",
+              file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# client_task_state_benchmark.py
+# Microbenchmark of TaskManager's status path, in-process: reader threads call get_status on a mix of
+# running tasks (whose jobs keep reporting progress, as writers contending with the readers) and
+# finished ones. Reports status reads per second for each reader count, and the memory one pending
+# and one finished task holds (tracemalloc, everything a submit allocates).
+#   python client_task_state_benchmark.py
+#   python client_task_state_benchmark.py --readers 1,2,4,8 -d 3 -o state.json
+#   python client_task_state_benchmark.py --baseline state.json      ratios against an earlier run
+import argparse
+import gc
+import json
+import sys
+import threading
+import time
+import tracemalloc
+
+from server_tasks import TaskManager
+
+POOL = 'bench'
+DEFAULT_READERS = "1,2,4,8"
+
+
+def make_manager(max_workers):
+    return TaskManager(executor_config={POOL: {'kind': 'thread', 'max_workers': max_workers, 'max_queue': 1000000}})
+
+
+def blocked_job(release, progress_callback, cancel_check_callback):
+    release.wait()
+    return "done"
+
+
+def progress_job(release, progress_callback, cancel_check_callback):
+    # A busy writer: reports progress as fast as a chatty model would, until released
+    step = 0
+    while not release.wait(0.0005):
+        step += 1
+        progress_callback(step % 100)
+    return "done"
+
+
+def instant_job(progress_callback, cancel_check_callback):
+    return "done"
+
+
+class Countdown:
+    """on_done callback that lets the benchmark wait for a number of tasks to finish."""
+    def __init__(self, count):
+        self.count = count
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def __call__(self, task_id, state, result):
+        with self.lock:
+            self.count -= 1
+            if self.count == 0:
+                self.done.set()
+
+    def wait(self, timeout=120):
+        if not self.done.wait(timeout):
+            raise RuntimeError(f"{self.count} tasks did not finish")
+
+
+def measure_memory(count):
+    """
+    :return: Bytes per pending task (queued behind a blocked worker) and per finished task.
+    """
+    manager = make_manager(1)
+    release = threading.Event()
+    countdown = Countdown(count + 1)
+    manager.submit(blocked_job, release, pool=POOL, on_done=countdown)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    task_ids = [manager.submit(blocked_job, release, pool=POOL, on_done=countdown) for _ in range(count)]
+    gc.collect()
+    pending = tracemalloc.get_traced_memory()[0]
+    release.set()
+    countdown.wait()
+    gc.collect()
+    finished = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    manager.shutdown()
+    # The ID list itself is the caller's, not the task's
+    id_bytes = sys.getsizeof(task_ids) + sum(sys.getsizeof(task_id) for task_id in task_ids)
+    return {'pending_task_bytes': (pending - before - id_bytes) / count,
+            'finished_task_bytes': (finished - before - id_bytes) / count}
+
+
+def measure_reads(readers, duration, running, finished):
+    manager = make_manager(running)
+    release = threading.Event()
+    countdown = Countdown(finished)
+    done_ids = [manager.submit(instant_job, pool=POOL, on_done=countdown) for _ in range(finished)]
+    countdown.wait()
+    task_ids = [manager.submit(progress_job, release, pool=POOL) for _ in range(running)]
+    while any(manager.get_status(task_id)['status'] == 'Pending' for task_id in task_ids):
+        time.sleep(0.001)
+    mix = task_ids + done_ids[:len(task_ids) * 3]  # One running read in four
+
+    results = {}
+    for count in readers:
+        stop = threading.Event()
+        counts = [0] * count
+
+        def read(slot):
+            n, i = 0, slot
+            get_status = manager.get_status
+            while not stop.is_set():
+                for _ in range(100):
+                    get_status(mix[i % len(mix)])
+                    i += 1
+                n += 100
+            counts[slot] = n
+
+        threads = [threading.Thread(target=read, args=(slot,)) for slot in range(count)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        results[str(count)] = {'reads_per_s': sum(counts) / elapsed, 'per_reader_per_s': sum(counts) / elapsed / count}
+    release.set()
+    manager.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TaskManager status read throughput and per-task memory.")
+    parser.add_argument("--readers", default=DEFAULT_READERS, help=f"Reader thread counts (default: {DEFAULT_READERS})")
+    parser.add_argument("-d", "--duration", type=float, default=2.0, help="Seconds per reader count")
+    parser.add_argument("--running", type=int, default=8, help="Running tasks reporting progress meanwhile")
+    parser.add_argument("--finished", type=int, default=2000, help="Finished tasks")
+    parser.add_argument("--memory-tasks", type=int, default=20000, help="Tasks submitted for the memory figures")
+    parser.add_argument("-o", "--output", help="Write the JSON report here (default: stdout)")
+    parser.add_argument("--baseline", help="Earlier report; adds current / baseline ratios")
+    args = parser.parse_args()
+
+    readers = [int(count) for count in args.readers.split(",") if count]
+    report = {'config': {'readers': readers, 'duration_s': args.duration, 'running': args.running,
+                         'finished': args.finished, 'python': sys.version.split()[0],
+                         'gil': getattr(sys, '_is_gil_enabled', lambda: True)()},
+              'memory': measure_memory(args.memory_tasks),
+              'reads': measure_reads(readers, args.duration, args.running, args.finished)}
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        report['vs_baseline'] = {
+            'memory': {name: value / baseline['memory'][name] for name, value in report['memory'].items()},
+            'reads_per_s': {count: result['reads_per_s'] / baseline['reads'][count]['reads_per_s']
+                            for count, result in report['reads'].items() if count in baseline['reads']},
+        }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    memory = report['memory']
+    print(f"memory per task: {memory['pending_task_bytes']:.0f} B pending, {memory['finished_task_bytes']:.0f} B finished",
+          file=sys.stderr)
+    for count, result in report['reads'].items():
+        print(f"{count:>3} readers: {result['reads_per_s']:>10.0f} status reads/s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# client_upload_concurrency.py
+# Event-loop responsiveness under large uploads: polls GET /status at a fixed rate, first alone and then
+# while several clients keep uploading large photos, and compares the two latency distributions. With
+# the decode on the event loop, status p99 jumps to the decode time of a photo; off the loop it stays flat.
+# Also checks that an upload over the size limit is refused up front (413) instead of being read.
+#   python client_upload_concurrency.py                        stub server in a subprocess, over localhost
+#   python client_upload_concurrency.py --url http://host:8000
+#   python client_upload_concurrency.py -o concurrency.json    exit code 1 when status latency isn't flat
+import argparse
+import asyncio
+import io
+import json
+import sys
+import time
+
+import httpx
+from PIL import Image
+
+from client_benchmark import spawn_stub_server, summarize, synthetic_pixels
+from server_uploads import MAX_UPLOAD_BYTES
+
+DEFAULT_UPLOAD_SIZE = 4000  # Pixels per side: a 16 MP phone photo
+# Pass criterion: loaded status p99 within this factor of the idle p99, plus an absolute slack for
+# scheduling noise on small machines
+DEFAULT_MAX_RATIO = 3.0
+DEFAULT_SLACK_MS = 20.0
+
+
+def make_uploads(count, size):
+    # Distinct photos, so every upload really is decoded (byte-identical ones are answered from the store)
+    uploads = []
+    for seed in range(count):
+        buffer = io.BytesIO()
+        Image.fromarray(synthetic_pixels(size, seed=100 + seed)).save(buffer, format="JPEG", quality=95)
+        uploads.append(buffer.getvalue())
+    return uploads
+
+
+async def poll_status(client, stop, interval):
+    latencies, errors = [], 0
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            response = await client.get("/status/concurrency-probe")
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except httpx.HTTPError:
+            errors += 1
+        await asyncio.sleep(max(0.0, interval - (time.perf_counter() - start)))
+    return latencies, errors
+
+
+async def upload_loop(client, stop, uploads, offset, latencies, errors):
+    i = offset
+    while not stop.is_set():
+        data = uploads[i % len(uploads)] + i.to_bytes(4, 'big')  # Trailing bytes: a new sha256, same pixels
+        i += len(uploads)
+        start = time.perf_counter()
+        try:
+            response = await client.post("/upload_source_image", files={'file': ('photo.jpg', data, 'image/jpeg')})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except httpx.HTTPError:
+            errors.append(1)
+
+
+async def phase(client, duration, interval, uploads=None, uploaders=0):
+    stop = asyncio.Event()
+    poller = asyncio.create_task(poll_status(client, stop, interval))
+    upload_latencies, upload_errors = [], []
+    workers = [asyncio.create_task(upload_loop(client, stop, uploads, n, upload_latencies, upload_errors))
+               for n in range(uploaders)]
+    await asyncio.sleep(duration)
+    stop.set()
+    latencies, errors = await poller
+    await asyncio.gather(*workers)
+    report = {'status': summarize(latencies, errors)}
+    if uploaders:
+        report['upload'] = summarize(upload_latencies, len(upload_errors))
+    return report
+
+
+async def oversized(url, limit):
+    # Sends only the headers of an upload declared over the limit, over a raw connection (HTTP clients
+    # don't read a response before their body is out): the 413 must come without any body
+    parsed = httpx.URL(url)
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(parsed.host, parsed.port or 80)
+    try:
+        writer.write(f"POST /upload_source_image HTTP/1.1\r\nHost: {parsed.host}\r\n"
+                     f"Content-Type: image/jpeg\r\nContent-Length: {limit + 1}\r\n\r\n".encode('ascii'))
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout=10)
+    finally:
+        writer.close()
+    return {'status_code': int(status_line.split()[1]), 'ms': (time.perf_counter() - start) * 1000}
+
+
+async def run(args, url):
+    uploads = make_uploads(args.uploaders, args.upload_size)
+    async with httpx.AsyncClient(base_url=url, timeout=args.timeout) as client:
+        await client.post("/upload_source_image", files={'file': ('warmup.jpg', uploads[0], 'image/jpeg')})
+        idle = await phase(client, args.duration, args.interval)
+        loaded = await phase(client, args.duration, args.interval, uploads, args.uploaders)
+    rejected = await oversized(url, MAX_UPLOAD_BYTES)
+    idle_p99, loaded_p99 = idle['status']['p99_ms'], loaded['status']['p99_ms']
+    flat = (idle_p99 is not None and loaded_p99 is not None
+            and loaded_p99 <= idle_p99 * args.max_ratio + args.slack_ms)
+    return {
+        'config': {'target': url, 'uploaders': args.uploaders, 'upload_size': args.upload_size,
+                   'upload_bytes': len(uploads[0]), 'duration_s': args.duration, 'interval_s': args.interval},
+        'idle': idle,
+        'loaded': loaded,
+        'status_p99_ratio': loaded_p99 / idle_p99 if idle_p99 and loaded_p99 else None,
+        'flat': flat,
+        'oversized': rejected,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Status latency with and without concurrent large uploads.")
+    parser.add_argument("--url", help="Server to test (default: a stub-model server on localhost)")
+    parser.add_argument("--port", type=int, default=8766, help="Port of the stub server")
+    parser.add_argument("--uploaders", type=int, default=4, help="Concurrent uploading clients")
+    parser.add_argument("--upload-size", type=int, default=DEFAULT_UPLOAD_SIZE, help="Photo side in pixels")
+    parser.add_argument("-d", "--duration", type=float, default=10.0, help="Seconds per phase")
+    parser.add_argument("--interval", type=float, default=0.02, help="Seconds between status polls")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-request timeout")
+    parser.add_argument("--max-ratio", type=float, default=DEFAULT_MAX_RATIO)
+    parser.add_argument("--slack-ms", type=float, default=DEFAULT_SLACK_MS)
+    parser.add_argument("-o", "--output", help="Write the JSON report here (default: stdout)")
+    args = parser.parse_args()
+
+    process, url = None, args.url
+    if not url:
+        args.latency = 0.2  # What spawn_stub_server passes on to the stub models
+        process, url = spawn_stub_server(args)
+    try:
+        report = asyncio.run(run(args, url))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    idle, loaded = report['idle']['status'], report['loaded']['status']
+    print(f"status p99: {idle['p99_ms']:.1f} ms idle, {loaded['p99_ms']:.1f} ms during uploads "
+          f"({loaded['max_ms']:.1f} ms max); oversized upload: {report['oversized']['status_code']} "
+          f"in {report['oversized']['ms']:.0f} ms", file=sys.stderr)
+    sys.exit(0 if report['flat'] and report['oversized']['status_code'] == 413 else 1)
+
+
+if __name__ == "__main__":
+    main()
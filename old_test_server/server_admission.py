@@ -0,0 +1,143 @@
+# server_admission.py
+import math
+from collections import OrderedDict, deque
+
+from server_metrics import InstrumentedLock
+
+PRIORITIES = {'interactive': 0, 'default': 1, 'bulk': 2}  # Lower level is served first
+SERVICE_TIME_ALPHA = 0.2  # EWMA weight of the latest task duration, for ETAs
+
+
+class QueueFullError(Exception):
+    """Raised by TaskManager.submit when a pool's admission queue is full; maps to HTTP 429."""
+    def __init__(self, pool, retry_after):
+        super().__init__(f"Queue for '{pool}' is full, retry in {retry_after}s")
+        self.pool = pool
+        self.retry_after = retry_after  # Whole seconds, for the Retry-After header
+
+
+class AdmissionQueue:
+    """
+    Bounded, prioritized admission in front of one executor backend.
+    At most max_inflight jobs are handed to the backend at once; the rest wait here (up to
+    max_depth, beyond that submit is rejected), so a burst never piles up in the executor's own
+    unbounded queue and a queued job can be canceled by just dropping it.
+    Waiting jobs are taken by priority class, and round-robin between clients within a class,
+    so one client's bulk run can't starve everyone else.
+    Callers get start callables back and run them outside the queue's lock.
+    """
+    def __init__(self, name, max_depth, max_inflight, initial_service_time=1.0):
+        self.name = name
+        self.max_depth = max_depth
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        # level: OrderedDict(client: deque of task_ids); client order is the round-robin order
+        self.classes = {level: OrderedDict() for level in sorted(set(PRIORITIES.values()))}
+        self.entries = {}  # task_id: (level, client, start)
+        self.service_time = initial_service_time  # EWMA of seconds from dispatch to finish
+        self.lock = InstrumentedLock('admission')
+        self.counters = {'admitted': 0, 'rejected': 0, 'canceled_in_queue': 0}
+
+    def admit(self, task_id, start, priority='default', client=''):
+        """
+        Queue a job, or reject it if the queue is full.
+        :param start: Callable that hands the job to the backend.
+        :param priority: A PRIORITIES key.
+        :return: Start callables to run now (possibly this job's).
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{priority}', expected one of {list(PRIORITIES)}")
+        level = PRIORITIES[priority]
+        with self.lock:
+            if len(self.entries) >= self.max_depth:
+                self.counters['rejected'] += 1
+                raise QueueFullError(self.name, self.__retry_after__())
+            self.entries[task_id] = (level, client, start)
+            self.classes[level].setdefault(client, deque()).append(task_id)
+            self.counters['admitted'] += 1
+            return self.__take__()
+
+    def release(self, service_time=None):
+        """
+        A dispatched job finished.
+        :param service_time: Its dispatch-to-finish seconds, to keep ETAs current.
+        :return: Start callables to run now.
+        """
+        with self.lock:
+            self.inflight -= 1
+            if service_time is not None:
+                self.service_time += SERVICE_TIME_ALPHA * (service_time - self.service_time)
+            return self.__take__()
+
+    def remove(self, task_id):
+        """
+        Drop a job that is still waiting.
+        :return: False if it was not queued (already started, or unknown).
+        """
+        with self.lock:
+            entry = self.entries.pop(task_id, None)
+            if entry is None:
+                return False
+            level, client, _ = entry
+            queue = self.classes[level][client]
+            queue.remove(task_id)
+            if not queue:
+                del self.classes[level][client]
+            self.counters['canceled_in_queue'] += 1
+            return True
+
+    def __take__(self):
+        # Caller holds self.lock
+        starts = []
+        while self.inflight < self.max_inflight and self.entries:
+            clients = next(clients for clients in self.classes.values() if clients)
+            client, queue = next(iter(clients.items()))
+            task_id = queue.popleft()
+            if queue:
+                clients.move_to_end(client)  # Next turn goes to the next client
+            else:
+                del clients[client]
+            starts.append(self.entries.pop(task_id)[2])
+            self.inflight += 1
+        return starts
+
+    def __retry_after__(self):
+        # Caller holds self.lock. Time for the backlog to drain one slot's worth
+        return max(1, math.ceil(len(self.entries) / self.max_inflight * self.service_time))
+
+    def spare(self):
+        """
+        :return: Jobs that could be let through now; negative: jobs waiting for a slot.
+        """
+        with self.lock:
+            return self.max_inflight - self.inflight - len(self.entries)
+
+    def position(self, task_id):
+        """
+        Estimated place in line, given the current queue (later higher-priority arrivals can still overtake).
+        :return: {'queue_position' (1 = next), 'eta_seconds'} or None if the job is not waiting.
+        """
+        with self.lock:
+            entry = self.entries.get(task_id)
+            if entry is None:
+                return None
+            level, client, _ = entry
+            ahead = sum(len(queue) for lower, clients in self.classes.items() if lower < level
+                        for queue in clients.values())
+            clients = self.classes[level]
+            index = clients[client].index(task_id)
+            before_us = True  # Clients before ours in round-robin order get one more turn first
+            for other, queue in clients.items():
+                if other == client:
+                    before_us = False
+                    ahead += index
+                else:
+                    ahead += min(len(queue), index + 1 if before_us else index)
+            waves = (ahead + self.inflight) // self.max_inflight + 1  # Rounds of max_inflight jobs until ours starts
+            return {'queue_position': ahead + 1, 'eta_seconds': round(waves * self.service_time, 1)}
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, 'queued': len(self.entries), 'inflight': self.inflight,
+                    'max_depth': self.max_depth, 'max_inflight': self.max_inflight,
+                    'service_time': self.service_time}
@@ -0,0 +1,212 @@
+# server_batching.py
+import concurrent.futures
+import threading
+import time
+from collections import deque
+
+from server_executors import CancelToken, TaskRevokedError
+
+LATENCY_WINDOW = 1000  # Recent jobs kept for latency percentiles
+
+
+class BatchCancelToken(CancelToken):
+    """
+    CancelToken of a batch member: once it raises, the member's future is failed right away, so its
+    task is reported canceled while the rest of the batch keeps running.
+    """
+    __slots__ = ('future',)
+
+    def __init__(self, event, future):
+        super().__init__(event)
+        self.future = future
+
+    def __call__(self):
+        try:
+            super().__call__()
+        except TaskRevokedError as e:
+            self.__settle__(e)
+            raise
+
+    def wait(self, seconds):
+        try:
+            super().wait(seconds)
+        except TaskRevokedError as e:
+            self.__settle__(e)
+            raise
+
+    def __settle__(self, error):
+        # Only the batch's worker thread resolves its members' futures, so this can't race with run()
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+class BatchJob:
+    """One queued task inside a BatchScheduler; handed to run_batch as part of a list."""
+    def __init__(self, args, kwargs, progress_callback, cancel_event):
+        self.args = args
+        self.kwargs = kwargs
+        self.progress_callback = progress_callback
+        self.future = concurrent.futures.Future()
+        self.cancel_check_callback = BatchCancelToken(cancel_event, self.future)
+        self.enqueued_at = time.monotonic()
+
+
+class BatchScheduler:
+    """
+    Executor backend that micro-batches jobs: it waits up to max_wait seconds for up to
+    max_batch_size jobs with the same group_key, then runs them with a single
+    run_batch(jobs) call. run_batch returns one result (or exception) per job, in order.
+    A new batch is only formed when one of the max_workers batch slots is free, so under
+    load batches grow on their own while latency stays bounded when idle.
+    Each job keeps its own future, progress callback and cancel event.
+    """
+    kind = 'batch'
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait=0.05, max_workers=1, group_key=None, name='batch'):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.group_key = group_key or (lambda job: None)
+        self.max_workers = max_workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.free_slots = threading.Semaphore(max_workers)
+        self.pending = []  # BatchJob, oldest first
+        self.running = 0  # Batches taken and not finished
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.stats_lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.counters = {'batches': 0, 'jobs': 0, 'canceled_before_start': 0}
+        self.batch_sizes = {}  # size: number of batches
+        self.queue_waits = deque(maxlen=LATENCY_WINDOW)  # Seconds from enqueue to batch start
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # Seconds from enqueue to result
+        threading.Thread(target=self.__dispatch__, name=f"{name}-dispatch", daemon=True).start()
+
+    def make_cancel_event(self):
+        return threading.Event()
+
+    def submit(self, fn, args, kwargs, progress_callback, cancel_event):
+        # fn is the unbatched entry point; batches go through run_batch instead
+        job = BatchJob(args, kwargs, progress_callback, cancel_event)
+        with self.condition:
+            self.pending.append(job)
+            self.condition.notify()
+        return job.future
+
+    def result(self, future):
+        return future.result()
+
+    def shutdown(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __take_batch__(self):
+        # Caller holds self.condition. Waits for the oldest job's group to fill up or its deadline.
+        while True:
+            while not self.pending and not self.stopped:
+                self.condition.wait()
+            if self.stopped:
+                return None
+            oldest = self.pending[0]
+            key = self.group_key(oldest)
+            group = [job for job in self.pending if self.group_key(job) == key][:self.max_batch_size]
+            remaining = oldest.enqueued_at + self.max_wait - time.monotonic()
+            if len(group) >= self.max_batch_size or remaining <= 0:
+                taken = set(map(id, group))
+                self.pending = [job for job in self.pending if id(job) not in taken]
+                return group
+            self.condition.wait(remaining)
+
+    def __dispatch__(self):
+        while True:
+            self.free_slots.acquire()
+            with self.condition:
+                batch = self.__take_batch__()
+                if batch is not None:
+                    self.running += 1
+            if batch is None:
+                return
+            # Drop jobs canceled while queued (future.cancel() from TaskManager.cancel)
+            runnable = [job for job in batch if job.future.set_running_or_notify_cancel()]
+            with self.stats_lock:
+                self.counters['canceled_before_start'] += len(batch) - len(runnable)
+            batch = runnable
+            if not batch:
+                self.__batch_done__()
+                continue
+            try:
+                self.executor.submit(self.__run__, batch)
+            except RuntimeError as e:  # Shut down (or the interpreter is exiting) while we waited
+                for job in batch:
+                    job.future.set_exception(e)
+                self.__batch_done__()
+                return
+
+    def __run__(self, batch):
+        started = time.monotonic()
+        try:
+            try:
+                results = self.run_batch(batch)
+                if len(results) != len(batch):
+                    raise RuntimeError(f"run_batch returned {len(results)} results for {len(batch)} jobs")
+            except Exception as e:
+                results = [e] * len(batch)
+            finished = time.monotonic()
+            for job, result in zip(batch, results):
+                if job.future.done():
+                    continue  # Canceled during the batch and already reported (BatchCancelToken)
+                if isinstance(result, BaseException):
+                    job.future.set_exception(result)
+                else:
+                    job.future.set_result(result)
+            with self.stats_lock:
+                self.counters['batches'] += 1
+                self.counters['jobs'] += len(batch)
+                self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+                for job in batch:
+                    self.queue_waits.append(started - job.enqueued_at)
+                    self.latencies.append(finished - job.enqueued_at)
+        finally:
+            self.__batch_done__()
+
+    def __batch_done__(self):
+        with self.condition:
+            self.running -= 1
+        self.free_slots.release()
+
+    def spare(self):
+        """
+        :return: Workers free for another batch, less one if jobs are already waiting to form one
+                 (negative: jobs wait for a worker).
+        """
+        with self.condition:
+            return self.max_workers - self.running - (1 if self.pending else 0)
+
+    def stats(self):
+        """
+        Throughput vs. latency numbers for tuning max_batch_size / max_wait.
+        """
+        def percentile(values, q):
+            if not values:
+                return 0.0
+            ordered = sorted(values)
+            return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+        with self.stats_lock, self.condition:
+            elapsed = time.monotonic() - self.started_at
+            return {
+                **self.counters,
+                'pending': len(self.pending),
+                'running_batches': self.running,
+                'max_batch_size': self.max_batch_size,
+                'max_wait': self.max_wait,
+                'mean_batch_size': self.counters['jobs'] / self.counters['batches'] if self.counters['batches'] else 0.0,
+                'batch_sizes': dict(sorted(self.batch_sizes.items())),
+                'throughput_jobs_per_second': self.counters['jobs'] / elapsed if elapsed else 0.0,
+                'queue_wait_p50': percentile(self.queue_waits, 0.5),
+                'queue_wait_p95': percentile(self.queue_waits, 0.95),
+                'latency_p50': percentile(self.latencies, 0.5),
+                'latency_p95': percentile(self.latencies, 0.95),
+            }
@@ -0,0 +1,206 @@
+# server_dedup.py
+import threading
+
+import numpy as np
+from PIL import Image
+
+from server_store import BoundedStore
+
+HASH_SIZE = 8  # 64-bit hashes
+MAX_DISTANCE = 6  # Hamming distance (out of 64) still counted as the same photo
+MAX_ASPECT_DIFFERENCE = 0.03  # Crops change the aspect ratio, re-encodes and resizes don't
+PIXEL_CHECK_SIZE = 32  # Near matches are confirmed on thumbnails this size
+MAX_PIXEL_DIFFERENCE = 16  # Largest thumbnail pixel difference (0-255, brightness evened out) of the same photo
+EVICT_FRACTION = 0.1  # Share of the index dropped at once when it is full, so rebuilds stay rare
+
+
+def __gray__(array, size):
+    # (H, W, 3) uint8 -> (size[1], size[0]) float32 luminance, downscaled with a box filter
+    image = Image.fromarray(array).convert('L').resize(size, Image.BOX)
+    return np.asarray(image, dtype=np.float32)
+
+
+def __pack__(bits):
+    return int.from_bytes(np.packbits(bits.reshape(-1)).tobytes(), 'big')
+
+
+def dhash(array, hash_size=HASH_SIZE):
+    """
+    Difference hash: one bit per horizontally adjacent pair of a (hash_size, hash_size + 1) thumbnail,
+    set where brightness increases. Survives recompression, resizing and small colour shifts.
+    :return: int of hash_size ** 2 bits.
+    """
+    gray = __gray__(array, (hash_size + 1, hash_size))
+    return __pack__(gray[:, 1:] > gray[:, :-1])
+
+
+def __dct_matrix__(n):
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * k * (2 * np.arange(n)[None, :] + 1) / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+DCT_32 = __dct_matrix__(32)
+
+
+def phash(array, hash_size=HASH_SIZE):
+    """
+    Perceptual hash: the low-frequency hash_size x hash_size block of the 2-D DCT of a 32x32
+    thumbnail, one bit per coefficient above their median. More robust than dhash to gamma and
+    contrast changes, slightly more work (two 32x32 matrix products).
+    :return: int of hash_size ** 2 bits.
+    """
+    gray = __gray__(array, (32, 32))
+    low = (DCT_32 @ gray @ DCT_32.T)[:hash_size, :hash_size]
+    return __pack__(low > np.median(low))
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def __thumbnail__(array):
+    # (H, W, 3) uint8 -> (PIXEL_CHECK_SIZE, PIXEL_CHECK_SIZE, 3) float32 with its mean scaled to 128
+    image = Image.fromarray(array).resize((PIXEL_CHECK_SIZE, PIXEL_CHECK_SIZE), Image.BOX)
+    thumbnail = np.asarray(image, dtype=np.float32)
+    return thumbnail * (128 / max(float(thumbnail.mean()), 1.0))
+
+
+def same_pixels(a, b, max_difference=MAX_PIXEL_DIFFERENCE):
+    """
+    Pixel-level check of a hash match: no thumbnail pixel of the two images differs by more than
+    max_difference. Re-encodes, resizes and brightness changes pass; a hash collision between two
+    photos, or the same photo with a face or region swapped, does not.
+    """
+    return float(np.abs(__thumbnail__(a) - __thumbnail__(b)).max()) <= max_difference
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over integer hashes in Hamming space: a lookup within distance d only
+    descends into children whose edge distance is within d of the query's distance to the node,
+    so it visits a small part of the tree. Insert-only; rebuild to drop entries.
+    """
+    def __init__(self):
+        self.root = None  # [hash, {distance: child node}]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value):
+        if self.root is None:
+            self.root = [value, {}]
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                return  # Already present
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [value, {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """
+        :return: [(distance, hash)] within max_distance, closest first.
+        """
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found.append((distance, node[0]))
+            for edge, child in node[1].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return sorted(found)
+
+
+class DedupIndex:
+    """
+    Maps uploads to a canonical source ID, so the same photo re-saved, re-compressed (e.g. by the
+    browser) or resized reuses the first upload's ID and with it every cached model output.
+    Exact byte matches are answered from a sha256 alias table; otherwise the perceptual hash of the
+    decoded image is looked up in a BK-tree within max_distance bits, and a hash match only counts once
+    the pixels agree too (same_pixels): uploads from different users share an ID only if they are the same photo.
+    """
+    def __init__(self, hash_fn=phash, max_distance=MAX_DISTANCE, max_entries=100000):
+        self.hash_fn = hash_fn
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.tree = BKTree()
+        self.sources = {}  # perceptual hash: [(source_id, aspect ratio)]
+        self.aliases = BoundedStore(0, max_entries=max_entries)  # sha256 of the upload: canonical source ID
+        self.lock = threading.Lock()
+        self.counters = {'exact': 0, 'near': 0, 'new': 0, 'rejected': 0, 'rebuilds': 0}
+
+    def alias(self, upload_id):
+        """
+        :return: Canonical source ID of an upload seen before byte for byte, or None.
+        """
+        canonical = self.aliases.get(upload_id)
+        if canonical is not None:
+            with self.lock:
+                self.counters['exact'] += 1
+        return canonical
+
+    def canonical(self, upload_id, array, load, is_live=lambda source_id: True):
+        """
+        Find or register the canonical source of a decoded upload.
+        :param upload_id: Exact ID of the upload (sha256 of its bytes).
+        :param array: Decoded image, (H, W, 3) uint8; a small preview is plenty.
+        :param load: Callable(source_id) -> the same kind of array for a stored source, or None if it is
+                     forgotten; near matches are confirmed against it pixel by pixel.
+        :param is_live: Whether a source ID is still stored (cheap check, used when the index is pruned).
+        :return: (source_id, is_new). is_new: no near match, upload_id is now canonical.
+        """
+        image_hash = self.hash_fn(array)
+        aspect = array.shape[1] / array.shape[0]
+        with self.lock:
+            matches = [(distance, source_id) for distance, match in self.tree.search(image_hash, self.max_distance)
+                       for source_id, source_aspect in self.sources[match]
+                       if abs(source_aspect - aspect) <= MAX_ASPECT_DIFFERENCE * aspect]
+        for _, source_id in sorted(matches):
+            if source_id == upload_id:
+                continue
+            candidate = load(source_id)
+            if candidate is None:
+                continue  # Forgotten
+            if not same_pixels(array, candidate):
+                with self.lock:
+                    self.counters['rejected'] += 1
+                continue
+            self.aliases[upload_id] = source_id
+            with self.lock:
+                self.counters['near'] += 1
+            return source_id, False
+        with self.lock:
+            if len(self.tree) >= self.max_entries:
+                self.__rebuild__(is_live)
+            self.tree.add(image_hash)
+            self.sources.setdefault(image_hash, []).append((upload_id, aspect))
+            self.counters['new'] += 1
+        return upload_id, True
+
+    def __rebuild__(self, is_live):
+        # Caller holds self.lock. Drops forgotten sources (the tree itself can't delete), then the oldest
+        # hashes until EVICT_FRACTION of the room is free: the O(n) rebuild runs once per that many inserts
+        sources = {image_hash: live for image_hash, entries in self.sources.items()
+                   if (live := [entry for entry in entries if is_live(entry[0])])}
+        excess = len(sources) - int(self.max_entries * (1 - EVICT_FRACTION))
+        self.sources = dict(list(sources.items())[max(0, excess):])  # Insertion order: oldest first
+        self.counters['rebuilds'] += 1
+        self.tree = BKTree()
+        for image_hash in self.sources:
+            self.tree.add(image_hash)
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, 'hashes': len(self.tree), 'aliases': len(self.aliases)}
@@ -1,12 +1,37 @@
 # server_dummy_app.py
-import time
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from server_tasks import run_ml_task, MODEL_REGISTRY, TaskManager
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from server_admission import PRIORITIES, QueueFullError
+from server_encoding import Encoder, negotiate
+from server_events import TaskSubscriber
+from server_executors import CpuPool
+from server_gallery import THUMBNAIL_SIZES
+from server_images import ImageResult, parse_range
+from server_metrics import REGISTRY, RECENT_SPANS, TRACING, MetricsMiddleware, span
+from server_result_cache import ResultCache
+from server_sources import check_source_id
+from server_speculation import Speculator
+from server_task_state import make_task_state
+from server_tasks import start_ml_task, MODEL_REGISTRY, TaskManager
+from server_uploads import MAX_PARAMS_BYTES, UploadTooLargeError, read_body, read_upload
+
+@asynccontextmanager
+async def lifespan(app):
+    # Bind first, load models in the background; /readyz reports when they are in
+    MODEL_REGISTRY.warm_up()
+    yield
+    cpu_pool.shutdown()
 
 app = FastAPI(title="ML Task Server",
-              description="API for managing ML model tasks with progress, cancellation, and image upload")
+              description="API for managing ML model tasks with progress, cancellation, and image upload",
+              lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -16,22 +41,122 @@ app.add_middleware(
     allow_methods=["*"],     # Allow all methods (GET, POST, etc.); or specify ["POST"] if only needed for this endpoint
     allow_headers=["*"],     # Allow all headers; or specify relevant ones like ["Content-Type"]
 )
+app.add_middleware(MetricsMiddleware)  # Outermost: per-route latency and bytes in/out for /metrics
+
+# 'memory' (default) keeps tasks in this process; with a shared backend ('sqlite:///...' for several
+# workers on one host, 'redis://...' across hosts) any replica can answer for any task
+TASK_STATE_URL = os.environ.get("HAIRSFE_TASK_STATE", "memory")
+task_manager = TaskManager(state=make_task_state(TASK_STATE_URL))
+result_cache = ResultCache()  # Pass persist_dir=... to keep results across restarts
+encoder = Encoder()  # Per-client variants (format, size, byte budget) of stored image results
+# CPU work of the handlers below (decodes, encodes, params parsing) runs here, never on the event loop
+cpu_pool = CpuPool()
+# HAIRSFE_SPECULATE_TOP_N=N: after each upload, precompute the N most requested model_ht styles on idle
+# capacity, so a first click is often a result cache hit (0, the default, turns it off)
+SPECULATE_TOP_N = int(os.environ.get("HAIRSFE_SPECULATE_TOP_N", "0"))
+speculator = Speculator(task_manager, result_cache, 'model_ht', top_n=SPECULATE_TOP_N)
+
+SSE_KEEPALIVE_SECONDS = 15  # Comment line sent on idle streams so proxies don't drop them
+
+def store_source(image_data, upload_id=None):
+    # CPU pool: decode and store an upload (loading model_ht if it isn't yet)
+    return MODEL_REGISTRY['model_ht'].upload_source_image(image_data, upload_id=upload_id)
+
+def upload_source(image_data, upload_id=None):
+    # CPU pool: store_source for the upload endpoints, then start speculative runs for the new source
+    source_image_id = store_source(image_data, upload_id)
+    speculator.speculate(source_image_id)
+    return source_image_id
+
+def start_model_task(model_name, params, **kwargs):
+    # CPU pool: start_ml_task through the result cache (it hashes params, image params included).
+    # Requests for the speculated model claim speculative results and preempt speculative runs
+    speculated = model_name == speculator.model_name
+    if speculated:
+        speculator.observe(params)
+    try:
+        return start_ml_task(task_manager, model_name, params, result_cache=result_cache, **kwargs)
+    finally:
+        if speculated:
+            speculator.preempt()
+
+async def from_state(fn, *args):
+    # TaskManager reads: with the in-process state there's no I/O, answer on the event loop;
+    # shared state means a SQLite / Redis round trip, which goes to the I/O thread pool
+    if task_manager.state.kind == 'memory':
+        return fn(*args)
+    return await run_in_threadpool(fn, *args)
+
+def parse_params(text):
+    # Task params: a JSON object, like the dict FastAPI used to validate
+    params = json.loads(text)
+    if not isinstance(params, dict):
+        raise ValueError("params must be a JSON object")
+    return params
+
+def parse_ws_command(text):
+    # /ws/tasks client message: {"subscribe": [task_id, ...], "unsubscribe": [...]}, both optional
+    message = json.loads(text)
+    if not isinstance(message, dict):
+        raise ValueError("message must be a JSON object")
+    task_ids = {}
+    for name in ('subscribe', 'unsubscribe'):
+        task_ids[name] = message.get(name, [])
+        if not isinstance(task_ids[name], list) or not all(isinstance(task_id, str) for task_id in task_ids[name]):
+            raise ValueError(f"'{name}' must be a list of task IDs")
+    return task_ids['subscribe'], task_ids['unsubscribe']
 
-task_manager = TaskManager()
+async def read_multipart_params(request: Request):
+    # multipart/form-data: a 'params' JSON field plus files. An 'image' file is stored like
+    # /upload_source_image and passed by source_image_id; other files (e.g. 'mask') go to the model as bytes.
+    fields, files = await read_upload(request)
+    params = parse_params(fields.get('params') or '{}')
+    for name, upload in files.items():
+        if name == 'image':
+            params['source_image_id'] = await cpu_pool.run(store_source, upload.data, upload.digest)
+        else:
+            params[name] = ImageResult(upload.data, upload.content_type)
+    return params
+
+def client_id(request: Request):
+    # Fair-share key for the admission queues
+    return request.headers.get("x-client-id") or (request.client.host if request.client else "")
 
 @app.post("/start/{model_name}", status_code=202)
-def start_task(model_name: str, params: dict):  # Use dict for flexibility, or Params for validation
+async def start_task(model_name: str, request: Request, priority: str = "default"):
+    # Params as a JSON body, or multipart/form-data (see read_multipart_params) to send images as raw bytes.
+    # priority: 'interactive' (e.g. previews), 'default' or 'bulk'.
+    # An Idempotency-Key header makes retries safe: the same key (per client) returns the same task
     if model_name not in MODEL_REGISTRY.keys():  # Validate model_name
         raise HTTPException(status_code=400, detail="Invalid model name")
-    task_id = task_manager.submit(run_ml_task, model_name, params)
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Invalid priority, expected one of {list(PRIORITIES)}")
+    try:
+        if request.headers.get('content-type', '').startswith('multipart/form-data'):
+            params = await read_multipart_params(request)
+        else:
+            params = await cpu_pool.run(parse_params, (await read_body(request, MAX_PARAMS_BYTES)).data)
+        if 'source_image_id' in params:
+            check_source_id(params['source_image_id'])  # IDs reach the store (and its spill files) as-is
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except QueueFullError as e:  # CPU pool saturated (parsing params, storing an 'image' file)
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid params: {str(e)}")
+    client = client_id(request)
+    idempotency_key = request.headers.get("idempotency-key")
+    try:
+        task_id = await cpu_pool.run(
+            start_model_task, model_name, params, priority=priority, client=client,
+            idempotency_key=f"{client}:{model_name}:{idempotency_key}" if idempotency_key else None)
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     return {"task_id": task_id}
 
 @app.post("/upload_source_image_payload")
 async def upload_source_image_payload(params: dict):
     # Restrict to image types if needed
-    # Measure time taken to upload
-    print("Received file for upload:")
-    start_time = time.time()
     source_image_byte64 = params.get('source_image')
     # if not file.content_type.startswith("image/"):
     #     raise HTTPException(status_code=400, detail="File must be an image")
@@ -40,50 +165,269 @@ async def upload_source_image_payload(params: dict):
         # image_data = await file.read()
         # Decode base64 string to bytes
         image_data = source_image_byte64.encode('utf-8')  # Assuming the input is a base64 string
+        source_image_id = await cpu_pool.run(upload_source, image_data)
         model = MODEL_REGISTRY['model_ht']  # Assuming model_ht is the only one for image upload
-        target_style_images, source_image_id = model.upload_source_image(image_data)  # Directly call the model method
-        elapsed_time = time.time() - start_time
-        print(f"Image upload and processing took {elapsed_time:.2f} seconds")
         return {
-            "images": target_style_images,
+            "styles": model.style_catalogue(),
+            "thumbnail_sizes": THUMBNAIL_SIZES,
             "sourceImageId": source_image_id
         }
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
 
 @app.post("/upload_source_image", status_code=200)
-async def upload_source_image(file: UploadFile = File(...)):
-    start_time = time.time()
-    if not file.content_type.startswith("image/"):
+async def upload_source_image(request: Request):
+    # The image as a multipart 'file' field (or as the raw body, with its image/* Content-Type).
+    # Read as it streams in: hashed on the way, refused with 413 as soon as it is over MAX_UPLOAD_BYTES;
+    # the decode then runs on the CPU pool, so other requests never wait behind a large photo.
+    # Read / decode timings go to /metrics (hairsfe_phase_duration_seconds), the total to the route histogram
+    try:
+        with span('read'):
+            _, files = await read_upload(request, max_files=1)
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid upload: {str(e)}")
+    upload = files.get('file')
+    if upload is None or not upload.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
 
-    # Log upload start
-    upload_start = time.time()
-    image_data = await file.read()
-    upload_time = time.time() - upload_start
-    print(f"File read took {upload_time:.2f} seconds")
-
-    # Log processing
-    process_start = time.time()
+    try:
+        source_image_id = await cpu_pool.run(upload_source, upload.data, upload.digest)
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except ValueError as e:  # Not a decodable image
+        raise HTTPException(status_code=400, detail=str(e))
     model = MODEL_REGISTRY['model_ht']  # Assuming model_ht is the only one for image upload
-    target_style_images, source_image_id = model.upload_source_image(image_data)
-    process_time = time.time() - process_start
-    print(f"Processing took {process_time:.2f} seconds")
-
-    elapsed_time = time.time() - start_time
-    print(f"Total endpoint time: {elapsed_time:.2f} seconds")
     return {
-        "images": target_style_images,
+        # One entry per style: stable ID (pass as 'style_id' to model_ht), URL and dimensions
+        "styles": model.style_catalogue(),
+        "thumbnail_sizes": THUMBNAIL_SIZES,
         "source_image_id": source_image_id
     }
 
+@app.get("/styles/{style_id}")
+def get_style(style_id: str, request: Request, size: int = None):
+    # Content-addressed URLs (/styles/{hash}) never change, so the hash (+ thumbnail size) is a strong ETag
+    # and they are cached forever; stable-ID URLs are revalidated since the file behind them may change
+    styles = MODEL_REGISTRY['model_ht'].target_styles
+    content_hash = styles.resolve(style_id)
+    entry = styles.get(content_hash, size) if content_hash is not None else None
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Style not found")
+    etag = f'"{content_hash}-{size}"' if size else f'"{content_hash}"'
+    cache_control = "public, max-age=31536000, immutable" if style_id == content_hash else "public, no-cache"
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    data, mime = entry
+    return Response(content=data, media_type=mime, headers=headers)
+
 @app.get("/status/{task_id}")
-def get_status(task_id: str):
-    return task_manager.get_status(task_id)
+async def get_status(task_id: str):
+    return await from_state(task_manager.get_status, task_id)
+
+@app.get("/result/{task_id}")
+async def get_result(task_id: str, request: Request, size: int = None, max_bytes: int = None):
+    # Raw result bytes with their real content type; supports single byte ranges for resumable downloads.
+    # Image results are re-encoded per client: the smallest format its Accept header names
+    # (AVIF / WebP, else the stored format), optionally downscaled to size (longest side) and/or fit
+    # into max_bytes (both rounded to a fixed set of steps, see server_encoding.quantize); otherwise the
+    # quality is the lowest that stays visually identical to the stored one
+    result = await from_state(task_manager.get_result, task_id)
+    if isinstance(result, str) and result.startswith("data:"):
+        result = ImageResult.from_data_url(result)  # Models that still return data URLs
+    if not isinstance(result, ImageResult):
+        raise HTTPException(status_code=404, detail="No binary result for this task")
+    if (size is not None and size <= 0) or (max_bytes is not None and max_bytes <= 0):
+        raise HTTPException(status_code=400, detail="size and max_bytes must be positive")
+    if result.mime.startswith("image/"):
+        mime = negotiate(request.headers.get("accept"), fallback=result.mime)
+        try:
+            result = await cpu_pool.run(encoder.variant, result, mime, size, max_bytes)
+        except QueueFullError as e:
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    etag = f'"{result.digest()}"'
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "private, max-age=3600", "Vary": "Accept"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    try:
+        byte_range = parse_range(request.headers.get("range"), len(result))
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{len(result)}"})
+    if byte_range is None:
+        return Response(content=result.data, media_type=result.mime, headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(result)}"
+    return Response(content=result.data[start:end + 1], status_code=206, media_type=result.mime, headers=headers)
+
+@app.get("/preview/{task_id}")
+def get_preview(task_id: str, request: Request):
+    # Latest low-resolution preview of a running task (its status carries preview_url while there is one).
+    # Replaced as the task goes on, so clients revalidate; the ETag is the preview's version
+    found = task_manager.get_preview(task_id)
+    if found is None:
+        raise HTTPException(status_code=404, detail="No preview for this task")
+    preview, version = found
+    etag = f'"{task_id}-{version}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=preview.data, media_type=preview.mime, headers=headers)
+
+@app.get("/events/{task_id}")
+async def task_events(task_id: str, inline_previews: bool = False):
+    # Server-sent events: one 'data:' line per (coalesced) status change, closed once the task is done.
+    # With inline_previews=true, events announcing a new preview carry it as a data URL ('preview'),
+    # saving the extra GET /preview round trip
+    subscriber = TaskSubscriber()
+    if not await from_state(task_manager.subscribe, task_id, subscriber):
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    async def event_stream():
+        last_preview_url = None
+        try:
+            while True:
+                try:
+                    updates = await asyncio.wait_for(subscriber.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                status = updates[task_id]
+                if inline_previews and status.get('preview_url', last_preview_url) != last_preview_url:
+                    last_preview_url = status['preview_url']
+                    found = await asyncio.to_thread(task_manager.get_preview, task_id)
+                    if found is not None:
+                        status = {**status, 'preview': found[0].to_data_url()}
+                yield f"data: {json.dumps(status)}\n\n"
+                if status['done']:
+                    return
+        finally:
+            task_manager.unsubscribe(task_id, subscriber)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.websocket("/ws/tasks")
+async def task_events_ws(websocket: WebSocket):
+    """
+    Multiplexed task events over one socket.
+    Client sends {"subscribe": [task_id, ...]} / {"unsubscribe": [...]}; server sends
+    {"task_id": ..., <status fields>} on every change and drops the subscription once done.
+    Binary frames close the socket with 1003, malformed messages with 1008.
+    """
+    await websocket.accept()
+    subscriber = TaskSubscriber()
+    task_ids = set()
+
+    async def receive_commands():
+        while True:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                raise WebSocketDisconnect(message.get('code', 1000))
+            if message.get('text') is None:
+                await websocket.close(code=1003, reason="Expected JSON text messages")
+                return
+            try:
+                subscribe, unsubscribe = parse_ws_command(message['text'])
+            except ValueError as e:
+                await websocket.close(code=1008, reason=f"Invalid message: {str(e)}")
+                return
+            for task_id in subscribe:
+                task_ids.add(task_id)
+                if not await from_state(task_manager.subscribe, task_id, subscriber):
+                    subscriber.push(task_id, {'status': 'Unknown', 'done': True})
+            for task_id in unsubscribe:
+                task_ids.discard(task_id)
+                task_manager.unsubscribe(task_id, subscriber)
+
+    async def send_events():
+        while True:
+            for task_id, status in (await subscriber.get()).items():
+                if task_id not in task_ids:
+                    continue
+                await websocket.send_json({'task_id': task_id, **status})
+                if status['done']:
+                    task_ids.discard(task_id)
+                    task_manager.unsubscribe(task_id, subscriber)
+
+    receiver = asyncio.create_task(receive_commands())
+    sender = asyncio.create_task(send_events())
+    try:
+        done, _ = await asyncio.wait({receiver, sender}, return_when=asyncio.FIRST_COMPLETED)
+        for finished in done:
+            error = finished.exception()
+            if error is not None and not isinstance(error, WebSocketDisconnect):
+                raise error
+    finally:
+        receiver.cancel()
+        sender.cancel()
+        for task_id in task_ids:
+            task_manager.unsubscribe(task_id, subscriber)
+
+@app.get("/healthz")
+def healthz():
+    # Liveness: the process is up and serving requests
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def readyz(response: Response):
+    # Readiness: every model is loaded, so no request will wait for a model load
+    ready = MODEL_REGISTRY.ready()
+    response.status_code = 200 if ready else 503
+    return {"ready": ready, "models": MODEL_REGISTRY.status()}
+
+@app.get("/stats")
+def get_stats():
+    model_ht = MODEL_REGISTRY.get_loaded('model_ht')  # Don't load a model just to report on it
+    return {
+        "tasks": task_manager.stats(),
+        "source_images": model_ht.source_images.stats() if model_ht is not None else {},
+        "source_dedup": model_ht.dedup.stats() if model_ht is not None else {},
+        "result_cache": result_cache.stats(),
+        "encoding": encoder.stats(),
+        "cpu_pool": cpu_pool.stats(),
+        "speculation": speculator.stats(),
+        "batching": {pool: backend.stats() for pool, backend in list(task_manager.backends.items())
+                     if backend.kind == 'batch'},
+        "admission": {pool or 'default': queue.stats() for pool, queue in list(task_manager.admission_queues.items())},
+    }
+
+def collect_stats():
+    # Numeric /stats values as gauges: hairsfe_<section>_<name>, batching labelled by pool
+    stats = get_stats()
+    sections = [(section, {}, stats[section]) for section in ("tasks", "source_images", "source_dedup", "result_cache",
+                                                                 "encoding", "cpu_pool", "speculation")]
+    sections.append(("result_cache_store", {}, stats["result_cache"]["store"]))
+    sections += [("batching", {"pool": pool}, values) for pool, values in stats["batching"].items()]
+    sections += [("admission", {"pool": pool}, values) for pool, values in stats["admission"].items()]
+    families = {}
+    for section, labels, values in sections:
+        for name, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                families.setdefault(f"hairsfe_{section}_{name}", []).append((labels, value))
+    return [(name, 'gauge', f"{name[len('hairsfe_'):]} from /stats.", samples) for name, samples in families.items()]
+
+REGISTRY.register_collector(collect_stats)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/traces")
+def get_traces(limit: int = 200):
+    # Most recent phase spans; only recorded when started with HAIRSFE_TRACING=1
+    spans = list(RECENT_SPANS)[-limit:]
+    return {"enabled": TRACING, "spans": spans}
 
 @app.post("/cancel/{task_id}")
 def cancel_task(task_id: str):
+    if result_cache.detach(task_id):
+        return {"status": "Detached; task still serves other requests"}
     return task_manager.cancel(task_id)
 
 if __name__ == "__main__":
@@ -0,0 +1,224 @@
+# server_encoding.py
+# Output encoding in one place: models store one high-quality master per result, and clients get
+# variants of it (format from their Accept header, optional size and byte budget / SSIM target),
+# each encoded once and then served from a bounded cache.
+import io
+import threading
+
+import numpy as np
+from PIL import Image, features
+
+from server_images import ImageResult
+from server_metrics import InstrumentedLock, span
+from server_store import BoundedStore
+
+PIL_FORMATS = {'image/avif': 'AVIF', 'image/webp': 'WEBP', 'image/jpeg': 'JPEG', 'image/png': 'PNG'}
+PREFERENCE = ('image/avif', 'image/webp', 'image/jpeg')  # Smallest output first
+MASTER_QUALITY = 90  # Models' stored results: variants re-encoded from it lose nothing visible
+QUALITY_STEPS = tuple(range(30, 96, 5))  # Qualities searched; finer steps aren't visible, only slower
+DEFAULT_MIN_SSIM = 0.985  # Variants without a byte budget: the smallest one at least this close to the master
+SSIM_SIZE = 256  # Longest side SSIM is measured at
+# Sizes and byte budgets variants are made for: requests are rounded to these before they become cache
+# keys, so arbitrary ?size= / ?max_bytes= values can't each cost a new quality search
+SIZE_STEPS = (64, 128, 256, 384, 512, 768, 1024, 1536, 2048)  # Requested sizes round up; larger ones get the master's
+BYTE_STEPS = tuple(1024 * 2 ** n for n in range(15))  # 1 KiB .. 16 MiB; budgets round down (still fit)
+MAX_SETTINGS = 1024  # (format, size, target) combinations whose last quality is remembered
+# Fixed per-format encoder settings; speed/method trade a little size for a lot of encode time
+SAVE_OPTIONS = {
+    'JPEG': {'optimize': True, 'progressive': True},
+    'WEBP': {'method': 4},
+    'AVIF': {'speed': 8},
+    'PNG': {'optimize': False, 'compress_level': 6},
+}
+
+
+def available_formats():
+    return tuple(mime for mime in PIL_FORMATS
+                 if mime not in ('image/avif', 'image/webp') or features.check(PIL_FORMATS[mime][:4].lower()))
+
+
+AVAILABLE = available_formats()
+
+
+def negotiate(accept, fallback='image/jpeg'):
+    """
+    Pick the output format for an Accept header: the smallest of PREFERENCE the client names
+    explicitly (wildcards don't count, many clients that send */* can't decode AVIF).
+    :return: MIME type, or fallback if none is named.
+    """
+    accepted = {}
+    for part in (accept or '').split(','):
+        media, _, params = part.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[media.strip().lower()] = q
+    for mime in PREFERENCE:
+        if mime in AVAILABLE and accepted.get(mime, 0) > 0:
+            return mime
+    return fallback
+
+
+def encode(image, mime='image/jpeg', quality=MASTER_QUALITY):
+    """
+    Encode a PIL image with the shared per-format settings.
+    :return: ImageResult.
+    """
+    pil_format = PIL_FORMATS[mime]
+    if pil_format in ('JPEG', 'AVIF') and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    options = dict(SAVE_OPTIONS[pil_format])
+    if pil_format != 'PNG':
+        options['quality'] = quality
+    buffer = io.BytesIO()
+    image.save(buffer, format=pil_format, **options)
+    return ImageResult(buffer.getvalue(), mime)
+
+
+def quantize(size=None, max_bytes=None):
+    """
+    Round a requested size up to SIZE_STEPS (None past the largest: the master's size) and a byte budget
+    down to BYTE_STEPS (at least the smallest).
+    :return: (size, max_bytes).
+    """
+    if size is not None:
+        size = next((step for step in SIZE_STEPS if step >= size), None)
+    if max_bytes is not None:
+        max_bytes = max([step for step in BYTE_STEPS if step <= max_bytes] or BYTE_STEPS[:1])
+    return size, max_bytes
+
+
+def __gray__(image):
+    # Luminance at SSIM_SIZE, cropped to whole 8x8 blocks
+    gray = image.convert('L')
+    gray.thumbnail((SSIM_SIZE, SSIM_SIZE))
+    array = np.asarray(gray, dtype=np.float32)
+    return array[:array.shape[0] // 8 * 8, :array.shape[1] // 8 * 8]
+
+
+def ssim(reference, candidate):
+    """
+    Mean SSIM over 8x8 blocks of two same-sized grayscale float arrays, vectorized over all blocks.
+    """
+    def blocks(array):
+        return array.reshape(array.shape[0] // 8, 8, array.shape[1] // 8, 8).swapaxes(1, 2).reshape(-1, 64)
+
+    x, y = blocks(reference), blocks(candidate)
+    mean_x, mean_y = x.mean(axis=1), y.mean(axis=1)
+    var_x, var_y = x.var(axis=1), y.var(axis=1)
+    covariance = ((x - mean_x[:, None]) * (y - mean_y[:, None])).mean(axis=1)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    return float(np.mean(((2 * mean_x * mean_y + c1) * (2 * covariance + c2)) /
+                         ((mean_x ** 2 + mean_y ** 2 + c1) * (var_x + var_y + c2))))
+
+
+class Encoder:
+    """
+    Variants of stored results, keyed by (result digest, format, size, target), with size and byte
+    budget rounded to SIZE_STEPS / BYTE_STEPS (see quantize): each one is encoded
+    once (concurrent requests wait for the first) and served from a bounded LRU afterwards.
+    Quality is searched per variant: the largest that fits max_bytes, or the smallest that keeps
+    min_ssim against the master. The quality last chosen per (format, size, target) is where the next
+    search starts, so steady traffic usually settles in one or two encodes per variant.
+    """
+    def __init__(self, max_bytes=128 * 1024 * 1024, ttl=3600, min_ssim=DEFAULT_MIN_SSIM):
+        self.min_ssim = min_ssim
+        self.variants = BoundedStore(max_bytes, ttl=ttl, sizeof=len)
+        # (mime, size, target): index into QUALITY_STEPS chosen last time
+        self.settings = BoundedStore(0, max_entries=MAX_SETTINGS)
+        self.locks = {}  # variant key: lock held while it is encoded
+        self.lock = threading.Lock()
+        self.counters = {'variants': 0, 'encodes': 0, 'passthrough': 0}
+
+    def variant(self, result, mime=None, size=None, max_bytes=None, min_ssim=None):
+        """
+        :param result: Stored ImageResult (the master).
+        :param mime: Output format (see negotiate); None keeps the master's.
+        :param size: Longest side in pixels, rounded up to SIZE_STEPS; None keeps the master's (never upscales).
+        :param max_bytes: Byte budget, rounded down to BYTE_STEPS; takes precedence over min_ssim.
+        :param min_ssim: SSIM target against the master; defaults to the encoder's.
+        :return: ImageResult; the master itself when nothing would change.
+        """
+        mime = mime or result.mime
+        size, max_bytes = quantize(size, max_bytes)
+        if mime not in PIL_FORMATS or (mime == result.mime and size is None and max_bytes is None):
+            with self.lock:
+                self.counters['passthrough'] += 1
+            return result
+        target = ('bytes', max_bytes) if max_bytes is not None else ('ssim', min_ssim or self.min_ssim)
+        key = (result.digest(), mime, size, target)
+        found = self.variants.get(key)
+        if found is not None:
+            return found
+        with self.lock:
+            key_lock = self.locks.setdefault(key, InstrumentedLock('encode_variant'))
+        try:
+            with key_lock:
+                found = self.variants.get(key)
+                if found is None:
+                    with span('encode', model=mime):
+                        found = self.__encode_variant__(result, mime, size, target)
+                    self.variants[key] = found
+                    with self.lock:
+                        self.counters['variants'] += 1
+                return found
+        finally:
+            with self.lock:
+                self.locks.pop(key, None)
+
+    def __encode_variant__(self, result, mime, size, target):
+        image = Image.open(io.BytesIO(result.data))
+        if size is not None:
+            image.draft('RGB', (size, size))  # JPEG masters: decode at a reduced scale
+            image = image.convert('RGB') if image.mode not in ('RGB', 'RGBA', 'L') else image
+            image.thumbnail((size, size))
+        else:
+            image.load()
+        if PIL_FORMATS[mime] == 'PNG':
+            return self.__count__(encode(image, mime))  # Lossless: nothing to search
+        reference = __gray__(image) if target[0] == 'ssim' else None
+
+        def probe(quality):
+            candidate = self.__count__(encode(image, mime, quality))
+            if target[0] == 'bytes':
+                return candidate, len(candidate) <= target[1]
+            return candidate, ssim(reference, __gray__(Image.open(io.BytesIO(candidate.data)))) >= target[1]
+
+        # Budget: the largest quality that fits; SSIM: the smallest that still matches. Start from last
+        # time's choice and its neighbour (usually settles it), then bisect what is left
+        raises = target[0] == 'bytes'  # Whether a passing quality may still go up
+        low, high = 0, len(QUALITY_STEPS) - 1
+        index = self.settings.get((mime, size, target))
+        if index is None:
+            index = (low + high) // 2
+        best, chosen, probes = None, None, 0
+        while low <= high:
+            candidate, fits = probe(QUALITY_STEPS[index])
+            if fits:
+                best, chosen = candidate, index
+            if fits == raises:
+                low = index + 1
+            else:
+                high = index - 1
+            probes += 1
+            index = (index + 1 if low > index else index - 1) if probes == 1 else (low + high) // 2
+        if best is None:  # Even the extreme misses the target: the closest we can do
+            chosen = len(QUALITY_STEPS) - 1 if target[0] == 'ssim' else 0
+            best = self.__count__(encode(image, mime, QUALITY_STEPS[chosen]))
+        self.settings.set((mime, size, target), chosen)
+        return best
+
+    def __count__(self, encoded):
+        with self.lock:
+            self.counters['encodes'] += 1
+        return encoded
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+        return {**counters, **{f"store_{name}": value for name, value in self.variants.stats().items()}}
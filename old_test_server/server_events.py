@@ -0,0 +1,38 @@
+# server_events.py
+import asyncio
+import threading
+
+
+class TaskSubscriber:
+    """
+    Receives task status snapshots published by TaskManager (usually from worker threads)
+    and hands them to a single asyncio consumer (an SSE stream or a WebSocket).
+    Snapshots are coalesced per task: if several progress updates arrive before the
+    consumer wakes up, only the latest one is delivered.
+    """
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self.pending = {}  # task_id: latest status snapshot not yet delivered
+        self.lock = threading.Lock()
+        self.event = asyncio.Event()
+
+    def push(self, task_id, status):
+        with self.lock:
+            self.pending[task_id] = status
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            pass  # Event loop already closed, consumer is gone
+
+    async def get(self):
+        """
+        Wait for at least one update.
+        :return: dict of task_id: latest status snapshot.
+        """
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            if pending:
+                return pending
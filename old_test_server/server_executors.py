@@ -0,0 +1,347 @@
+# server_executors.py
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+
+from server_admission import QueueFullError
+from server_images import ImageResult
+
+SHARED_RESULT_MIN_BYTES = 64 * 1024  # Smaller results are cheaper to just pickle back
+CANCEL_POLL_SECONDS = 0.1  # How often blocking waits look at the cancel token
+
+
+class TaskRevokedError(Exception):
+    pass
+
+
+class CancelToken:
+    """
+    What jobs receive as cancel_check_callback. Calling it raises TaskRevokedError once the task
+    was canceled; wait(seconds) replaces time.sleep in models, so a waiting job notices a cancel
+    at once instead of after its sleep. Wraps a threading.Event or a manager Event proxy, so it
+    behaves the same in threads and in worker processes.
+    """
+    __slots__ = ('event',)
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self):
+        if self.event.is_set():
+            raise TaskRevokedError("Task canceled")
+
+    def is_canceled(self):
+        return self.event.is_set()
+
+    def wait(self, seconds):
+        """Sleep up to seconds; raises TaskRevokedError as soon as the task is canceled."""
+        if self.event.wait(seconds):
+            raise TaskRevokedError("Task canceled")
+
+
+def cancellable_sleep(seconds, cancel_check_callback=None):
+    # time.sleep for models: wakes up early on cancellation when given a CancelToken
+    if isinstance(cancel_check_callback, CancelToken):
+        cancel_check_callback.wait(seconds)
+        return
+    if cancel_check_callback is not None:
+        cancel_check_callback()
+    time.sleep(seconds)
+
+
+def cancellable_batch_sleep(seconds, cancel_check_callbacks):
+    """
+    cancellable_sleep for one step of a batch: checks every member's cancel callback each
+    CANCEL_POLL_SECONDS and returns early once all of them are canceled.
+    :return: {index into cancel_check_callbacks: TaskRevokedError} of the members canceled meanwhile.
+    """
+    deadline = time.monotonic() + seconds
+    canceled = {}
+    while True:
+        for i, cancel_check_callback in enumerate(cancel_check_callbacks):
+            if i not in canceled:
+                try:
+                    cancel_check_callback()
+                except TaskRevokedError as e:
+                    canceled[i] = e
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or len(canceled) == len(cancel_check_callbacks):
+            return canceled
+        time.sleep(min(remaining, CANCEL_POLL_SECONDS))
+
+
+class ThreadBackend:
+    """
+    Runs jobs on a thread pool. Right for I/O-bound models (e.g. remote API calls),
+    where the GIL is released while waiting.
+    """
+    kind = 'thread'
+
+    def __init__(self, max_workers, name='tasks'):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    def make_cancel_event(self):
+        return threading.Event()
+
+    def submit(self, fn, args, kwargs, progress_callback, cancel_event):
+        return self.executor.submit(fn, *args, **kwargs, progress_callback=progress_callback,
+                                    cancel_check_callback=CancelToken(cancel_event))
+
+    def result(self, future):
+        return future.result()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SharedResult:
+    """Handle to a str/bytes/ImageResult payload left in shared memory by a worker process."""
+    def __init__(self, name, size, is_text, mime=None):
+        self.name = name
+        self.size = size
+        self.is_text = is_text
+        self.mime = mime  # Set for ImageResult
+
+
+def __to_shared__(result):
+    mime = result.mime if isinstance(result, ImageResult) else None
+    if mime is not None:
+        data = result.data
+    elif isinstance(result, (str, bytes)):
+        data = result.encode('utf-8') if isinstance(result, str) else result
+    else:
+        return result
+    if len(data) < SHARED_RESULT_MIN_BYTES:
+        return result
+    block = shared_memory.SharedMemory(create=True, size=len(data))
+    block.buf[:len(data)] = data
+    shared = SharedResult(block.name, len(data), isinstance(result, str), mime)
+    block.close()
+    # Ownership moves to the parent, which unlinks it after copying the result out; without this the
+    # resource tracker would count the block twice (once per process) and warn about a leak
+    resource_tracker.unregister(block._name, 'shared_memory')
+    return shared
+
+
+def __from_shared__(result):
+    if not isinstance(result, SharedResult):
+        return result
+    block = shared_memory.SharedMemory(name=result.name)
+    try:
+        data = bytes(block.buf[:result.size])
+    finally:
+        block.close()
+        block.unlink()
+    if result.mime is not None:
+        return ImageResult(data, result.mime)
+    return data.decode('utf-8') if result.is_text else data
+
+
+def __run_in_worker__(fn, args, kwargs, job_id, progress_queue, cancel_event):
+    # Executed inside the worker process; callbacks talk to the parent through manager proxies
+    def progress_callback(progress, preview=None):
+        progress_queue.put((job_id, progress, preview))
+
+    result = fn(*args, **kwargs, progress_callback=progress_callback, cancel_check_callback=CancelToken(cancel_event))
+    return __to_shared__(result)
+
+
+class ProcessBackend:
+    """
+    Runs jobs in dedicated worker processes, for CPU-bound models that would otherwise
+    serialize on the GIL. initializer(*initargs) runs once in every worker, so models are
+    loaded once per process rather than per job. Progress and cancellation cross the process
+    boundary through a multiprocessing manager; large str/bytes results come back through
+    shared memory instead of being pickled over the pipe.
+    fn must be a picklable (module-level) function.
+    """
+    kind = 'process'
+
+    def __init__(self, max_workers, initializer=None, initargs=()):
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self.executor = None
+        self.manager = None
+        self.progress_queue = None
+        self.progress_callbacks = {}  # job_id: progress callback in this process
+        self.lock = threading.Lock()
+
+    def __start__(self):
+        # Started on first use so that importing the server doesn't fork anything
+        with self.lock:
+            if self.executor is not None:
+                return
+            self.manager = multiprocessing.Manager()
+            self.progress_queue = self.manager.Queue()
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers,
+                                                                   initializer=self.initializer,
+                                                                   initargs=self.initargs)
+            threading.Thread(target=self.__dispatch_progress__, name='process-progress', daemon=True).start()
+
+    def __dispatch_progress__(self):
+        while True:
+            try:
+                message = self.progress_queue.get()
+            except (EOFError, OSError):
+                return  # Manager shut down
+            if message is None:
+                return
+            job_id, progress, preview = message
+            callback = self.progress_callbacks.get(job_id)
+            if callback is not None:
+                callback(progress, preview)
+
+    def make_cancel_event(self):
+        self.__start__()
+        return self.manager.Event()
+
+    def submit(self, fn, args, kwargs, progress_callback, cancel_event):
+        self.__start__()
+        job_id = uuid.uuid4().hex
+        self.progress_callbacks[job_id] = progress_callback
+        future = self.executor.submit(__run_in_worker__, fn, args, kwargs, job_id, self.progress_queue, cancel_event)
+        future.add_done_callback(lambda _: self.progress_callbacks.pop(job_id, None))
+        return future
+
+    def result(self, future):
+        return __from_shared__(future.result())
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.progress_queue.put(None)
+            self.manager.shutdown()
+
+
+class EventLoopThread:
+    """
+    An asyncio event loop running forever in a daemon thread, shared by everything that
+    needs to run coroutines from synchronous code (async models, the remote HTTP client).
+    """
+    def __init__(self, name='async-tasks'):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self.thread.start()
+
+    def run(self, coro):
+        """
+        Schedule a coroutine on the loop.
+        :return: concurrent.futures.Future; cancelling it cancels the coroutine.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+def shared_event_loop():
+    global _shared_loop
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = EventLoopThread()
+        return _shared_loop
+
+
+class CpuPool:
+    """
+    Bounded thread pool for the CPU work of API handlers (upload decode, JSON parsing, result
+    encodes), so it never runs on the event loop and doesn't take Starlette's thread pool from
+    I/O-bound handlers. Threads are enough: PIL, numpy and hashlib release the GIL for the heavy
+    parts. At most max_workers + max_queue calls are admitted; beyond that run() raises
+    QueueFullError (HTTP 429) instead of queueing without bound.
+    """
+    def __init__(self, max_workers=None, max_queue=64, name='cpu'):
+        self.name = name
+        self.max_workers = max_workers or os.cpu_count() or 4
+        self.max_queue = max_queue
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self.slots = threading.BoundedSemaphore(self.max_workers + max_queue)
+        self.lock = threading.Lock()
+        self.counters = {'submitted': 0, 'rejected': 0, 'in_flight': 0}
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) on the pool and await its result.
+        :raises QueueFullError: The pool and its queue are full.
+        """
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.counters['rejected'] += 1
+            raise QueueFullError(self.name, 1)
+        with self.lock:
+            self.counters['submitted'] += 1
+            self.counters['in_flight'] += 1
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.__release__()
+            raise
+        future.add_done_callback(self.__release__)  # Not on await: a disconnected client doesn't stop the work
+        return await asyncio.wrap_future(future)
+
+    def __release__(self, future=None):
+        with self.lock:
+            self.counters['in_flight'] -= 1
+        self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, 'max_workers': self.max_workers, 'max_queue': self.max_queue}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncBackend:
+    """
+    Runs coroutine functions on the shared event loop. Jobs that mostly wait on the network
+    (submit, poll, download) don't occupy a worker thread, so many of them can be in flight
+    at once; any concurrency cap belongs to the upstream client.
+    """
+    kind = 'async'
+
+    def __init__(self):
+        self.event_loop = shared_event_loop()
+
+    def make_cancel_event(self):
+        return threading.Event()
+
+    def submit(self, fn, args, kwargs, progress_callback, cancel_event):
+        # Cancelling the returned future cancels the coroutine, aborting any in-flight request;
+        # the token covers code that checks between steps
+        return self.event_loop.run(fn(*args, **kwargs, progress_callback=progress_callback,
+                                      cancel_check_callback=CancelToken(cancel_event)))
+
+    def result(self, future):
+        return future.result()
+
+    def shutdown(self):
+        pass  # The loop is shared and dies with the process
+
+
+def make_backend(config, name, initializer=None, initargs=(), run_batch=None):
+    """
+    Build a backend from a config dict such as {'kind': 'process', 'max_workers': 2}.
+    :param run_batch: Callable(jobs) -> results, required for kind 'batch'.
+    """
+    kind = config.get('kind', 'thread')
+    if kind == 'thread':
+        return ThreadBackend(config.get('max_workers', 4), name=name)
+    elif kind == 'process':
+        return ProcessBackend(config.get('max_workers', 2), initializer=initializer, initargs=initargs)
+    elif kind == 'async':
+        return AsyncBackend()
+    elif kind == 'batch':
+        from server_batching import BatchScheduler  # Imported here: server_batching imports this module
+        group_by = config.get('group_by')
+        return BatchScheduler(run_batch, max_batch_size=config.get('max_batch_size', 8),
+                              max_wait=config.get('max_wait', 0.05), max_workers=config.get('max_workers', 1),
+                              group_key=(lambda job: job.args[-1].get(group_by)) if group_by else None, name=name)
+    else:
+        raise ValueError(f"Unknown executor kind: {kind}")
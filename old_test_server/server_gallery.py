@@ -0,0 +1,268 @@
+# server_gallery.py
+import argparse
+import hashlib
+import io
+import json
+import mmap
+import os
+import re
+import tempfile
+
+from PIL import Image
+
+from server_images import ImageResult
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+THUMBNAIL_SIZES = (128, 256)  # Longest side, in pixels
+BUNDLE_VERSION = 3
+
+
+def style_id_for(filename, taken=()):
+    """
+    Stable, URL-safe ID from a file name ("Curly Bob 2.png" -> "curly-bob-2"), so an entry keeps
+    its ID whatever order the directory is listed in. Clashes get a -2, -3, ... suffix.
+    """
+    base = re.sub(r'[^a-z0-9]+', '-', os.path.splitext(filename)[0].lower()).strip('-') or 'image'
+    style_id, n = base, 1
+    while style_id in taken:
+        n += 1
+        style_id = f"{base}-{n}"
+    return style_id
+
+
+class GalleryStore:
+    """
+    Content-addressed store for catalogue images (hair styles, processed results).
+    Every image has a stable ID (from its file name) and is kept as raw bytes keyed by the
+    sha256 of its content, so it can be served as-is with a stable ETag instead of being
+    inlined as base64.
+    With a bundle path the catalogue is a packed bundle: <bundle>.<digest>.bin holds every image
+    and thumbnail back to back, <bundle>.json the index (data file name, ID, hash, MIME type,
+    dimensions and offsets, and the directory listing it was built from). Bundles are mmapped
+    and served as zero-copy slices, so all worker processes share one page-cache copy. Build
+    them ahead of time with
+        python server_gallery.py <directory> <bundle>
+    or let the first start build it from the directory.
+    """
+    def __init__(self, directory, thumbnail_sizes=THUMBNAIL_SIZES, bundle=None):
+        self.directory = directory
+        self.thumbnail_sizes = tuple(thumbnail_sizes)
+        self.bundle = bundle  # Path prefix of <bundle>.bin / <bundle>.json, or None
+        self.entries = {}  # content hash: {'id', 'data', 'mime', 'filename', 'width', 'height', 'thumbnails'}
+        self.order = []  # content hashes in listing order (sorted by file name; what 'index' refers to)
+        self.by_id = {}  # stable ID: content hash, in listing order (one ID per file, even for identical files)
+        self.listing = None  # [file name, size, mtime_ns] of the images read from directory
+        self.mmap = None
+        if not (bundle and self.__load_bundle__()):
+            self.__load__()
+            if bundle and self.order:
+                self.save_bundle(bundle)
+
+    def __listing__(self):
+        # What the catalogue is built from: any file added, removed, replaced or edited changes it.
+        # Sorted: positions don't depend on the file system
+        listing = []
+        for filename in sorted(os.listdir(self.directory)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                stat = os.stat(os.path.join(self.directory, filename))
+                listing.append([filename, stat.st_size, stat.st_mtime_ns])
+        return listing
+
+    def __load__(self):
+        if not os.path.exists(self.directory):
+            return
+        self.listing = self.__listing__()  # Taken before reading: a file edited meanwhile makes the bundle stale
+        for filename, _, _ in self.listing:
+            with open(os.path.join(self.directory, filename), "rb") as img_file:
+                data = img_file.read()
+            content_hash = hashlib.sha256(data).hexdigest()
+            style_id = style_id_for(filename, self.by_id)
+            if content_hash not in self.entries:
+                self.entries[content_hash] = self.__make_entry__(style_id, filename, data)
+            self.by_id[style_id] = content_hash  # Duplicate files share the entry but keep their own ID
+            self.order.append(content_hash)
+
+    def __bundle_is_fresh__(self, index):
+        if index.get('version') != BUNDLE_VERSION or tuple(index['thumbnail_sizes']) != self.thumbnail_sizes:
+            return False
+        # Same files with the same sizes and mtimes; a missing directory means "bundle only"
+        return not os.path.isdir(self.directory) or index['listing'] == self.__listing__()
+
+    def __load_bundle__(self):
+        index_path = f"{self.bundle}.json"
+        if not os.path.exists(index_path):
+            return False
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if not self.__bundle_is_fresh__(index):
+            return False
+        try:
+            f = open(os.path.join(os.path.dirname(os.path.abspath(self.bundle)), index['data_file']), "rb")
+        except FileNotFoundError:  # Replaced (and cleaned up) by a newer build since we read the index
+            return False
+        with f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        self.listing = index['listing']
+        view = memoryview(self.mmap)
+        for record in index['entries']:
+            offset, length = record['offset'], record['length']
+            self.entries[record['hash']] = {
+                'id': record['id'],
+                'data': view[offset:offset + length],  # Zero-copy slice of the mapping
+                'mime': record['mime'],
+                'filename': record['filename'],
+                'width': record['width'],
+                'height': record['height'],
+                'thumbnails': {int(size): view[thumb['offset']:thumb['offset'] + thumb['length']]
+                               for size, thumb in record['thumbnails'].items()},
+            }
+        self.by_id = index['ids']
+        self.order = index['order']
+        return True
+
+    def save_bundle(self, bundle):
+        """
+        Write the catalogue as <bundle>.<digest>.bin + <bundle>.json. The data file is named by its
+        content and the index names it, so replacing the index is the one atomic step: readers get
+        the old bundle or the new one, never a mix. Temporary files are unique, so several processes
+        may build the same bundle at once.
+        """
+        records = []
+        offset = 0
+        directory = os.path.dirname(os.path.abspath(bundle))
+        prefix = os.path.basename(bundle)
+        os.makedirs(directory, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, bin_tmp = tempfile.mkstemp(dir=directory, prefix=f"{prefix}.", suffix=".bin.tmp")
+        with os.fdopen(fd, "wb") as f:
+            def append(data):
+                nonlocal offset
+                f.write(data)
+                digest.update(data)
+                offset += len(data)
+                return {'offset': offset - len(data), 'length': len(data)}
+
+            for content_hash, entry in self.entries.items():
+                records.append({'id': entry['id'], 'hash': content_hash, 'mime': entry['mime'],
+                                'filename': entry['filename'], 'width': entry['width'], 'height': entry['height'],
+                                **append(entry['data']),
+                                'thumbnails': {size: append(thumbnail)
+                                               for size, thumbnail in entry['thumbnails'].items()}})
+        data_file = f"{prefix}.{digest.hexdigest()[:16]}.bin"
+        os.replace(bin_tmp, os.path.join(directory, data_file))  # Same content, same name: harmless if it exists
+        index = {'version': BUNDLE_VERSION, 'thumbnail_sizes': list(self.thumbnail_sizes), 'data_file': data_file,
+                 'listing': self.listing, 'order': self.order, 'ids': self.by_id, 'entries': records}
+        fd, index_tmp = tempfile.mkstemp(dir=directory, prefix=f"{prefix}.", suffix=".json.tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(index_tmp, f"{bundle}.json")
+        # Older data files: already-mapped ones stay readable (POSIX), new readers only see the new index.
+        # Keep whatever the index names now, in case another builder replaced it in the meantime
+        try:
+            with open(f"{bundle}.json", "r", encoding="utf-8") as f:
+                keep = {data_file, json.load(f).get('data_file')}
+        except (OSError, ValueError):
+            keep = {data_file}
+        for name in os.listdir(directory):
+            if name.startswith(f"{prefix}.") and name.endswith(".bin") and name not in keep:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass  # Still mapped (Windows) or removed by another builder
+
+    def __make_entry__(self, style_id, filename, data):
+        with Image.open(io.BytesIO(data)) as img:
+            mime = Image.MIME.get(img.format, 'application/octet-stream')
+            thumbnails = {size: self.__make_thumbnail__(img, size) for size in self.thumbnail_sizes}
+            width, height = img.size
+        return {'id': style_id, 'data': data, 'mime': mime, 'filename': filename, 'width': width, 'height': height,
+                'thumbnails': thumbnails}
+
+    @staticmethod
+    def __make_thumbnail__(img, size):
+        thumb = img.convert('RGB')
+        thumb.thumbnail((size, size))
+        buffer = io.BytesIO()
+        thumb.save(buffer, format="JPEG", quality=85)
+        return buffer.getvalue()
+
+    def __len__(self):
+        return len(self.order)
+
+    def ids(self):
+        return list(self.order)
+
+    def style_ids(self):
+        # Stable IDs, in listing order: byte-identical files share an entry but each keeps its own ID
+        return list(self.by_id)
+
+    def id_at(self, index):
+        return self.order[index]
+
+    def resolve(self, key):
+        """
+        :param key: Stable ID, content hash, or listing position.
+        :return: Content hash, or None if unknown.
+        """
+        if isinstance(key, int):
+            return self.order[key] if -len(self.order) <= key < len(self.order) else None
+        if key in self.entries:
+            return key
+        return self.by_id.get(key)
+
+    def describe(self, key):
+        """
+        :param key: Stable ID or content hash (which describes the first file with that content).
+        :raises KeyError: Unknown key.
+        """
+        content_hash = self.resolve(key)
+        if content_hash is None or isinstance(key, int):
+            raise KeyError(key)
+        entry = self.entries[content_hash]
+        return {'id': key if key in self.by_id else entry['id'], 'hash': content_hash, 'mime': entry['mime'],
+                'width': entry['width'], 'height': entry['height']}
+
+    def get(self, key, size=None):
+        """
+        Return (bytes, mime) for an image, or one of its pre-generated thumbnails.
+        :param key: Stable ID or sha256 of the original file.
+        :param size: Thumbnail size; None for the original.
+        :return: (bytes, mime) or None if the key / size is unknown. Bundled images are memoryviews.
+        """
+        entry = self.entries.get(self.resolve(key))
+        if entry is None:
+            return None
+        if size is None:
+            return entry['data'], entry['mime']
+        thumbnail = entry['thumbnails'].get(size)
+        if thumbnail is None:
+            return None
+        return thumbnail, 'image/jpeg'
+
+    def image_result(self, key):
+        """
+        :param key: Stable ID, content hash, or listing position.
+        :raises KeyError: Unknown key.
+        """
+        found = self.get(key)
+        if found is None:
+            raise KeyError(f"No image '{key}' in {self.directory}")
+        data, mime = found
+        return ImageResult(data, mime)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a packed, mmap-able catalogue bundle from an image directory.")
+    parser.add_argument("directory", help="Directory with the catalogue images")
+    parser.add_argument("bundle", help="Output path prefix; writes <bundle>.<digest>.bin and <bundle>.json")
+    parser.add_argument("-t", "--thumbnail", dest="thumbnail_sizes", action="append", type=int,
+                        help=f"Thumbnail size (longest side); repeat for several (default: {THUMBNAIL_SIZES})")
+    args = parser.parse_args()
+
+    store = GalleryStore(args.directory, thumbnail_sizes=args.thumbnail_sizes or THUMBNAIL_SIZES)
+    store.save_bundle(args.bundle)
+    print(f"Wrote {len(store.entries)} images ({len(store)} listed) to {args.bundle}.json")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# server_images.py
+import base64
+import hashlib
+import io
+import re
+
+from PIL import Image
+
+PREVIEW_SIZE = 256  # Longest side of intermediate previews, in pixels
+PREVIEW_QUALITY = 70
+BYTE_RANGE = re.compile(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', re.IGNORECASE)  # One range-spec
+
+
+class ImageResult:
+    """
+    Encoded image bytes plus their MIME type. Models return these instead of base64 data URLs,
+    so results travel as raw bytes (GET /result/{task_id}) and are never re-encoded on the way.
+    """
+    __slots__ = ('data', 'mime', '__digest__')
+
+    def __init__(self, data, mime, digest=None):
+        # Immutable buffers are kept as they are (e.g. memoryviews into a mmapped bundle: served without a copy)
+        self.data = data if isinstance(data, bytes) or (isinstance(data, memoryview) and data.readonly) else bytes(data)
+        self.mime = mime
+        self.__digest__ = digest  # sha256 hex, when already known (e.g. stored with the result)
+
+    def __len__(self):
+        return len(self.data)
+
+    def digest(self):
+        if self.__digest__ is None:
+            self.__digest__ = hashlib.sha256(self.data).hexdigest()
+        return self.__digest__
+
+    def __getstate__(self):
+        return bytes(self.data), self.mime  # memoryviews don't pickle
+
+    def __setstate__(self, state):
+        self.data, self.mime = state
+        self.__digest__ = None
+
+    def to_data_url(self):
+        return f"data:{self.mime};base64,{base64.b64encode(self.data).decode('utf-8')}"
+
+    @classmethod
+    def from_data_url(cls, data_url):
+        header, encoded = data_url.split(",", 1)
+        mime = header[len("data:"):].split(";", 1)[0] or 'application/octet-stream'
+        return cls(base64.b64decode(encoded), mime)
+
+    @classmethod
+    def from_image(cls, image, format="JPEG", **save_kwargs):
+        buffer = io.BytesIO()
+        (image.convert('RGB') if format == "JPEG" and image.mode != 'RGB' else image).save(buffer, format=format, **save_kwargs)
+        return cls(buffer.getvalue(), Image.MIME[format])
+
+
+def make_preview(image, size=PREVIEW_SIZE):
+    """
+    Low-resolution JPEG of an intermediate (or final) model output, cheap enough to send every few
+    hundred milliseconds. Never encodes anything at full size.
+    :param image: PIL image, or an ImageResult / encoded bytes (JPEGs are decoded at reduced scale).
+    :return: ImageResult.
+    """
+    if not isinstance(image, Image.Image):
+        image = Image.open(io.BytesIO(image.data if isinstance(image, ImageResult) else image))
+        image.draft('RGB', (size, size))  # JPEG only: let the decoder skip most of the pixels
+    preview = image.convert('RGB')
+    preview.thumbnail((size, size))
+    return ImageResult.from_image(preview, quality=PREVIEW_QUALITY)
+
+
+def parse_range(range_header, size):
+    """
+    Parse a single-range 'bytes=start-end' header.
+    :return: (start, end) inclusive, None to serve the whole body, or raise ValueError if unsatisfiable.
+    """
+    # Absent, malformed, other units or multi-range: ignored (RFC 9110 14.2), the full body is a valid answer
+    match = BYTE_RANGE.fullmatch(range_header or '')
+    if match is None or not any(match.groups()):
+        return None
+    start_text, end_text = match.groups()
+    if start_text:
+        start = int(start_text)
+        if end_text and int(end_text) < start:
+            return None  # last-pos before first-pos: invalid, not unsatisfiable
+        end = min(int(end_text), size - 1) if end_text else size - 1
+    else:
+        suffix = int(end_text)  # bytes=-N: last N bytes
+        if suffix == 0:
+            raise ValueError("Empty suffix range")
+        start, end = max(size - suffix, 0), size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
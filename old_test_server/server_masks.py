@@ -0,0 +1,168 @@
+# server_masks.py
+# Compact binary masks for mask-guided models. A mask param is a dict:
+#   {'format': 'rle', 'size': [w, h], 'counts': [n0, n1, ...]}
+#       alternating run lengths over the row-major pixels, starting with a run of 0s (may be 0)
+#   {'format': 'bits', 'size': [w, h], 'data': <base64>[, 'bbox': [x0, y0, x1, y1]]}
+#       1 bit per pixel, row-major, MSB first (np.packbits); with a bbox the bits only cover that
+#       box (x1 / y1 exclusive) and everything outside it is 0
+# or an encoded image (PNG upload, data URL): pixels with alpha (or, without alpha, luminance) > 0 are set.
+# size is the coordinate system the mask was drawn in (e.g. the editor canvas); models scale it to the image.
+# It comes from the client, so it is capped at MAX_MASK_PIXELS before anything is allocated.
+import base64
+import io
+
+import numpy as np
+from PIL import Image
+
+from server_images import ImageResult
+
+MAX_MASK_PIXELS = 4096 * 4096  # Largest mask (width x height) accepted; far above any editor canvas
+
+
+def encode_rle(mask):
+    """
+    :param mask: (H, W) bool.
+    :return: {'format': 'rle', ...} mask param.
+    """
+    flat = np.asarray(mask, dtype=bool).reshape(-1)
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate([[0], changes, [flat.size]])
+    counts = np.diff(bounds).tolist()
+    if flat.size and flat[0]:
+        counts.insert(0, 0)  # Runs always start with 0s
+    return {'format': 'rle', 'size': [mask.shape[1], mask.shape[0]], 'counts': counts}
+
+
+def encode_bits(mask, crop=True):
+    """
+    :param mask: (H, W) bool.
+    :param crop: Only pack the bounding box of the set pixels.
+    :return: {'format': 'bits', ...} mask param.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    spec = {'format': 'bits', 'size': [mask.shape[1], mask.shape[0]]}
+    if crop:
+        box = mask_bbox(mask) or (0, 0, 0, 0)
+        spec['bbox'] = list(box)
+        mask = mask[box[1]:box[3], box[0]:box[2]]
+    spec['data'] = base64.b64encode(np.packbits(mask.reshape(-1)).tobytes()).decode('ascii')
+    return spec
+
+
+def decode_mask(spec, max_pixels=MAX_MASK_PIXELS):
+    """
+    :param spec: Mask param (see the top of this module).
+    :param max_pixels: Largest width x height accepted.
+    :return: (H, W) bool array, in the mask's own size.
+    :raises ValueError: Malformed or too large mask.
+    """
+    (width, height), box, crop = decode_mask_region(spec, max_pixels)
+    mask = np.zeros((height, width), dtype=bool)
+    if box is not None:
+        mask[box[1]:box[3], box[0]:box[2]] = crop
+    return mask
+
+
+def decode_mask_region(spec, max_pixels=MAX_MASK_PIXELS):
+    """
+    Decode only the part of a mask that has set pixels: compact masks are never expanded to the full frame.
+    :param spec: Mask param (see the top of this module).
+    :param max_pixels: Largest width x height accepted.
+    :return: ((W, H) of the mask, (x0, y0, x1, y1) bbox of the set pixels or None if empty,
+             (y1 - y0, x1 - x0) bool crop of the mask to that bbox or None).
+    :raises ValueError: Malformed or too large mask.
+    """
+    if isinstance(spec, str) and spec.startswith("data:"):
+        spec = ImageResult.from_data_url(spec)
+    if isinstance(spec, (ImageResult, bytes, bytearray)):
+        with Image.open(io.BytesIO(spec.data if isinstance(spec, ImageResult) else spec)) as img:
+            __check_size__(img.width, img.height, max_pixels)  # Before decoding any pixel
+            if 'A' in img.getbands():
+                mask = np.asarray(img.getchannel('A')) > 0
+            else:
+                mask = np.asarray(img.convert('L')) > 0
+        return __cropped__(mask, (0, 0))
+    if not isinstance(spec, dict) or 'size' not in spec:
+        raise ValueError("Mask must be an image or a {'format': 'rle' | 'bits', 'size': [w, h], ...} dict")
+    try:
+        width, height = (int(n) for n in spec['size'])
+    except (TypeError, ValueError):
+        raise ValueError(f"Mask size must be [w, h], got {spec['size']!r}")
+    __check_size__(width, height, max_pixels)
+    if spec.get('format') == 'rle':
+        return (width, height), *__decode_rle__(spec['counts'], width, height)
+    if spec.get('format') == 'bits':
+        x0, y0, x1, y1 = spec.get('bbox') or (0, 0, width, height)
+        if not (0 <= x0 <= x1 <= width and 0 <= y0 <= y1 <= height):
+            raise ValueError(f"Mask bbox {[x0, y0, x1, y1]} is outside {width}x{height}")
+        bits = np.frombuffer(base64.b64decode(spec['data']), dtype=np.uint8)
+        count = (x1 - x0) * (y1 - y0)
+        if bits.size * 8 < count:
+            raise ValueError(f"Mask has {bits.size * 8} bits, expected {count}")
+        crop = np.unpackbits(bits, count=count).reshape(y1 - y0, x1 - x0).astype(bool)
+        return (width, height), *__cropped__(crop, (x0, y0))[1:]
+    raise ValueError(f"Unknown mask format '{spec.get('format')}'")
+
+
+def __check_size__(width, height, max_pixels):
+    if width <= 0 or height <= 0 or width * height > max_pixels:
+        raise ValueError(f"Mask size {width}x{height} is empty or over {max_pixels} pixels")
+
+
+def __cropped__(mask, offset):
+    # Tight bbox of a (partial) mask whose top-left corner is at offset, in the result's format
+    box = mask_bbox(mask)
+    if box is None:
+        return (mask.shape[1], mask.shape[0]), None, None
+    x0, y0, x1, y1 = box
+    crop = mask[y0:y1, x0:x1]
+    return (mask.shape[1], mask.shape[0]), (x0 + offset[0], y0 + offset[1], x1 + offset[0], y1 + offset[1]), crop
+
+
+def __decode_rle__(counts, width, height):
+    # (bbox, crop) from run lengths: the bbox comes from the set runs' ends, and only its rows are expanded
+    try:
+        counts = np.asarray(counts, dtype=np.int64).reshape(-1)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("RLE counts must be a list of integers")
+    total = width * height
+    if (counts < 0).any() or (counts > total).any() or counts.sum() != total:
+        raise ValueError(f"RLE counts must be non-negative and cover {total} pixels")
+    ends = np.cumsum(counts)
+    set_runs = (np.arange(len(counts)) % 2 == 1) & (counts > 0)  # Odd runs are the set ones
+    if not set_runs.any():
+        return None, None
+    starts, stops = (ends - counts)[set_runs], ends[set_runs] - 1  # First and last pixel of every set run
+    y0, y1 = int(starts.min() // width), int(stops.max() // width) + 1
+    one_row = starts // width == stops // width
+    wraps = not one_row.all()  # A run over a row end covers whole rows' worth of columns
+    x0 = 0 if wraps else int((starts % width).min())
+    x1 = width if wraps else int((stops % width).max()) + 1
+    # Expand just rows y0..y1: clip every run to that band
+    bounds = np.clip(np.concatenate([[0], ends]), y0 * width, y1 * width) - y0 * width
+    band = np.repeat(np.arange(len(counts)) % 2 == 1, np.diff(bounds)).reshape(y1 - y0, width)
+    return (x0, y0, x1, y1), band[:, x0:x1]
+
+
+def mask_window(box, crop, window):
+    """
+    The mask over window (x0, y0, x1, y1, any part of the mask's frame) from decode_mask_region's bbox and crop.
+    :return: (y1 - y0, x1 - x0) bool array, False outside the bbox.
+    """
+    x0, y0, x1, y1 = window
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+    ox0, oy0, ox1, oy1 = max(x0, box[0]), max(y0, box[1]), min(x1, box[2]), min(y1, box[3])
+    if ox0 < ox1 and oy0 < oy1:
+        mask[oy0 - y0:oy1 - y0, ox0 - x0:ox1 - x0] = crop[oy0 - box[1]:oy1 - box[1], ox0 - box[0]:ox1 - box[0]]
+    return mask
+
+
+def mask_bbox(mask):
+    """
+    :return: (x0, y0, x1, y1) of the set pixels, x1 / y1 exclusive, or None for an empty mask.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if not len(rows):
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
@@ -0,0 +1,269 @@
+# server_metrics.py
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TRACING = os.environ.get("HAIRSFE_TRACING") == "1"  # Keep individual spans too, served at /traces
+TRACE_BUFFER = 2000  # Most recent spans kept when tracing
+
+
+def __format_labels__(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    """Base for labelled metrics; one child value per label combination."""
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}  # label values tuple: value
+        self.lock = threading.Lock()
+
+    def __key__(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.__key__(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = list(self.values.items())
+        return self.header() + [f"{self.name}{__format_labels__(self.label_names, key)} {value}" for key, value in items]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.__key__(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.__key__(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # per bucket, sum, count
+            counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def render(self):
+        with self.lock:
+            items = [(key, list(counts[0]), counts[1], counts[2]) for key, counts in self.values.items()]
+        lines = self.header()
+        for key, bucket_counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{__format_labels__(self.label_names, key, [('le', bound)])} {cumulative}")
+            labels = __format_labels__(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Process-wide metrics, rendered in the Prometheus text format for GET /metrics.
+    Collectors are callables run at scrape time that return extra
+    (name, type, help, [(labels dict, value), ...]) families, for numbers other objects
+    already keep (cache and store counters), so nothing is duplicated on the hot path.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def __register__(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)  # Re-registering returns the existing one
+
+    def counter(self, name, help, labels=()):
+        return self.__register__(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.__register__(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.__register__(Histogram(name, help, labels, buckets))
+
+    def register_collector(self, collector):
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self):
+        with self.lock:
+            metrics, collectors = list(self.metrics.values()), list(self.collectors)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        names = {metric.name for metric in metrics}
+        for collector in collectors:
+            for name, metric_type, help, samples in collector():
+                if name in names:
+                    continue  # A family may only appear once per scrape; registered metrics win
+                names.add(name)
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {metric_type}"]
+                for labels, value in samples:
+                    lines.append(f"{name}{__format_labels__(list(labels), list(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram("hairsfe_http_request_duration_seconds", "HTTP request latency.",
+                                          ("method", "route", "status"))
+HTTP_BYTES_IN = REGISTRY.counter("hairsfe_http_request_bytes_total", "Request body bytes received.", ("route",))
+HTTP_BYTES_OUT = REGISTRY.counter("hairsfe_http_response_bytes_total", "Response body bytes sent.", ("route",))
+PHASE_SECONDS = REGISTRY.histogram("hairsfe_phase_duration_seconds",
+                                   "Time per processing phase (read, decode, queue_wait, inference, encode).",
+                                   ("phase", "model"))
+TASK_SECONDS = REGISTRY.histogram("hairsfe_task_duration_seconds", "Task latency from submit to finish.",
+                                  ("pool", "state"))
+TASKS_FINISHED = REGISTRY.counter("hairsfe_tasks_finished_total", "Finished tasks by final state.", ("pool", "state"))
+TASKS_PENDING = REGISTRY.gauge("hairsfe_tasks_pending", "Tasks queued and not yet started (executor queue depth).",
+                               ("pool",))
+TASKS_ACTIVE = REGISTRY.gauge("hairsfe_tasks_active", "Tasks currently running.", ("pool",))
+CANCEL_SECONDS = REGISTRY.histogram("hairsfe_cancel_duration_seconds",
+                                    "Time from a cancel request until the task stopped (how: admission, dequeued "
+                                    "or async-aborted, cooperative, deadline).", ("pool", "how"))
+LOCK_WAIT_SECONDS = REGISTRY.histogram("hairsfe_lock_wait_seconds", "Time spent waiting to acquire a lock.",
+                                       ("lock",), buckets=(1e-6, 1e-5, 1e-4, 1e-3, 0.01, 0.1, 1.0))
+
+RECENT_SPANS = deque(maxlen=TRACE_BUFFER)  # Only filled when TRACING
+
+
+def collect_process():
+    # Resident memory of this process (load tests watch it): current RSS from /proc on Linux, peak RSS elsewhere
+    try:
+        with open("/proc/self/statm") as f:
+            return [("process_resident_memory_bytes", 'gauge', "Resident memory size in bytes.",
+                     [({}, int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"))])]
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return []  # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return [("process_resident_memory_bytes", 'gauge', "Peak resident memory size in bytes.",
+             [({}, peak if sys.platform == 'darwin' else peak * 1024)])]  # ru_maxrss is in KiB on Linux
+
+
+REGISTRY.register_collector(collect_process)
+
+
+@contextmanager
+def span(phase, model=""):
+    """
+    Time one processing phase into PHASE_SECONDS (and RECENT_SPANS when tracing):
+        with span('decode'):
+            ...
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        PHASE_SECONDS.observe(duration, phase=phase, model=model)
+        if TRACING:
+            RECENT_SPANS.append({'phase': phase, 'model': model, 'thread': threading.current_thread().name,
+                                 'start': time.time() - duration, 'duration': duration})
+
+
+class InstrumentedLock:
+    """threading.Lock that records how long acquiring it took into LOCK_WAIT_SECONDS."""
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            LOCK_WAIT_SECONDS.observe(0.0, lock=self.name)  # Uncontended: skip the clock
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        LOCK_WAIT_SECONDS.observe(time.perf_counter() - start, lock=self.name)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording per-route latency and body sizes. Routes are labelled by their
+    template (/status/{task_id}), not the concrete path, to keep label cardinality bounded.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        state = {'status': 500, 'bytes_in': 0, 'bytes_out': 0}
+
+        async def counting_receive():
+            message = await receive()
+            state['bytes_in'] += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            if message["type"] == "http.response.start":
+                state['status'] = message["status"]
+            elif message["type"] == "http.response.body":
+                state['bytes_out'] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=scope["method"], route=route,
+                                         status=state['status'])
+            HTTP_BYTES_IN.inc(state['bytes_in'], route=route)
+            HTTP_BYTES_OUT.inc(state['bytes_out'], route=route)
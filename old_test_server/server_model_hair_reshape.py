@@ -0,0 +1,85 @@
+# server_model_hair_reshape.py
+import numpy as np
+from PIL import Image, ImageFilter
+
+from server_images import ImageResult
+from server_masks import decode_mask_region, mask_window
+from server_metrics import span
+from server_sources import source_array
+
+FEATHER_PIXELS = 4  # Soft edge of the blend, in image pixels; the work region is padded by as much
+
+
+def extend_downwards(region, mask):
+    """
+    Dummy reshape: every masked pixel takes the colour of the nearest unmasked pixel above it in
+    its column, i.e. the hair above the painted area grows down into it. Vectorized per region.
+    :param region: (h, w, 3) uint8 crop of the image.
+    :param mask: (h, w) bool crop of the mask.
+    :return: (h, w, 3) uint8 edited crop.
+    """
+    rows = np.where(mask, 0, np.arange(mask.shape[0])[:, None])
+    np.maximum.accumulate(rows, axis=0, out=rows)  # Index of the last unmasked row at or above each pixel
+    filled = region[rows, np.arange(mask.shape[1])[None, :]]
+    # A little vertical blur so the stretched strands don't look like flat streaks
+    return np.asarray(Image.fromarray(filled).filter(ImageFilter.BoxBlur(1)))
+
+
+class ModelHairReshape:
+    """
+    Mask-guided hair edits. Only the bounding box of the mask (plus the feather margin) is processed
+    and blended back, so a small brush stroke costs a small fraction of a full-frame run.
+    Params: the image ('source_image_id' of an upload, or 'image' like the other models) and 'mask',
+    a compact encoding (RLE or bit-packed, see server_masks) or a mask image, in any resolution:
+    it is scaled to the image.
+    """
+    def __init__(self, editor=extend_downwards):
+        self.name = "ModelHairReshape"
+        self.description = "A model for reshaping hair inside a painted mask."
+        self.editor = editor  # Callable(region, mask) -> edited region; a generative model plugs in here
+
+    @staticmethod
+    def __image_box__(mask_size, box, crop, image_size):
+        # Mask bbox (in mask pixels) -> padded bbox in image pixels, plus the mask cropped and resized to it
+        width, height = image_size
+        scale_x, scale_y = width / mask_size[0], height / mask_size[1]
+        x0 = max(0, int(box[0] * scale_x) - FEATHER_PIXELS)
+        y0 = max(0, int(box[1] * scale_y) - FEATHER_PIXELS)
+        x1 = min(width, int(np.ceil(box[2] * scale_x)) + FEATHER_PIXELS)
+        y1 = min(height, int(np.ceil(box[3] * scale_y)) + FEATHER_PIXELS)
+        # The same area in mask pixels (the feather margin may reach past the bbox), resized to the box
+        mx0, my0 = int(x0 / scale_x), int(y0 / scale_y)
+        mx1, my1 = max(mx0 + 1, int(np.ceil(x1 / scale_x))), max(my0 + 1, int(np.ceil(y1 / scale_y)))
+        window = Image.fromarray(mask_window(box, crop, (mx0, my0, mx1, my1)).astype(np.uint8) * 255)
+        window = window.resize((x1 - x0, y1 - y0), Image.NEAREST, box=(x0 / scale_x - mx0, y0 / scale_y - my0,
+                                                                       x1 / scale_x - mx0, y1 / scale_y - my0))
+        return (x0, y0, x1, y1), window
+
+    def run(self, params, progress_callback=None, cancel_check_callback=None):
+        if 'mask' not in params:
+            raise ValueError("No mask: pass 'mask' (RLE / bit-packed dict or a mask image)")
+        _, image = source_array(params)
+        mask_size, box, crop = decode_mask_region(params['mask'])  # Only the painted bbox is expanded
+        if box is None:
+            return ImageResult.from_image(Image.fromarray(image))  # Nothing painted: nothing to change
+        (x0, y0, x1, y1), mask_crop = self.__image_box__(mask_size, box, crop, (image.shape[1], image.shape[0]))
+        if progress_callback:
+            progress_callback(10)
+        if cancel_check_callback:
+            cancel_check_callback()  # Raises if canceled
+        region = image[y0:y1, x0:x1]
+        with span('reshape', model='model_hair_reshape'):
+            edited = self.editor(region, np.asarray(mask_crop) > 127)
+        if progress_callback:
+            progress_callback(80)
+        # Feathered alpha blend of the edited box over the original, in float32 on the box only, pasted
+        # into the image being encoded: the source array is never copied or touched
+        alpha = np.asarray(mask_crop.filter(ImageFilter.GaussianBlur(FEATHER_PIXELS / 2)), dtype=np.float32)[..., None] / 255
+        blended = np.rint(region + (edited.astype(np.float32) - region) * alpha).astype(np.uint8)
+        output = Image.fromarray(image)
+        output.paste(Image.fromarray(blended), (x0, y0))
+        with span('encode', model='model_hair_reshape'):
+            result = ImageResult.from_image(output, quality=92)
+        if progress_callback:
+            progress_callback(100)
+        return result
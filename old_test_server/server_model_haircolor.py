@@ -1,129 +1,259 @@
-import requests
-import base64
-import time
-from typing import Literal
-from PIL import Image
-import io
-from io import BytesIO
-
-def image_to_base64(image: Image.Image):
-    buffered = BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode("utf-8")
-
-class ModelProfile:
+# server_model_haircolor.py
+import os
+import threading
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from server_images import ImageResult
+from server_metrics import span
+from server_model_profile import ModelProfile
+from server_sources import source_array
+from server_store import BoundedStore
+
+# Reference swatches, one per colour code ("6.1.jpeg" is colour 6.1); the frontend shows the same files
+HAIR_COLORS_DIR = os.environ.get("HAIRSFE_HAIR_COLORS_DIR", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'public', 'resources', 'hair_colors'))
+MASK_SIZE = 256  # Longest side the hair mask is estimated at; it is upsampled (softly) to the image size
+MASK_THRESHOLD = 0.02  # Pixels below this hair weight are left untouched
+
+# sRGB (D65) <-> CIE XYZ, and the D65 white point
+RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                       [0.2126729, 0.7151522, 0.0721750],
+                       [0.0193339, 0.1191920, 0.9503041]], dtype=np.float32)
+XYZ_TO_RGB = np.linalg.inv(RGB_TO_XYZ).astype(np.float32)
+WHITE = np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+
+
+def rgb_to_lab(rgb):
+    """
+    :param rgb: (..., 3) uint8 sRGB.
+    :return: (..., 3) float32 CIE Lab.
+    """
+    c = rgb.astype(np.float32) / 255
+    linear = np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ RGB_TO_XYZ.T / WHITE
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16 / 116)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def lab_to_rgb(lab):
+    """
+    :param lab: (..., 3) float CIE Lab.
+    :return: (..., 3) float32 sRGB in [0, 255] (not rounded).
     """
-    A model for profile image processing tasks.
-    This model can handle profile view generation, hair color changes, and other edits.
+    fy = (lab[..., 0] + 16) / 116
+    f = np.stack([fy + lab[..., 1] / 500, fy, fy - lab[..., 2] / 200], axis=-1)
+    xyz = np.where(f > 0.206893, f ** 3, (f - 16 / 116) / 7.787) * WHITE
+    linear = np.clip(xyz @ XYZ_TO_RGB.T, 0, 1)
+    c = np.where(linear <= 0.0031308, linear * 12.92, 1.055 * linear ** (1 / 2.4) - 0.055)
+    return c * 255
+
+
+def estimate_hair_mask(rgb):
+    """
+    Heuristic hair segmentation, a stand-in until a segmentation network is plugged in
+    (ModelHairColor(segmenter=...)): foreground pixels that are neither skin nor background,
+    above the chin and around the face found by a skin-tone test.
+    :param rgb: (H, W, 3) uint8.
+    :return: (H, W) float32 hair weight in [0, 1].
+    """
+    height, width = rgb.shape[:2]
+    pixels = rgb.astype(np.float32)
+    border = np.concatenate([pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]])
+    foreground = np.linalg.norm(pixels - np.median(border, axis=0), axis=-1) > 40
+    # Skin in YCbCr (BT.601)
+    r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    cb = 128 - 0.168736 * r - 0.331264 * g + 0.5 * b
+    cr = 128 + 0.5 * r - 0.418688 * g - 0.081312 * b
+    skin = foreground & (cr > 135) & (cr < 180) & (cb > 85) & (cb < 135)
+    hair = foreground & ~skin
+    rows, cols = np.nonzero(skin)
+    if len(rows) < 0.005 * height * width:  # No face to anchor on: the upper half of the foreground
+        hair[height // 2:] = False
+        return hair.astype(np.float32)
+    top, bottom = np.percentile(rows, (2, 60))  # Skin below the chin (neck, shoulders) shouldn't stretch the face
+    left, right = np.percentile(cols, (5, 95))
+    face_height, face_width = bottom - top, right - left
+    y = np.arange(height)[:, None]
+    x = np.arange(width)[None, :]
+    hair &= (x > left - 0.6 * face_width) & (x < right + 0.6 * face_width)
+    # Above the forehead, plus the sides down to the ears (beards stay as they are)
+    hair &= (y < top + 0.4 * face_height) | ((y < top + 0.6 * face_height) & (
+        (x < left + 0.15 * face_width) | (x > right - 0.15 * face_width)))
+    return hair.astype(np.float32)
+
+
+def load_palettes(directory=HAIR_COLORS_DIR):
+    """
+    Reference colour statistics of every swatch: Lab mean and standard deviation of its centre,
+    so the recoloured hair gets the swatch's shade and its spread of highlights and lowlights.
+    :return: {colour code: (mean, std)}
+    """
+    palettes = {}
+    if not os.path.isdir(directory):
+        return palettes
+    for filename in sorted(os.listdir(directory)):
+        code, extension = os.path.splitext(filename)
+        if extension.lower() not in ('.png', '.jpg', '.jpeg'):
+            continue
+        with Image.open(os.path.join(directory, filename)) as img:
+            img = img.convert('RGB')
+            img.thumbnail((128, 128))
+            swatch = np.asarray(img)
+        height, width = swatch.shape[:2]
+        lab = rgb_to_lab(swatch[height // 5:height - height // 5, width // 5:width - width // 5]).reshape(-1, 3)
+        palettes[code] = (lab.mean(axis=0), lab.std(axis=0) + 1e-3)
+    return palettes
+
+
+class HairLayer:
     """
-    def __init__(self):
-        self.name = "ModelProfile"
-        self.description = "A model for profile image processing tasks."
-        self.__base_url__ = "https://api.bfl.ai/v1/flux-kontext-pro"
-        self.__headers__ = {
-            "x-key": "396557ef-16f2-4111-bdec-48ccb4e0c12a",
-            "Content-Type": "application/json"
-        }
-        self.__timeout__ = 30  # Timeout for requests in seconds
-        self.__interval__ = 0.5  # Polling interval in seconds
-
-    # Load your image and encode it
-    def __encode_image__(self, path):
-        with open(path, "rb") as f:
-            return base64.b64encode(f.read()).decode()
-
-    def __get_image_encoded__(self, image):
+    What recolouring one source needs, computed once per source: the hair pixels (flat indices),
+    their weight, Lab values and colour statistics. Each colour is then a few array ops on these.
+    """
+    __slots__ = ('rgb', 'indices', 'alpha', 'lab', 'mean', 'std')
+
+    def __init__(self, rgb, mask):
+        self.rgb = rgb  # (H, W, 3) uint8, shared with the source store
+        flat = mask.reshape(-1)
+        self.indices = np.flatnonzero(flat > MASK_THRESHOLD)
+        self.alpha = flat[self.indices][:, None]
+        self.lab = rgb_to_lab(rgb.reshape(-1, 3)[self.indices])
+        core = self.lab[flat[self.indices] > 0.5]  # Statistics from confident pixels only
+        core = core if len(core) else self.lab
+        self.mean = core.mean(axis=0) if len(core) else np.zeros(3, dtype=np.float32)
+        self.std = core.std(axis=0) + 1e-3 if len(core) else np.ones(3, dtype=np.float32)
+
+    @property
+    def nbytes(self):
+        # rgb counts too: the layer keeps it alive even after the source store has evicted the source
+        return self.rgb.nbytes + self.indices.nbytes + self.alpha.nbytes + self.lab.nbytes
+
+
+class ModelHairColor:
+    """
+    Local hair recolouring: the hair region of the source is moved to the reference colour of a
+    swatch by colour transfer in Lab space (Reinhard et al.), vectorized with NumPy.
+    The hair layer (mask + Lab values) is cached per source image, so trying ten colours costs one
+    segmentation plus ten cheap array ops; run_batch recolours all colours of one source at once.
+    Params: 'color_code' (a swatch code such as "6.1") or 'color' (a code or "#rrggbb"), plus the image:
+    'source_image_id' of an upload (resolved to 'image_array' by the task runner), or 'image' as a data
+    URL / bytes / PIL image.
+    """
+    def __init__(self, palettes_dir=HAIR_COLORS_DIR, segmenter=estimate_hair_mask, layers_max_bytes=256 * 1024 * 1024,
+                 layers_ttl=3600):
+        self.name = "ModelHairColor"
+        self.description = "A model for changing hair color locally."
+        self.palettes = load_palettes(palettes_dir)
+        self.segmenter = segmenter
+        self.layers = BoundedStore(layers_max_bytes, ttl=layers_ttl, sizeof=lambda layer: layer.nbytes)
+        self.layer_locks = {}  # source key: lock held while its layer is computed (concurrent batches wait for it)
+        self.layer_locks_lock = threading.Lock()
+
+    def colors(self):
+        return sorted(self.palettes)
+
+    def __palette__(self, params):
+        color = str(params.get('color_code') or params.get('color') or '')
+        if color in self.palettes:
+            return self.palettes[color]
+        if color.startswith('#') and len(color) == 7:
+            rgb = np.array([[int(color[i:i + 2], 16) for i in (1, 3, 5)]], dtype=np.uint8)
+            return rgb_to_lab(rgb)[0], None  # A flat colour: keep the hair's own spread
+        raise ValueError(f"Unknown hair color '{color}'; expected one of {self.colors()} or #rrggbb")
+
+    def __mask__(self, rgb):
+        # Segment at MASK_SIZE, then upsample with a soft edge so strands blend instead of stair-stepping
+        height, width = rgb.shape[:2]
+        scale = min(1.0, MASK_SIZE / max(height, width))
+        small = rgb if scale == 1 else np.asarray(Image.fromarray(rgb).resize(
+            (max(1, round(width * scale)), max(1, round(height * scale))), Image.BILINEAR))
+        mask = Image.fromarray((np.clip(self.segmenter(small), 0, 1) * 255).astype(np.uint8))
+        mask = mask.filter(ImageFilter.GaussianBlur(2)).resize((width, height), Image.BILINEAR)
+        return np.asarray(mask, dtype=np.float32) / 255
+
+    def hair_layer(self, key, rgb):
+        if key is None:
+            with span('segment', model='model_haircolor'):
+                return HairLayer(rgb, self.__mask__(rgb))
+        with self.layer_locks_lock:
+            key_lock = self.layer_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:  # One segmentation per source, however many batches ask at once
+                layer = self.layers.get(key)
+                if layer is None:
+                    with span('segment', model='model_haircolor'):
+                        layer = self.layers[key] = HairLayer(rgb, self.__mask__(rgb))
+                return layer
+        finally:
+            with self.layer_locks_lock:
+                self.layer_locks.pop(key, None)
+
+    def recolor(self, layer, palettes):
+        """
+        Recolour one hair layer to several palettes at once.
+        :param palettes: [(mean, std or None)], as returned by __palette__.
+        :return: One (H, W, 3) uint8 array per palette.
+        """
+        means = np.stack([mean for mean, _ in palettes])[:, None, :]
+        stds = np.stack([std if std is not None else layer.std for _, std in palettes])[:, None, :]
+        # Shift and scale the hair's Lab distribution onto each reference: (colours, hair pixels, 3)
+        lab = (layer.lab[None] - layer.mean) * (stds / layer.std) + means
+        source = layer.rgb.reshape(-1, 3)[layer.indices].astype(np.float32)
+        hair = source + (lab_to_rgb(lab) - source) * layer.alpha
+        outputs = []
+        for colored in np.clip(np.rint(hair), 0, 255).astype(np.uint8):
+            output = layer.rgb.copy()
+            output.reshape(-1, 3)[layer.indices] = colored
+            outputs.append(output)
+        return outputs
+
+    def run(self, params, progress_callback=None, cancel_check_callback=None):
+        return self.run_batch([params], [progress_callback], [cancel_check_callback])[0]
+
+    def run_batch(self, params_list, progress_callbacks, cancel_check_callbacks):
         """
-        Load an image from a file path and encode it to base64.
-        :param image_path: Path to the image file.
-        :return: Base64 encoded string of the image.
+        Recolour several requests, grouped by source: one hair layer per source, one vectorized
+        recolour for all of its colours.
+        :return: One ImageResult or exception per entry, in order.
         """
-        if isinstance(image, str):
-            with open(image, "rb") as img_file:
-                return base64.b64encode(img_file.read()).decode('utf-8')
-        elif isinstance(image, bytes):
-            return base64.b64encode(image).decode('utf-8')
-        elif isinstance(image, Image.Image):
-            buffer = io.BytesIO()
-            image.save(buffer, format="PNG")
-            return base64.b64encode(buffer.getvalue()).decode('utf-8')
-        else:
-            raise ValueError("Unsupported image type. Must be a file path, bytes, or PIL Image.")
-
-    # __base_url__ = "https://api.bfl.ai/v1/flux-kontext-pro"
-    # __headers__ = {
-    #     "x-key": "396557ef-16f2-4111-bdec-48ccb4e0c12a",
-    #     "Content-Type": "application/json"
-    # }
-
-
-    def run(self, params : dict, progress_callback, cancel_check_callback):
-        input_image = params['image']
-
-        # Tmp
-        return input_image
-
-        mode = params.get('mode', 'profile') #: Literal[')profile', 'color', 'edit']
-        color = params.get('color', 'dark brown')
-        encoded_image = input_image #self.__get_image_encoded__(input_image)
-        if mode == 'profile':
-            # prompt = "profile view of the same person. face turn to the side. same identity"
-            prompt = "profile view of the same person. face turn to the side. no skin infections, no blemishes, no acne, no discoloration, no skin issues"
-        elif mode == 'color':
-            prompt = f"change hair color to {color} , keep same haircut and same identity",
-        elif mode == 'edit':
-            raise NotImplementedError("Edit mode is not implemented yet.")
-        else:
-            raise ValueError("Invalid mode. Choose from 'profile', 'color', or 'edit'.")
-        payload = {
-            "output_format": "png",
-            "prompt_upsampling": False,
-            "safety_tolerance": 6,
-            "prompt": prompt,
-            "input_image": encoded_image,
-            "aspect_ratio": "1:1"
-        }
-
-        response = requests.request("POST", self.__base_url__, json=payload, headers=self.__headers__)
-        resp_url = response.json()['polling_url']
-        resp2 = requests.request("GET", resp_url)
-        progress_var = 0.0
-
-        max_n_iter = self.__timeout__/self.__interval__
-        while resp2.json()['status'] == 'Pending' or resp2.json()['status'] == 'Processing':
-            resp2 = requests.request("GET", resp_url)
-            # Show progress
-            print(f"Progress: {resp2.json()['progress']}")
-            time.sleep(self.__interval__)  # Polling interval, adjust as needed
-            progress_var += 100 / max_n_iter
-            if cancel_check_callback():
-                raise ValueError("Task was canceled by the user.")
-            progress_callback(int(progress_var))  # Update progress
-        try :
-            img_url = resp2.json()['result']['sample']
-            response = requests.get(img_url)
-            response.raise_for_status()  # Raises HTTPError if the request failed
-
-            # Load and display the image
-            image = Image.open(BytesIO(response.content))
-            progress_var = 100
-            progress_callback(progress_var)  # Update progress
-            img_base_64 = image_to_base64(image)  # Convert image to base64
-            return f"data:image/jpeg;base64,{img_base_64}"  # Return the base64 encoded image
-        except KeyError:
-            print(f"Error in response: {resp2.json()}")
-            return None
-
-
-if __name__ == "__main__":
-    # Example usage
-    model_profile = ModelProfile()
-    # file = r"C:\Temp\pics\Shay\Archive\tmp1.png"
-    image1 = r"C:\Users\ShayMoshe\OneDrive - vayyar.com\Documents\Personal\ML\HairSProject\pics\Shay\my_pics_fixed_ratio\Shay0_ChatGPT Image Apr 25, 2025, 07_40_30 PM_part1.jpg"
-    # encoded_image1 = encode_image(r"C:\Users\ShayMoshe\OneDrive - vayyar.com\Documents\Personal\ML\HairSProject\pics\Shay\Shay0.jpeg")
-    # encoded_image2 = encode_image(r"C:\Users\ShayMoshe\OneDrive - vayyar.com\Documents\Personal\ML\HairSProject\pics\list_of_hairs\arranged\ChatGPT Image Apr 25, 2025, 06_05_56 PM.png")
-    input_image_path = r"C:\Users\ShayMoshe\OneDrive - vayyar.com\Documents\Personal\ML\HairSProject\pics\Shay\my_pics_fixed_ratio\Shay0_ChatGPT Image Apr 25, 2025, 07_40_30 PM_part1.jpg"
-    result_image = model_profile.run({'image' : image1, 'mode':'profile'})
-    result_image.show()  # Display the result image
-    print("Done")
+        results = [None] * len(params_list)
+        groups = {}  # source key: (layer, [entry index])
+        for i, params in enumerate(params_list):
+            try:
+                if cancel_check_callbacks[i]:
+                    cancel_check_callbacks[i]()  # Raises if canceled
+                palette = self.__palette__(params)
+                key, rgb = source_array(params)
+                group_key = key if key is not None else ('uncached', i)
+                if group_key not in groups:
+                    groups[group_key] = (self.hair_layer(key, rgb), [])
+                groups[group_key][1].append((i, palette))
+                if progress_callbacks[i]:
+                    progress_callbacks[i](50)
+            except Exception as e:
+                results[i] = e
+        for layer, entries in groups.values():
+            with span('recolor', model='model_haircolor'):
+                outputs = self.recolor(layer, [palette for _, palette in entries])
+            for (i, _), output in zip(entries, outputs):
+                with span('encode', model='model_haircolor'):
+                    results[i] = ImageResult.from_image(Image.fromarray(output), quality=92)
+                if progress_callbacks[i]:
+                    progress_callbacks[i](100)
+        return results
+
+
+class ModelHairColorRemote(ModelProfile):
+    """
+    Hair colour change through the remote generative API.
+    Same protocol as ModelProfile in 'color' mode, so it shares its pooled client.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.name = "ModelHairColorRemote"
+        self.description = "A model for changing hair color through the remote API."
 
+    async def run_async(self, params : dict, progress_callback=None, cancel_check_callback=None):
+        return await super().run_async({**params, 'mode': 'color'}, progress_callback, cancel_check_callback)
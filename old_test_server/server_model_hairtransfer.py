@@ -1,54 +1,158 @@
 # server_model_hairtransfer.py
-import base64
-import io
 import os
-import time  # For simulation
-import hashlib
+import tempfile
 
-from PIL import Image
+from server_dedup import DedupIndex
+from server_executors import cancellable_batch_sleep, cancellable_sleep
+from server_gallery import GalleryStore
+from server_images import PREVIEW_SIZE, ImageResult
+from server_metrics import span
+from server_sources import PreparedSource, SourcePipeline, check_source_id
+from server_store import BoundedStore, DiskSpill
+
+
+# Pre-built catalogue bundles (see GalleryStore.save_bundle); built on the first start if missing
+BUNDLE_DIR = os.environ.get("HAIRSFE_BUNDLE_DIR", os.path.join(tempfile.gettempdir(), "hairsfe_bundles"))
 
 
 class ModelHairTransfer:
-    def __init__(self):
+    def __init__(self, source_images_max_bytes=512 * 1024 * 1024, source_images_ttl=3600, spill_dir=None,
+                 bundle_dir=BUNDLE_DIR):
         self.name = "ModelHairTransfer"
         self.description = "A model for hair transfer tasks."
         self.hair_styles_dir = r"C:\Users\ShayMoshe\OneDrive - vayyar.com\Documents\Personal\ML\HairSProject\pics\list_of_hairs\arranged"
-        self.target_styles_images = self.__load_images__(self.hair_styles_dir)  # Load images at initialization
+        # Load images at initialization (or mmap them from the bundle), served via /styles/{hash}
+        self.target_styles = GalleryStore(self.hair_styles_dir,
+                                          bundle=os.path.join(bundle_dir, "styles") if bundle_dir else None)
         self.results_dir_processing = r"C:\Users\ShayMoshe\OneDrive - vayyar.com\Documents\Personal\ML\HairSProject\pics\Archive\output_examples\Shay_With_Hair_TBW3_upscaled"
-        self.images_processed = self.__load_images__(self.results_dir_processing)
-        self.source_images = {}  # Store source images by their ID
-
-    def __load_images__(self, results_dir):
-        images = []
-        if os.path.exists(results_dir):
-            for filename in os.listdir(results_dir):
-                if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                    # images.append(Image.open(os.path.join(results_dir, filename)))
-                    with open(os.path.join(results_dir, filename), "rb") as img_file:
-                        img_data = base64.b64encode(img_file.read()).decode('utf-8')
-                        images.append(f"data:image/jpeg;base64,{img_data}")
-                        # images.append(f"data:image/{filename.lower()};base64,{img_data}")
-
-        return images
-
-    def upload_source_image(self, image_data: bytes, progress_callback=None, cancel_check_callback=None):
+        # Previews (what run() shows before it finishes) come from pre-generated thumbnails
+        self.images_processed = GalleryStore(self.results_dir_processing, thumbnail_sizes=(PREVIEW_SIZE,),
+                                             bundle=os.path.join(bundle_dir, "processed") if bundle_dir else None)
+        # Uploads are decoded once into model-input / preview arrays (PreparedSource), stored by their ID.
+        # Bounded by array size; cold sources are spilled to disk as raw .npz (pass spill_dir=False to just
+        # drop them) and come back on the next access without decoding anything.
+        self.source_pipeline = SourcePipeline()
+        if spill_dir is None:
+            spill_dir = os.path.join(tempfile.gettempdir(), "hairsfe_source_images")
+        spill = DiskSpill(spill_dir, ttl=source_images_ttl, dump=PreparedSource.dump, load=PreparedSource.load,
+                          suffix='.npz') if spill_dir else None
+        self.source_images = BoundedStore(source_images_max_bytes, ttl=source_images_ttl,
+                                          sizeof=lambda source: source.nbytes, spill=spill)
+        # Re-saved / re-compressed / resized copies of an upload map to its ID (and its cached outputs)
+        self.dedup = DedupIndex()
+
+    def style_catalogue(self):
+        # Stable style IDs (what run() takes as 'style_id') with their URL and dimensions, in listing order,
+        # one entry per file. The content hash is only in the URL; the bytes are fetched (and cached) via
+        # GET /styles/{hash}, which identical files share
+        described = map(self.target_styles.describe, self.target_styles.style_ids())
+        return [{**{name: value for name, value in description.items() if name != 'hash'},
+                 'url': f"/styles/{description['hash']}"} for description in described]
+
+    def __processed_key__(self, params):
+        # Dummy output: the processed example for the chosen style, by stable ID when given (falling back to
+        # the style's position), otherwise by 'index'
+        style_id = params.get('style_id')
+        if style_id is None:
+            return params['index']
+        if self.images_processed.resolve(style_id) is not None:
+            return style_id
+        style_ids = self.target_styles.style_ids()
+        if style_id not in style_ids:
+            raise ValueError(f"Unknown style_id '{style_id}'")
+        return style_ids.index(style_id)
+
+    def __result_for__(self, params):
+        return self.images_processed.image_result(self.__processed_key__(params))
+
+    def __preview_for__(self, params):
+        # Low-resolution output so far (the real model would decode its intermediate state at PREVIEW_SIZE)
+        try:
+            found = self.images_processed.get(self.__processed_key__(params), PREVIEW_SIZE)
+        except (KeyError, ValueError):
+            return None  # Bad params: run() reports it at the end
+        return ImageResult(*found) if found is not None else None
+
+    def __canonical_source__(self, upload_id, image_data):
+        # Same bytes, same arrays: skip the decode. Otherwise decode, and look for a near-duplicate
+        # among earlier uploads by perceptual hash of the (already downscaled) preview array
+        if self.source_images.has(upload_id):
+            return upload_id
+        canonical = self.dedup.alias(upload_id)
+        if canonical is not None and self.source_images.has(canonical):
+            return canonical
+        prepared = self.source_pipeline.prepare(image_data, upload_id)
+        preview_sizes = self.source_pipeline.preview_sizes
+        name = f'preview_{preview_sizes[0]}' if preview_sizes else 'model'
+
+        def load(source_id):
+            source = self.source_images.get(source_id)
+            return source.array(name) if source is not None else None
+
+        with span('dedup'):
+            canonical, is_new = self.dedup.canonical(upload_id, prepared.array(name), load,
+                                                     is_live=self.source_images.has)
+        if is_new:
+            self.source_images[upload_id] = prepared
+        return canonical
+
+    def upload_source_image(self, image_data: bytes, progress_callback=None, cancel_check_callback=None,
+                            upload_id=None):
         # Example: Simulate image processing (e.g., open with PIL, do ML inference)
+        # upload_id: sha256 of image_data when the caller already has it (hashed while streaming in)
         try:
-            img = Image.open(io.BytesIO(image_data))
-            source_image_id = hashlib.sha256(image_data).hexdigest()
-            self.source_images[source_image_id] = {'image' : img, 'bald_source' : None}  # Store the source image by its ID
-            return self.target_styles_images, source_image_id
+            upload_id = check_source_id(upload_id) if upload_id else SourcePipeline.source_id(image_data)
+            source_image_id = self.__canonical_source__(upload_id, image_data)
+            return source_image_id
         except Exception as e:
             raise ValueError(f"Image processing failed: {str(e)}")
 
     def run(self, params, progress_callback=None, cancel_check_callback=None):
         total_steps = 2
         for step in range(total_steps):
-            if cancel_check_callback:
-                cancel_check_callback()  # Raises if canceled
             # Do ML work here...
-            time.sleep(0.5)  # Simulate work
+            cancellable_sleep(0.5, cancel_check_callback)  # Simulate work; raises if canceled
             if progress_callback:
-                progress_callback((step + 1) / total_steps * 100)
+                if step + 1 < total_steps:  # Intermediate state: a cheap preview, never a full-size encode
+                    progress_callback((step + 1) / total_steps * 100, preview=self.__preview_for__(params))
+                else:
+                    progress_callback(100)
         print("ModelHairTransfer run completed with params:", params)
-        return self.images_processed[params['index']]
\ No newline at end of file
+        return self.__result_for__(params)
+
+    def run_batch(self, params_list, progress_callbacks, cancel_check_callbacks):
+        """
+        Run several transfers together: every step is one (simulated) forward pass over the whole batch.
+        Canceled entries drop out within CANCEL_POLL_SECONDS without affecting the others (their tasks
+        finish right away), and a step whose entries are all canceled stops at once.
+        :return: One result or exception per entry, in order.
+        """
+        results = [None] * len(params_list)
+        active = list(range(len(params_list)))
+        total_steps = 2
+        for step in range(total_steps):
+            for i in list(active):
+                try:
+                    cancel_check_callbacks[i]()  # Raises if canceled
+                except Exception as e:
+                    results[i] = e
+                    active.remove(i)
+            if not active:
+                break
+            # Do batched ML work here...
+            canceled = cancellable_batch_sleep(0.5, [cancel_check_callbacks[i] for i in active])  # Simulate work
+            for i, error in [(active[position], error) for position, error in canceled.items()]:
+                results[i] = error
+                active.remove(i)
+            for i in active:
+                if step + 1 < total_steps:
+                    progress_callbacks[i]((step + 1) / total_steps * 100, preview=self.__preview_for__(params_list[i]))
+                else:
+                    progress_callbacks[i](100)
+        for i in active:
+            try:
+                results[i] = self.__result_for__(params_list[i])
+            except Exception as e:
+                results[i] = e
+        print(f"ModelHairTransfer run_batch completed {len(active)}/{len(params_list)} jobs")
+        return results
@@ -1,31 +1,38 @@
-import requests
+import asyncio
 import base64
-import time
+import concurrent.futures
 from typing import Literal
 from PIL import Image
-import io
 from io import BytesIO
 
+from server_encoding import MASTER_QUALITY, encode
+from server_executors import CANCEL_POLL_SECONDS, TaskRevokedError, shared_event_loop
+from server_images import ImageResult, make_preview
+from server_metrics import span
+from server_remote import RemoteInferenceClient
+
+# One pooled client for every remote model, so connections (and TLS sessions) are reused across jobs
+REMOTE_CLIENT = RemoteInferenceClient()
+
 def image_to_base64(image: Image.Image):
-    buffered = BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+    return base64.b64encode(encode(image, 'image/jpeg', MASTER_QUALITY).data).decode("utf-8")
 
 class ModelProfile:
     """
     A model for profile image processing tasks.
     This model can handle profile view generation, hair color changes, and other edits.
     """
-    def __init__(self):
+    def __init__(self, base_url="https://api.bfl.ai/v1/flux-kontext-pro", client=None, bypass_remote=True):
         self.name = "ModelProfile"
         self.description = "A model for profile image processing tasks."
-        self.__base_url__ = "https://api.bfl.ai/v1/flux-kontext-pro"
+        self.__base_url__ = base_url  # Point at server_remote_stub.py to run offline
+        self.__client__ = client or REMOTE_CLIENT
+        self.__bypass_remote__ = bypass_remote  # Tmp: echo the input image instead of calling the remote API
         self.__headers__ = {
             "x-key": "396557ef-16f2-4111-bdec-48ccb4e0c12a",
             "Content-Type": "application/json"
         }
-        self.__timeout__ = 30  # Timeout for requests in seconds
-        self.__interval__ = 0.5  # Polling interval in seconds
+        self.__timeout__ = 30  # Seconds to wait for a remote job; polling backoff is handled by the client
 
     # Load your image and encode it
     def __encode_image__(self, path):
@@ -44,9 +51,9 @@ class ModelProfile:
         elif isinstance(image, bytes):
             return base64.b64encode(image).decode('utf-8')
         elif isinstance(image, Image.Image):
-            buffer = io.BytesIO()
-            image.save(buffer, format="PNG")
-            return base64.b64encode(buffer.getvalue()).decode('utf-8')
+            # JPEG at master quality is several times smaller to upload than PNG; PNG only to keep alpha
+            mime = 'image/png' if 'A' in image.getbands() else 'image/jpeg'
+            return base64.b64encode(encode(image, mime, MASTER_QUALITY).data).decode('utf-8')
         else:
             raise ValueError("Unsupported image type. Must be a file path, bytes, or PIL Image.")
 
@@ -57,25 +64,20 @@ class ModelProfile:
     # }
 
 
-    def run(self, params : dict, progress_callback, cancel_check_callback):
-        input_image = params['image']
-
-        # Tmp
-        return input_image
-
+    def __build_payload__(self, params):
         mode = params.get('mode', 'profile') #: Literal[')profile', 'color', 'edit']
         color = params.get('color', 'dark brown')
-        encoded_image = input_image #self.__get_image_encoded__(input_image)
+        encoded_image = params['image'] #self.__get_image_encoded__(input_image)
         if mode == 'profile':
             # prompt = "profile view of the same person. face turn to the side. same identity"
             prompt = "profile view of the same person. face turn to the side. no skin infections, no blemishes, no acne, no discoloration, no skin issues"
         elif mode == 'color':
-            prompt = f"change hair color to {color} , keep same haircut and same identity",
+            prompt = f"change hair color to {color} , keep same haircut and same identity"
         elif mode == 'edit':
             raise NotImplementedError("Edit mode is not implemented yet.")
         else:
             raise ValueError("Invalid mode. Choose from 'profile', 'color', or 'edit'.")
-        payload = {
+        return {
             "output_format": "png",
             "prompt_upsampling": False,
             "safety_tolerance": 6,
@@ -84,35 +86,54 @@ class ModelProfile:
             "aspect_ratio": "1:1"
         }
 
-        response = requests.request("POST", self.__base_url__, json=payload, headers=self.__headers__)
-        resp_url = response.json()['polling_url']
-        resp2 = requests.request("GET", resp_url)
-        progress_var = 0.0
-
-        max_n_iter = self.__timeout__/self.__interval__
-        while resp2.json()['status'] == 'Pending' or resp2.json()['status'] == 'Processing':
-            resp2 = requests.request("GET", resp_url)
-            # Show progress
-            print(f"Progress: {resp2.json()['progress']}")
-            time.sleep(self.__interval__)  # Polling interval, adjust as needed
-            progress_var += 100 / max_n_iter
-            if cancel_check_callback():
-                raise ValueError("Task was canceled by the user.")
-            progress_callback(int(progress_var))  # Update progress
-        try :
-            img_url = resp2.json()['result']['sample']
-            response = requests.get(img_url)
-            response.raise_for_status()  # Raises HTTPError if the request failed
-
-            # Load and display the image
-            image = Image.open(BytesIO(response.content))
-            progress_var = 100
-            progress_callback(progress_var)  # Update progress
-            img_base_64 = image_to_base64(image)  # Convert image to base64
-            return f"data:image/jpeg;base64,{img_base_64}"  # Return the base64 encoded image
-        except KeyError:
-            print(f"Error in response: {resp2.json()}")
-            return None
+    @staticmethod
+    def __encode_result__(sample, progress_callback=None):
+        with span('encode', model='model_profile'):
+            image = Image.open(BytesIO(sample))
+            if progress_callback:
+                image.load()
+                progress_callback(99, preview=make_preview(image))  # Shown while the full-size encode runs
+            return encode(image, 'image/jpeg', MASTER_QUALITY)  # The master; /result re-encodes per client
+
+    def run(self, params : dict, progress_callback=None, cancel_check_callback=None):
+        # Blocking wrapper for thread backends / scripts; the job itself runs on the shared event loop.
+        # Watches for cancellation while waiting, and cancels the coroutine (aborting any in-flight request).
+        future = shared_event_loop().run(self.run_async(params, progress_callback, cancel_check_callback))
+        while True:
+            try:
+                return future.result(timeout=CANCEL_POLL_SECONDS)
+            except concurrent.futures.TimeoutError:
+                pass
+            try:
+                if cancel_check_callback:
+                    cancel_check_callback()  # Raises if canceled
+            except TaskRevokedError:
+                future.cancel()
+                raise
+
+    async def run_async(self, params : dict, progress_callback=None, cancel_check_callback=None):
+        input_image = params.get('image')
+        if input_image is None:
+            raise ValueError("No input image: pass 'image' or the 'source_image_id' of an upload")
+
+        # Tmp
+        if self.__bypass_remote__:
+            if not isinstance(input_image, Image.Image):
+                return input_image
+            with span('encode', model='model_profile'):
+                return ImageResult.from_image(input_image)
+
+        if not isinstance(input_image, str):
+            with span('encode', model='model_profile'):
+                params = {**params, 'image': self.__get_image_encoded__(input_image)}
+        payload = self.__build_payload__(params)
+        sample = await self.__client__.run_job(self.__base_url__, payload, self.__headers__,
+                                               progress_callback, cancel_check_callback, timeout=self.__timeout__)
+        # Decode + JPEG re-encode is CPU work, keep it off the event loop
+        result = await asyncio.to_thread(self.__encode_result__, sample, progress_callback)
+        if progress_callback:
+            progress_callback(100)  # Update progress
+        return result  # Served as raw bytes by GET /result/{task_id}
 
 
 if __name__ == "__main__":
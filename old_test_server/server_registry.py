@@ -0,0 +1,88 @@
+# server_registry.py
+import threading
+import time
+
+
+class ModelRegistry:
+    """
+    Name -> model mapping that builds each model on first use, so importing the server (or
+    starting a worker process) costs nothing. Loading is thread-safe: concurrent first users
+    wait for one load. warm_up() loads everything in a background thread after startup, and
+    status() / ready() back the /readyz endpoint.
+    A model whose load fails stays unloaded; the next access retries.
+    """
+    def __init__(self, factories):
+        self.factories = dict(factories)  # name: zero-argument callable returning the model
+        self.models = {}
+        self.errors = {}  # name: last load error
+        self.load_seconds = {}
+        self.locks = {name: threading.Lock() for name in self.factories}
+
+    def __contains__(self, name):
+        return name in self.factories
+
+    def __iter__(self):
+        return iter(self.factories)
+
+    def __len__(self):
+        return len(self.factories)
+
+    def keys(self):
+        return self.factories.keys()
+
+    def __getitem__(self, name):
+        model = self.models.get(name)
+        if model is not None:
+            return model
+        if name not in self.factories:
+            raise KeyError(name)
+        with self.locks[name]:
+            if name not in self.models:  # Someone else may have loaded it while we waited
+                start = time.perf_counter()
+                try:
+                    self.models[name] = self.factories[name]()
+                except Exception as e:
+                    self.errors[name] = f"{type(e).__name__}: {e}"
+                    raise
+                self.errors.pop(name, None)
+                self.load_seconds[name] = time.perf_counter() - start
+            return self.models[name]
+
+    def __setitem__(self, name, model):
+        # Swap in a ready instance (tests, or a model configured differently)
+        self.factories.setdefault(name, lambda: model)
+        self.locks.setdefault(name, threading.Lock())
+        self.models[name] = model
+
+    def get_loaded(self, name):
+        """:return: The model if it is already loaded, else None (never triggers a load)."""
+        return self.models.get(name)
+
+    def warm_up(self, names=None, background=True):
+        """
+        Load models ahead of their first request.
+        :param background: Return at once and load in a daemon thread.
+        :return: The thread, or None when loading in the foreground.
+        """
+        def load_all():
+            for name in names or list(self.factories):
+                try:
+                    self[name]
+                except Exception as e:
+                    print(f"Warm-up of {name} failed: {e}")
+
+        if not background:
+            load_all()
+            return None
+        thread = threading.Thread(target=load_all, name='model-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def ready(self):
+        return all(name in self.models for name in self.factories)
+
+    def status(self):
+        return {name: {'loaded': name in self.models,
+                       'load_seconds': self.load_seconds.get(name),
+                       'error': self.errors.get(name)}
+                for name in self.factories}
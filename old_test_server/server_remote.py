@@ -0,0 +1,110 @@
+# server_remote.py
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+from server_executors import CANCEL_POLL_SECONDS
+
+PENDING_STATUSES = ('Pending', 'Processing')
+
+
+class RemoteJobError(Exception):
+    pass
+
+
+class RemoteInferenceClient:
+    """
+    Shared async client for remote inference APIs that follow the submit / polling_url / sample
+    protocol (POST the job, poll the returned polling_url until 'Ready', download result.sample).
+    One keep-alive connection pool is reused for every request, polls back off adaptively, and
+    at most max_jobs_per_upstream jobs run at once against each host.
+    Must be used from a single event loop (see server_executors.shared_event_loop).
+    """
+    def __init__(self, max_connections=64, max_keepalive_connections=16, max_jobs_per_upstream=8,
+                 request_timeout=30.0, min_poll_interval=0.25, max_poll_interval=2.0, backoff=1.5, transport=None):
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections)
+        self.request_timeout = request_timeout
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.max_jobs_per_upstream = max_jobs_per_upstream
+        self.transport = transport  # e.g. httpx.ASGITransport(app=stub_app) to run offline
+        self.client = None
+        self.upstream_slots = {}  # host: asyncio.Semaphore
+
+    def __client__(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(limits=self.limits, timeout=self.request_timeout, transport=self.transport)
+        return self.client
+
+    def __slots_for__(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.upstream_slots:
+            self.upstream_slots[host] = asyncio.Semaphore(self.max_jobs_per_upstream)
+        return self.upstream_slots[host]
+
+    @staticmethod
+    async def __wait__(seconds, cancel_check_callback):
+        # Poll-interval sleep that stops within CANCEL_POLL_SECONDS of a cancel, even when nobody cancels the coroutine
+        deadline = time.monotonic() + seconds
+        while (remaining := deadline - time.monotonic()) > 0:
+            await asyncio.sleep(min(remaining, CANCEL_POLL_SECONDS))
+            if cancel_check_callback:
+                cancel_check_callback()  # Raises if canceled
+
+    async def run_job(self, url, payload, headers, progress_callback=None, cancel_check_callback=None, timeout=30.0):
+        """
+        Submit a job and wait for its result.
+        :param timeout: Seconds to wait for the job to become ready.
+        :return: Bytes of the result sample.
+        """
+        client = self.__client__()
+        async with self.__slots_for__(url):
+            response = await client.post(url, json=payload, headers=headers)
+            response.raise_for_status()
+            polling_url = response.json()['polling_url']
+
+            deadline = time.monotonic() + timeout
+            started = time.monotonic()
+            interval = self.min_poll_interval
+            last_progress = None
+            while True:
+                if cancel_check_callback:
+                    cancel_check_callback()  # Raises if canceled
+                status = (await client.get(polling_url, headers=headers)).json()
+                if status['status'] not in PENDING_STATUSES:
+                    break
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Remote job not ready after {timeout} seconds")
+                progress = status.get('progress')
+                if progress is not None and progress != last_progress:
+                    interval = self.min_poll_interval  # Job is moving: look again soon
+                    last_progress = progress
+                else:
+                    interval = min(interval * self.backoff, self.max_poll_interval)
+                if progress_callback:
+                    # Upstream progress when reported (fraction or percent), otherwise a time-based estimate
+                    if progress is not None:
+                        estimate = progress * 100 if progress <= 1 else progress
+                    else:
+                        estimate = (time.monotonic() - started) / timeout * 100
+                    progress_callback(min(int(estimate), 99))
+                await self.__wait__(interval, cancel_check_callback)
+
+            if status['status'] != 'Ready':
+                raise RemoteJobError(f"Remote job ended with status {status['status']!r}")
+            try:
+                sample_url = status['result']['sample']
+            except (KeyError, TypeError):
+                raise RemoteJobError(f"Error in response: {status}")
+            sample = await client.get(sample_url)
+            sample.raise_for_status()
+            return sample.content
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
@@ -0,0 +1,64 @@
+# server_remote_stub.py
+# Local stand-in for the remote inference API (submit -> polling_url -> result.sample), so
+# ModelProfile and RemoteInferenceClient can be exercised offline:
+#   python server_remote_stub.py            (listens on :8001)
+#   ModelProfile(base_url="http://localhost:8001/v1/flux-kontext-pro", bypass_remote=False)
+# or in-process, without a socket:
+#   RemoteInferenceClient(transport=httpx.ASGITransport(app=server_remote_stub.app))
+import base64
+import io
+import time
+import uuid
+
+from fastapi import FastAPI, HTTPException, Request, Response
+from PIL import Image
+
+app = FastAPI(title="Remote inference stub")
+
+JOB_SECONDS = 1.0  # How long every job stays 'Pending'
+jobs = {}  # job id: {'started', 'image'}
+
+
+def decode_input_image(encoded):
+    if not encoded:
+        return Image.new("RGB", (256, 256), (120, 80, 60))
+    if encoded.startswith("data:"):
+        encoded = encoded.split(",", 1)[1]
+    try:
+        return Image.open(io.BytesIO(base64.b64decode(encoded))).convert("RGB")
+    except Exception:
+        return Image.new("RGB", (256, 256), (120, 80, 60))
+
+
+@app.post("/v1/{model}")
+async def submit(model: str, payload: dict, request: Request):
+    job_id = str(uuid.uuid4())
+    jobs[job_id] = {'started': time.monotonic(), 'image': decode_input_image(payload.get('input_image'))}
+    return {"id": job_id, "polling_url": f"{str(request.base_url).rstrip('/')}/v1/get_result?id={job_id}"}
+
+
+@app.get("/v1/get_result")
+def get_result(id: str, request: Request):
+    job = jobs.get(id)
+    if job is None:
+        return {"id": id, "status": "Task not found"}
+    elapsed = time.monotonic() - job['started']
+    if elapsed < JOB_SECONDS:
+        return {"id": id, "status": "Pending", "progress": round(elapsed / JOB_SECONDS, 2)}
+    return {"id": id, "status": "Ready", "progress": 1.0,
+            "result": {"sample": f"{str(request.base_url).rstrip('/')}/samples/{id}.png"}}
+
+
+@app.get("/samples/{job_id}.png")
+def get_sample(job_id: str):
+    job = jobs.pop(job_id, None)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Sample not found")
+    buffer = io.BytesIO()
+    job['image'].transpose(Image.FLIP_LEFT_RIGHT).save(buffer, format="PNG")  # Mirror it, so it's visibly "processed"
+    return Response(content=buffer.getvalue(), media_type="image/png")
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8001)
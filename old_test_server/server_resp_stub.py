@@ -0,0 +1,202 @@
+# server_resp_stub.py
+# Local stand-in for a Redis server, with just the commands RespTaskState uses, so the shared task
+# backend can be exercised without installing Redis:
+#   python server_resp_stub.py              (listens on :6380)
+#   HAIRSFE_TASK_STATE=redis://localhost:6380/0 uvicorn server_dummy_app:app --workers 4
+# or in-process:
+#   stub = start_stub(); RespClient('localhost', stub.server_address[1])
+# Single keyspace (SELECT is accepted and ignored), expiry is checked lazily on access.
+import socketserver
+import threading
+import time
+
+data = {}  # key: bytes, dict (hash) or set
+expires = {}  # key: time.monotonic() deadline
+lock = threading.Lock()
+
+
+class CommandError(Exception):
+    pass
+
+
+def __live__(key):
+    # Caller holds lock. Drops the key if it has expired
+    deadline = expires.get(key)
+    if deadline is not None and time.monotonic() >= deadline:
+        data.pop(key, None)
+        expires.pop(key, None)
+    return key in data
+
+
+def __typed__(key, kind):
+    value = data.get(key) if __live__(key) else None
+    if value is not None and not isinstance(value, kind):
+        raise CommandError("WRONGTYPE Operation against a key holding the wrong kind of value")
+    return value
+
+
+def cmd_set(key, value, *options):
+    options = [option.upper() for option in options]
+    exists = __live__(key)
+    if (b'NX' in options and exists) or (b'XX' in options and not exists):
+        return None
+    data[key] = value
+    expires.pop(key, None)
+    for unit, scale in ((b'EX', 1.0), (b'PX', 0.001)):
+        if unit in options:
+            expires[key] = time.monotonic() + int(options[options.index(unit) + 1]) * scale
+    return 'OK'
+
+
+def cmd_get(key):
+    return __typed__(key, bytes)
+
+
+def cmd_del(*keys):
+    removed = 0
+    for key in keys:
+        if __live__(key):
+            del data[key]
+            removed += 1
+        expires.pop(key, None)
+    return removed
+
+
+def cmd_exists(*keys):
+    return sum(1 for key in keys if __live__(key))
+
+
+def cmd_expire(key, seconds):
+    if not __live__(key):
+        return 0
+    expires[key] = time.monotonic() + int(seconds)
+    return 1
+
+
+def cmd_hset(key, *pairs):
+    fields = __typed__(key, dict)
+    if fields is None:
+        fields = data[key] = {}
+    added = sum(1 for name in pairs[::2] if name not in fields)
+    fields.update(zip(pairs[::2], pairs[1::2]))
+    return added
+
+
+def cmd_hget(key, name):
+    return (__typed__(key, dict) or {}).get(name)
+
+
+def cmd_hmget(key, *names):
+    fields = __typed__(key, dict) or {}
+    return [fields.get(name) for name in names]
+
+
+def cmd_hgetall(key):
+    return [item for pair in (__typed__(key, dict) or {}).items() for item in pair]
+
+
+def cmd_hincrby(key, name, amount):
+    fields = __typed__(key, dict)
+    if fields is None:
+        fields = data[key] = {}
+    value = int(fields.get(name, b'0')) + int(amount)
+    fields[name] = str(value).encode()
+    return value
+
+
+def cmd_sadd(key, *members):
+    members_set = __typed__(key, set)
+    if members_set is None:
+        members_set = data[key] = set()
+    added = len(set(members) - members_set)
+    members_set.update(members)
+    return added
+
+
+def cmd_srem(key, *members):
+    members_set = __typed__(key, set) or set()
+    removed = len(members_set & set(members))
+    members_set.difference_update(members)
+    return removed
+
+
+def cmd_sismember(key, member):
+    return int(member in (__typed__(key, set) or set()))
+
+
+def cmd_smembers(key):
+    return list(__typed__(key, set) or ())
+
+
+def cmd_scard(key):
+    return len(__typed__(key, set) or ())
+
+
+COMMANDS = {
+    b'SET': cmd_set, b'GET': cmd_get, b'DEL': cmd_del, b'EXISTS': cmd_exists, b'EXPIRE': cmd_expire,
+    b'HSET': cmd_hset, b'HGET': cmd_hget, b'HMGET': cmd_hmget, b'HGETALL': cmd_hgetall, b'HINCRBY': cmd_hincrby,
+    b'SADD': cmd_sadd, b'SREM': cmd_srem, b'SISMEMBER': cmd_sismember, b'SMEMBERS': cmd_smembers,
+    b'SCARD': cmd_scard, b'PING': lambda *args: 'PONG', b'SELECT': lambda db: 'OK',
+    b'FLUSHDB': lambda: (data.clear(), expires.clear()) and 'OK',
+}
+
+
+def encode_reply(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, str):
+        return f"+{reply}\r\n".encode()
+    if isinstance(reply, int):
+        return f":{reply}\r\n".encode()
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    return b"*%d\r\n" % len(reply) + b"".join(encode_reply(item) for item in reply)
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()  # Inline command (e.g. typed into telnet)
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            if not command:
+                continue
+            handler = COMMANDS.get(command[0].upper())
+            try:
+                if handler is None:
+                    raise CommandError(f"ERR unknown command '{command[0].decode(errors='replace')}'")
+                with lock:
+                    reply = handler(*command[1:])
+            except (CommandError, TypeError, ValueError) as e:
+                reply_bytes = f"-{e if isinstance(e, CommandError) else 'ERR ' + str(e)}\r\n".encode()
+            else:
+                reply_bytes = encode_reply(reply)
+            self.wfile.write(reply_bytes)
+
+
+class RespServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_stub(host='localhost', port=0):
+    """Serve in a background thread; port 0 picks a free one (see server.server_address)."""
+    server = RespServer((host, port), RespHandler)
+    threading.Thread(target=server.serve_forever, name='resp-stub', daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    RespServer(("0.0.0.0", 6380), RespHandler).serve_forever()
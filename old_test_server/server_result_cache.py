@@ -0,0 +1,146 @@
+# server_result_cache.py
+import hashlib
+import json
+import threading
+
+from server_images import ImageResult
+from server_store import BoundedStore, DiskSpill
+
+INLINE_PARAM_MAX_CHARS = 256  # Longer string params (inline images) are keyed by their sha256
+
+
+def normalize_params(params):
+    """
+    Canonical form of request params for cache keys: sorted keys, and large inline values
+    (data URLs) replaced by their content hash so the key stays small.
+    """
+    normalized = {}
+    for name, value in params.items():
+        if isinstance(value, ImageResult):
+            value = 'sha256:' + value.digest()  # Multipart upload
+        elif isinstance(value, str) and len(value) > INLINE_PARAM_MAX_CHARS:
+            value = 'sha256:' + hashlib.sha256(value.encode('utf-8')).hexdigest()
+        normalized[name] = value
+    return json.dumps(normalized, sort_keys=True, separators=(',', ':'), default=str)
+
+
+class ResultCache:
+    """
+    Finished model results keyed by (source image, model, normalized params), plus single-flight
+    bookkeeping: while a result is being computed, identical requests get the same task_id.
+    Results live in a size-bounded LRU; with persist_dir they are also written through to disk
+    and survive restarts (files idle for longer than ttl are purged).
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024, ttl=24 * 3600, persist_dir=None):
+        self.results = BoundedStore(max_bytes, ttl=ttl, sizeof=lambda result: len(result))
+        self.disk = DiskSpill(persist_dir, ttl=ttl) if persist_dir else None
+        self.in_flight = {}  # key: task_id currently computing it
+        self.waiters = {}  # task_id: number of requests attached to it
+        self.keys = {}  # task_id: key it computes, while in flight
+        self.lock = threading.RLock()  # Re-entrant: on_done may run inside submit() if the job is instant
+        self.counters = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
+    @staticmethod
+    def key(model_name, params):
+        source = params.get('source_image_id', '')
+        digest = hashlib.sha256(f"{model_name}\0{source}\0{normalize_params(params)}".encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        result = self.results.get(key)
+        if result is None and self.disk is not None:
+            result = self.disk.restore(key, keep=True)
+            if result is not None:
+                self.results.set(key, result)
+        return result
+
+    def has(self, key):
+        """
+        Whether key is cached or being computed, without counting a lookup.
+        """
+        with self.lock:
+            if key in self.in_flight:
+                return True
+        return self.results.has(key) or (self.disk is not None and self.disk.contains(key))
+
+    def put(self, key, result):
+        if not isinstance(result, (str, bytes, ImageResult)):
+            return  # Only cache real payloads (None means the model produced nothing)
+        self.results.set(key, result)
+        if self.disk is not None:
+            self.disk.save(key, result)
+            self.disk.purge_expired()
+
+    def start(self, task_manager, key, submit, complete):
+        """
+        Single-flight entry point.
+        :param submit: Callable(on_done) -> task_id that starts the real computation.
+        :param complete: Callable(result) -> task_id of an already-completed task.
+        :return: task_id, either served from the cache, shared with an identical running
+                 request, or newly submitted.
+        """
+        result = self.get(key)
+        if result is not None:
+            with self.lock:
+                self.counters['hits'] += 1
+            return complete(result)
+
+        with self.lock:
+            task_id = self.in_flight.get(key)
+            if task_id is not None:
+                self.waiters[task_id] += 1
+                self.counters['coalesced'] += 1
+                return task_id
+            self.counters['misses'] += 1
+
+            def on_done(done_task_id, state, result):
+                if state == 'COMPLETED':
+                    self.put(key, result)
+                with self.lock:
+                    if self.in_flight.get(key) == done_task_id:
+                        del self.in_flight[key]
+                    self.waiters.pop(done_task_id, None)
+                    self.keys.pop(done_task_id, None)
+
+            # Submitting only queues the job, so holding the lock here is cheap and closes the race
+            # between two identical requests
+            task_id = submit(on_done)
+            if task_manager.get_status(task_id).get('done'):
+                return task_id  # Finished (and cleaned up) before we got here
+            self.in_flight[key] = task_id
+            self.waiters[task_id] = 1
+            self.keys[task_id] = key
+            return task_id
+
+    def detach(self, task_id):
+        """
+        Called when one requester cancels. The task is only really canceled once no other
+        coalesced request is waiting for it; then it is abandoned first (see abandon), so identical
+        requests arriving meanwhile don't join the run being canceled.
+        :return: True if others still wait (don't cancel), False otherwise.
+        """
+        with self.lock:
+            return not self.abandon(self.keys.get(task_id), task_id)
+
+    def abandon(self, key, task_id):
+        """
+        Called by a requester dropping a run nobody else is attached to, before canceling it: from now on
+        identical requests start a new run instead of joining the canceled one.
+        :return: True if the run can be canceled, False if others wait for it (the caller is detached).
+        """
+        with self.lock:
+            if self.waiters.get(task_id, 0) > 1:
+                self.waiters[task_id] -= 1
+                return False
+            if key is not None and self.in_flight.get(key) == task_id:
+                del self.in_flight[key]
+            self.waiters.pop(task_id, None)
+            self.keys.pop(task_id, None)
+            return True
+
+    def stats(self):
+        with self.lock:
+            counters = {**self.counters, 'in_flight': len(self.in_flight)}
+        lookups = counters['hits'] + counters['misses'] + counters['coalesced']
+        counters['hit_ratio'] = (counters['hits'] + counters['coalesced']) / lookups if lookups else 0.0
+        return {**counters, 'store': self.results.stats()}
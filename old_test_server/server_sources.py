@@ -0,0 +1,127 @@
+# server_sources.py
+import hashlib
+import io
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from server_images import ImageResult
+from server_metrics import span
+from server_store import is_hex_key
+
+MODEL_INPUT_SIZE = 1024  # Longest side of the array models run on
+PREVIEW_SIZES = (256,)  # Longest side of the preview arrays
+
+
+def check_source_id(source_image_id):
+    """
+    Client-supplied source IDs are sha256 hex digests of an upload; refuse anything else (e.g. paths)
+    before it reaches a store or the spill directory.
+    :raises ValueError: Not 64 lowercase hex characters.
+    """
+    if not is_hex_key(source_image_id):
+        raise ValueError("Invalid source_image_id: expected the 64-character hex ID of an upload")
+    return source_image_id
+
+
+class PreparedSource:
+    """
+    An uploaded source image after ingestion: decoded once, EXIF-rotated, RGB, and resized
+    to the model input and preview sizes. Models read the uint8 arrays directly.
+    """
+    __slots__ = ('source_id', 'arrays', 'bald_source')
+
+    def __init__(self, source_id, arrays, bald_source=None):
+        self.source_id = source_id
+        self.arrays = arrays  # 'model' / 'preview_<size>': (H, W, 3) uint8, C-contiguous
+        self.bald_source = bald_source  # Derived by models, recomputed after a spill
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def array(self, name='model'):
+        return self.arrays[name]
+
+    def image(self, name='model'):
+        # A PIL view for models that want one; no decoding involved
+        return Image.fromarray(self.arrays[name], mode='RGB')
+
+    def __getstate__(self):
+        return self.source_id, self.arrays  # bald_source is derived, not worth shipping
+
+    def __setstate__(self, state):
+        self.source_id, self.arrays = state
+        self.bald_source = None
+
+    def dump(self, f):
+        # Uncompressed .npz: reading back is a memcpy, not a decode
+        np.savez(f, source_id=np.array(self.source_id), **self.arrays)
+
+    @classmethod
+    def load(cls, f):
+        with np.load(f) as stored:
+            arrays = {name: stored[name] for name in stored.files if name != 'source_id'}
+            return cls(str(stored['source_id']), arrays)
+
+
+class SourcePipeline:
+    """
+    Ingestion stage for uploads: decode, apply the EXIF orientation, convert to RGB and
+    produce every resolution the models and previews need, in one pass.
+    """
+    def __init__(self, model_input_size=MODEL_INPUT_SIZE, preview_sizes=PREVIEW_SIZES):
+        self.model_input_size = model_input_size
+        self.preview_sizes = tuple(preview_sizes)
+
+    @staticmethod
+    def source_id(image_data: bytes):
+        return hashlib.sha256(image_data).hexdigest()
+
+    @staticmethod
+    def __fit__(img, size):
+        # Downscale only, keeping the aspect ratio
+        scale = size / max(img.size)
+        if scale >= 1:
+            return img
+        new_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        return img.resize(new_size, Image.LANCZOS)
+
+    def prepare(self, image_data: bytes, source_id=None):
+        """
+        :param image_data: Encoded upload (JPEG/PNG/...).
+        :return: PreparedSource keyed by the sha256 of the upload.
+        """
+        with span('decode'), Image.open(io.BytesIO(image_data)) as img:
+            img.draft('RGB', (self.model_input_size, self.model_input_size))  # JPEG: decode at a reduced scale when possible
+            img = ImageOps.exif_transpose(img).convert('RGB')
+        with span('resize'):
+            model_img = self.__fit__(img, self.model_input_size)
+            arrays = {'model': np.ascontiguousarray(model_img, dtype=np.uint8)}
+            for size in self.preview_sizes:
+                arrays[f'preview_{size}'] = np.ascontiguousarray(self.__fit__(model_img, size), dtype=np.uint8)
+        return PreparedSource(source_id or self.source_id(image_data), arrays)
+
+
+def source_array(params):
+    """
+    The image a model should work on, from its params: the prepared array of an upload ('image_array',
+    filled in from 'source_image_id' by the task runner) or an 'image' given as a data URL / bytes /
+    ImageResult / PIL image.
+    :return: (key, (H, W, 3) uint8 array); key identifies the image for per-source caches (None if unknown).
+    :raises ValueError: No image in params.
+    """
+    if params.get('image_array') is not None:
+        return check_source_id(params['source_image_id']), params['image_array']
+    image = params.get('image')
+    if isinstance(image, Image.Image):
+        return None, np.asarray(image.convert('RGB'))
+    if isinstance(image, str) and image.startswith("data:"):
+        image = ImageResult.from_data_url(image)
+    if isinstance(image, ImageResult):
+        image = image.data
+    if not isinstance(image, (bytes, bytearray)):
+        raise ValueError("No input image: pass 'image' or the 'source_image_id' of an upload")
+    with span('decode'), Image.open(io.BytesIO(image)) as img:
+        array = np.asarray(ImageOps.exif_transpose(img).convert('RGB'))
+    return SourcePipeline.source_id(bytes(image)), array
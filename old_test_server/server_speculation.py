@@ -0,0 +1,224 @@
+# server_speculation.py
+# Speculative precompute: right after an upload, run the styles users pick most often for the new source
+# on otherwise idle model capacity, so the first click is often answered straight from the result cache.
+# - Popularity is learned from real requests: their params minus source_image_id are "the style", so a
+#   speculative run hashes to the same result cache key as the click it anticipates. Counts decay.
+# - Runs only start while the model has spare capacity (TaskManager.spare_capacity; bulk priority, a client
+#   of their own), and running ones are canceled, newest first, as soon as real requests have to wait.
+#   On batch pools one upload's runs share a batch, and preemption cancels them all: a worker is only
+#   free again once every job of its batch is gone.
+# - Hits (real requests answered by a speculative result, or joining its run) and waste (runs preempted,
+#   failed, or not asked for within claim_window) are counted, in runs and in model seconds.
+import functools
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+from server_admission import QueueFullError
+from server_result_cache import ResultCache, normalize_params
+from server_tasks import submit_ml_task
+
+SPECULATIVE_CLIENT = 'speculative'  # Admission fair-share key of speculative runs
+STYLE_VALUE_TYPES = (str, int, float, bool, type(None))  # Requests with other params (inline images) aren't learned
+DECAY_EVERY = 1000  # Observed requests between halvings of the popularity counts
+MAX_STYLES = 1000  # Distinct styles counted
+CLAIM_WINDOW_SECONDS = 15 * 60  # A speculative result nobody asked for within this counts as wasted
+MAX_READY = 10000  # Unclaimed speculative results tracked
+# States of a running speculative run
+SPECULATIVE, CLAIMED, PREEMPTED = 'speculative', 'claimed', 'preempted'
+
+
+class Speculator:
+    """
+    Speculative runs of one model's top_n most requested styles for every new upload.
+    top_n=0 disables it (nothing is learned or run).
+    """
+    def __init__(self, task_manager, result_cache, model_name='model_ht', top_n=0,
+                 claim_window=CLAIM_WINDOW_SECONDS):
+        self.task_manager = task_manager
+        self.result_cache = result_cache
+        self.model_name = model_name
+        self.top_n = top_n
+        self.claim_window = claim_window
+        self.popularity = {}  # normalized style params: [count, style params]
+        self.observed = 0
+        self.running = OrderedDict()  # result cache key: [task_id, submitted_at, state], oldest first
+        self.ready = OrderedDict()  # result cache key: (finished_at, run seconds) of unclaimed results, oldest first
+        self.lock = threading.Lock()
+        self.counters = {'submitted': 0, 'skipped_busy': 0, 'already_cached': 0, 'hits': 0, 'preempted': 0,
+                         'failed': 0, 'wasted': 0, 'useful_seconds': 0.0, 'wasted_seconds': 0.0}
+
+    def observe(self, params):
+        """
+        A real request for the model (call before starting it): counts its style, and claims the
+        speculative result or run it matches, if any.
+        """
+        if not self.top_n:
+            return
+        style = {name: value for name, value in params.items() if name != 'source_image_id'}
+        if 'source_image_id' not in params or not all(isinstance(value, STYLE_VALUE_TYPES) for value in style.values()):
+            return
+        key = ResultCache.key(self.model_name, params)
+        cached = self.result_cache.has(key)
+        with self.lock:
+            self.__count__(style)
+            self.__expire__(time.monotonic())
+            entry = self.running.get(key)
+            if entry is not None and entry[2] == SPECULATIVE:
+                entry[2] = CLAIMED  # No longer preempted; its seconds count as useful once it finishes
+                self.counters['hits'] += 1
+            elif key in self.ready:
+                _, seconds = self.ready.pop(key)
+                if cached:
+                    self.counters['hits'] += 1
+                    self.counters['useful_seconds'] += seconds
+                else:
+                    self.__waste__(seconds)  # Evicted from the result cache before anyone asked
+
+    def speculate(self, source_image_id):
+        """
+        Start runs of the top styles for a new source, as long as the model has spare capacity.
+        :return: Number of runs started.
+        """
+        if not self.top_n:
+            return 0
+        with self.lock:
+            self.__expire__(time.monotonic())
+            styles = [style for _, style in heapq.nlargest(self.top_n, self.popularity.values(), key=lambda e: e[0])]
+        spare = self.task_manager.spare_capacity(self.model_name)
+        if spare > 0 and self.task_manager.backend(self.model_name).kind == 'batch':
+            spare = len(styles)  # One free worker runs them all, as one batch
+        started = cached = skipped = 0
+        for i, style in enumerate(styles):
+            params = {**style, 'source_image_id': source_image_id}
+            key = ResultCache.key(self.model_name, params)
+            if key in self.running:  # E.g. preempted and still winding down
+                continue
+            if self.result_cache.has(key):
+                cached += 1
+                continue
+            if started >= spare:
+                skipped = len(styles) - i  # Real requests come first: stop here
+                break
+            try:
+                self.result_cache.start(self.task_manager, key, functools.partial(self.__submit__, key, params),
+                                        self.task_manager.submit_completed)
+            except QueueFullError:
+                skipped = len(styles) - i
+                break
+            started += 1
+        with self.lock:
+            self.counters['already_cached'] += cached
+            self.counters['skipped_busy'] += skipped
+        return started
+
+    def preempt(self):
+        """
+        Cancel unclaimed speculative runs, newest first (they have done the least work), one for every
+        job waiting for the model's capacity (all of them on batch pools). Call after starting a real request.
+        :return: Number of runs canceled.
+        """
+        with self.lock:
+            if not self.running:
+                return 0
+        waiting = -self.task_manager.spare_capacity(self.model_name)
+        if waiting <= 0:
+            return 0
+        if self.task_manager.backend(self.model_name).kind == 'batch':
+            waiting = len(self.running)
+        with self.lock:
+            waiting -= sum(1 for entry in self.running.values() if entry[2] == PREEMPTED)  # Already on their way out
+            victims = [(key, entry) for key, entry in reversed(self.running.items())
+                       if entry[2] == SPECULATIVE and entry[0] is not None][:max(0, waiting)]
+            for _, entry in victims:
+                entry[2] = PREEMPTED  # Requests for it from now on are no hits
+        for key, entry in victims:
+            if self.result_cache.abandon(key, entry[0]):  # Otherwise a real request joined it just now
+                self.task_manager.cancel(entry[0])
+        return len(victims)
+
+    def __submit__(self, key, params, on_done):
+        # The result cache's submit: the run, tracked until it finishes
+        with self.lock:
+            self.running[key] = [None, time.monotonic(), SPECULATIVE]
+        try:
+            task_id = submit_ml_task(self.task_manager, self.model_name, params,
+                                     on_done=functools.partial(self.__done__, key, on_done),
+                                     priority='bulk', client=SPECULATIVE_CLIENT)
+        except Exception:
+            with self.lock:
+                self.running.pop(key, None)
+            raise
+        with self.lock:
+            entry = self.running.get(key)
+            if entry is not None and entry[0] is None:  # Otherwise it already finished
+                entry[0] = task_id
+            self.counters['submitted'] += 1
+        return task_id
+
+    def __done__(self, key, on_done, task_id, state, result):
+        on_done(task_id, state, result)  # The result cache's first: the result is stored before it counts as ready
+        now = time.monotonic()
+        with self.lock:
+            entry = self.running.get(key)
+            if entry is None or entry[0] not in (None, task_id):  # None: finished inside submit
+                return
+            del self.running[key]
+            seconds = now - entry[1]
+            if state != 'COMPLETED':
+                self.counters['preempted' if state == 'CANCELED' else 'failed'] += 1
+                self.__waste__(seconds)
+            elif entry[2] == CLAIMED:
+                self.counters['useful_seconds'] += seconds
+            else:
+                self.ready[key] = (now, seconds)
+                while len(self.ready) > MAX_READY:
+                    self.__waste__(self.ready.popitem(last=False)[1][1])
+
+    def __count__(self, style):
+        # Caller holds self.lock
+        name = normalize_params(style)
+        entry = self.popularity.get(name)
+        if entry is None:
+            if len(self.popularity) >= MAX_STYLES:
+                self.__decay__()
+                if len(self.popularity) >= MAX_STYLES:
+                    return
+            entry = self.popularity[name] = [0, style]
+        entry[0] += 1
+        self.observed += 1
+        if self.observed % DECAY_EVERY == 0:
+            self.__decay__()
+
+    def __decay__(self):
+        # Caller holds self.lock. Halve every count, so recent choices outweigh old ones
+        for name, entry in list(self.popularity.items()):
+            entry[0] //= 2
+            if not entry[0]:
+                del self.popularity[name]
+
+    def __expire__(self, now):
+        # Caller holds self.lock
+        while self.ready:
+            key, (finished_at, seconds) = next(iter(self.ready.items()))
+            if now - finished_at <= self.claim_window:
+                break
+            del self.ready[key]
+            self.__waste__(seconds)
+
+    def __waste__(self, seconds):
+        # Caller holds self.lock
+        self.counters['wasted'] += 1
+        self.counters['wasted_seconds'] += seconds
+
+    def stats(self):
+        with self.lock:
+            self.__expire__(time.monotonic())
+            counters = {**self.counters, 'top_n': self.top_n, 'styles': len(self.popularity),
+                        'running': len(self.running), 'ready': len(self.ready)}
+        resolved = counters['hits'] + counters['wasted']
+        counters['hit_ratio'] = counters['hits'] / resolved if resolved else 0.0
+        compute = counters['useful_seconds'] + counters['wasted_seconds']
+        counters['wasted_compute_ratio'] = counters['wasted_seconds'] / compute if compute else 0.0
+        return counters
@@ -0,0 +1,250 @@
+# server_store.py
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+
+HEX_KEY = re.compile(r'[0-9a-f]{64}')  # sha256 hex digest: the only keys DiskSpill turns into file names
+
+
+def is_hex_key(key):
+    return isinstance(key, str) and HEX_KEY.fullmatch(key) is not None
+
+
+class DiskSpill:
+    """
+    Optional second tier for BoundedStore: entries evicted from memory are written to a
+    directory and read back (and promoted to memory again) on the next access.
+    Files idle for longer than ttl seconds are purged.
+    Keys must be sha256 hex digests (is_hex_key); anything else is refused before touching the filesystem.
+    """
+    def __init__(self, directory, ttl=None, dump=None, load=None, suffix='.pkl'):
+        self.directory = directory
+        self.ttl = ttl
+        self.dump = dump or (lambda value, f: pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL))
+        self.load = load or pickle.load
+        self.suffix = suffix
+        self.last_purge = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def __path__(self, key):
+        if not is_hex_key(key):
+            raise ValueError(f"Invalid spill key: {key!r}")
+        return os.path.join(self.directory, f"{key}{self.suffix}")
+
+    def save(self, key, value):
+        path = self.__path__(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            self.dump(value, f)
+        os.replace(tmp_path, path)  # Readers never see a half-written file
+
+    def restore(self, key, keep=False):
+        """
+        Read an entry back.
+        :param keep: Leave the file in place (write-through caches); by default it is removed,
+                     since the entry is back in memory and gets spilled again if evicted again.
+        """
+        try:
+            with open(self.__path__(key), "rb") as f:
+                value = self.load(f)
+        except FileNotFoundError:
+            return None
+        if keep:
+            os.utime(self.__path__(key))  # Counts as an access for purge_expired
+        else:
+            os.remove(self.__path__(key))
+        return value
+
+    def contains(self, key):
+        return os.path.exists(self.__path__(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.__path__(key))
+        except FileNotFoundError:
+            pass
+
+    def purge_expired(self):
+        # Scanning the directory is not free, so do it at most ~10 times per TTL period
+        if self.ttl is None or time.monotonic() - self.last_purge < self.ttl / 10:
+            return 0
+        self.last_purge = time.monotonic()
+        purged = 0
+        cutoff = time.time() - self.ttl
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    purged += 1
+            except FileNotFoundError:
+                pass
+        return purged
+
+
+class BoundedStore:
+    """
+    Thread-safe, memory-bounded key/value store with LRU + idle-TTL eviction.
+    Every entry is charged sizeof(value) bytes against max_bytes; when the budget is exceeded
+    the least recently used entries are dropped (or moved to the DiskSpill, if given).
+    can_evict(value) may veto eviction of entries that are still in use (e.g. running tasks);
+    they stay in memory, over budget if necessary, until they become evictable.
+    Spill files are written outside the lock; until one is, its entry is still served from memory.
+    """
+    def __init__(self, max_bytes, ttl=None, max_entries=None, sizeof=None, can_evict=None, spill=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl  # Seconds since last access; None disables expiry
+        self.max_entries = max_entries
+        self.sizeof = sizeof or (lambda value: 0)
+        self.can_evict = can_evict or (lambda value: True)
+        self.spill = spill
+        self.entries = OrderedDict()  # key: [value, size, last_access], least recently used first
+        self.spilling = {}  # key: value evicted to the spill whose file isn't written yet
+        self.spill_lock = threading.Lock()  # One spill write at a time, so a key's newest copy lands last
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'spills': 0, 'spill_hits': 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def has(self, key):
+        """
+        Whether key is stored, in memory or spilled, without counting an access or restoring it.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and not self.__expired__(entry, time.monotonic()):
+                return True
+            if key in self.spilling:
+                return True
+        return self.spill is not None and self.spill.contains(key)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.__expired__(entry, now):
+                self.__remove__(key)
+                self.counters['expirations'] += 1
+                entry = None
+            if entry is not None:
+                entry[2] = now
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return entry[0]
+            value = self.spilling.get(key)  # Evicted, but its spill file isn't written yet
+            if value is not None:
+                self.counters['hits'] += 1
+        if value is None:
+            value = self.spill.restore(key) if self.spill is not None else None
+            with self.lock:
+                if value is None:
+                    self.counters['misses'] += 1
+                    return default
+                self.counters['spill_hits'] += 1
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        """
+        Insert or replace an entry; also used to re-account an entry whose size changed.
+        """
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self.__remove__(key)
+            self.entries[key] = [value, size, time.monotonic()]
+            self.total_bytes += size
+            spilled = self.__enforce_limits__()
+        if spilled:
+            self.__spill__(spilled)
+        if self.spill is not None:
+            self.spill.purge_expired()
+
+    def __spill__(self, spilled):
+        # Write evicted entries to the spill. Each stays in self.spilling (and is served from there)
+        # until its file is in place; a file outdated meanwhile (entry set again, read back into memory,
+        # popped, or spilled again) is removed, so the spill never holds an older copy than memory
+        with self.spill_lock:
+            for key, value in spilled:
+                with self.lock:
+                    if self.spilling.get(key) is not value:
+                        continue  # Popped, or spilled again since: that write covers it
+                    if key in self.entries:
+                        del self.spilling[key]  # Back in memory: nothing to write
+                        continue
+                self.spill.save(key, value)
+                with self.lock:
+                    current = self.spilling.get(key) is value
+                    if current:
+                        del self.spilling[key]
+                    if not current or key in self.entries:
+                        self.spill.delete(key)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.__remove__(key)
+            spilling = self.spilling.pop(key, None)
+        if self.spill is not None:
+            self.spill.delete(key)
+        if entry is not None:
+            return entry[0]
+        return spilling if spilling is not None else default
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, 'entries': len(self.entries), 'bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes}
+
+    def __expired__(self, entry, now):
+        return self.ttl is not None and now - entry[2] > self.ttl and self.can_evict(entry[0])
+
+    def __remove__(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+
+    def __enforce_limits__(self):
+        # Caller must hold self.lock. Returns the (key, value) pairs to write to the spill.
+        now = time.monotonic()
+        total_bytes, count = self.total_bytes, len(self.entries)
+        victims = []
+        for key, entry in self.entries.items():
+            over_budget = total_bytes > self.max_bytes or (self.max_entries is not None and count > self.max_entries)
+            idle = self.ttl is not None and now - entry[2] > self.ttl
+            if not over_budget and not idle:
+                break  # LRU order: every later entry was used more recently
+            if not self.can_evict(entry[0]):
+                continue
+            victims.append((key, entry[0], idle))
+            total_bytes -= entry[1]
+            count -= 1
+        spilled = []
+        for key, value, idle in victims:
+            self.__remove__(key)
+            if idle:
+                self.counters['expirations'] += 1
+            else:
+                self.counters['evictions'] += 1
+                if self.spill is not None:
+                    self.spilling[key] = value
+                    spilled.append((key, value))
+                    self.counters['spills'] += 1
+        return spilled
@@ -0,0 +1,104 @@
+# server_task_records.py
+# Bookkeeping of the tasks running in this process, built for many status reads while workers report progress:
+# - TaskSnapshot: immutable, versioned view of a task's changing fields. Writers build the next one and
+#   swap it in with a single attribute store; readers load that attribute without any lock and always
+#   see a state / progress / result combination that actually existed.
+# - LiveTask: __slots__ record of one task (instead of a dict, a lock and four closures per task).
+# - TaskTable: task_id -> LiveTask over a fixed number of shards. Lookups take no lock (a dict read is
+#   atomic); adds and removals lock their shard, whose lock also orders the writes of its tasks (lock striping).
+from collections import namedtuple
+
+from server_metrics import InstrumentedLock
+
+DEFAULT_SHARDS = 64  # Power of two
+
+
+class RecordView:
+    """
+    Mixin for namedtuple records that read like dict records (record['state'], record.get('preview_seq')),
+    so code written against one serves the other.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return getattr(self, key) if isinstance(key, str) else super().__getitem__(key)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+
+class TaskSnapshot(RecordView, namedtuple('TaskSnapshot', ('id', 'version', 'state', 'progress', 'error', 'result',
+                                                           'preview', 'preview_seq'))):
+    """
+    One version of a live task's state; status_of takes it like a state backend record.
+    """
+    __slots__ = ()
+
+    def next(self, **fields):
+        return self._replace(version=self.version + 1, **fields)
+
+
+class LiveTask:
+    """
+    A task submitted to this process, from admission until its final state is stored.
+    snapshot is the only field readers need; everything else is the manager's.
+    """
+    __slots__ = ('id', 'pool', 'backend', 'snapshot', 'lock', 'job', 'on_done', 'cancel_event', 'cancel_requested_at',
+                 'future', 'submitted_at', 'dispatched_at')
+
+    def __init__(self, task_id, pool, backend, lock, job, on_done, submitted_at):
+        self.id = task_id
+        self.pool = pool
+        self.backend = backend
+        self.snapshot = TaskSnapshot(task_id, 0, 'PENDING', 0, None, None, None, 0)
+        self.lock = lock  # Shared with the other tasks of its TaskTable shard; held by writers only
+        self.job = job  # (fn, args, kwargs)
+        self.on_done = on_done
+        self.cancel_event = None  # Created when the task is handed to its backend: queued tasks don't need one
+        self.cancel_requested_at = None
+        self.future = None
+        self.submitted_at = submitted_at
+        self.dispatched_at = None
+
+    def update(self, **fields):
+        """
+        Swap in the next snapshot. Caller holds self.lock.
+        :return: The new snapshot.
+        """
+        self.snapshot = self.snapshot.next(**fields)
+        return self.snapshot
+
+
+class TaskTable:
+    """
+    task_id -> LiveTask, sharded by the ID's hash.
+    """
+    def __init__(self, shards=DEFAULT_SHARDS):
+        self.mask = shards - 1
+        self.shards = [{} for _ in range(shards)]
+        self.locks = [InstrumentedLock('task_table') for _ in range(shards)]  # Waits go to /metrics
+
+    def lock_for(self, task_id):
+        return self.locks[hash(task_id) & self.mask]
+
+    def get(self, task_id):
+        return self.shards[hash(task_id) & self.mask].get(task_id)
+
+    def __contains__(self, task_id):
+        return task_id in self.shards[hash(task_id) & self.mask]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def add(self, task):
+        index = hash(task.id) & self.mask
+        with self.locks[index]:
+            self.shards[index][task.id] = task
+
+    def pop(self, task_id):
+        index = hash(task_id) & self.mask
+        with self.locks[index]:
+            return self.shards[index].pop(task_id, None)
+
+    def ids(self):
+        return [task_id for shard in self.shards for task_id in list(shard)]
@@ -0,0 +1,561 @@
+# server_task_state.py
+# Where task records live, so any replica can answer /status, /result and /cancel for a task another
+# replica accepted (no sticky sessions). Pick one with make_task_state(url):
+#   'memory'                      this process only (the default; one uvicorn worker)
+#   'sqlite:///tasks.db'          shared by all workers on one host (uvicorn --workers N); 'sqlite:////abs/tasks.db'
+#   'redis://host:6379/0'         shared across hosts; any RESP server (see server_resp_stub.py for a local stand-in)
+# Every backend offers:
+#   create(record, idempotency_key, lease) -> task_id    the existing task's ID if the key was seen before
+#   update(task_id, **fields), set_progress(updates), get(task_id) -> record or None, delete(task_id)
+#   finish(task_id, owner, **fields) -> bool     final state, only from the task's current owner
+#   put_blob(task_id, name, data), get_blob(task_id, name)   results, previews and job specs, stored out of line
+#   renew(owner, task_ids, lease) -> task_ids with a cancel request   heartbeat of the owning replica
+#   request_cancel(task_id), claim_expired(owner, lease) -> records whose owner stopped renewing
+#   purge(), stats(), close()
+# Records are read-only mappings (dicts, or MemoryRecord) of JSON values: id, state, progress, error, pool, owner, attempts, result (inline JSON
+# results), result_mime / result_digest (binary results, in blob 'result'), cancel_requested, and
+# preview_seq / preview_mime (latest preview of a running task, in blob 'preview', dropped once it finishes).
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlparse
+
+from server_store import BoundedStore
+from server_task_records import RecordView
+
+FINISHED_STATES = ('COMPLETED', 'FAILED', 'CANCELED')
+TASK_OVERHEAD_BYTES = 1024  # Rough cost of a record
+RECORD_FIELDS = ('id', 'state', 'progress', 'error', 'pool', 'owner', 'attempts', 'result', 'result_mime',
+                 'result_digest', 'cancel_requested', 'preview_seq', 'preview_mime', 'created_at', 'updated_at')
+
+
+class MemoryRecord(RecordView, namedtuple('MemoryRecord', (*RECORD_FIELDS, 'lease_expires'),
+                                          defaults=(None,) * (len(RECORD_FIELDS) + 1))):
+    """
+    A MemoryTaskState record. Immutable: updates swap in a new one, so get() hands it out as is,
+    without a lock or a copy.
+    """
+    __slots__ = ()
+
+
+class MemoryEntry:
+    __slots__ = ('record', 'blobs')
+
+    def __init__(self, record):
+        self.record = record
+        self.blobs = None  # {name: bytes}, once the task has any
+
+
+class MemoryTaskState:
+    """
+    Records in this process' memory. Finished tasks (and their results) are evicted LRU once over
+    max_bytes, or ttl seconds after last being read; running tasks are never evicted.
+    Not shared, so TaskManager skips heartbeats and progress writes for it.
+    """
+    kind = 'memory'
+    shared = False
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, ttl=3600):
+        # task_id: MemoryEntry
+        self.tasks = BoundedStore(max_bytes, ttl=ttl, sizeof=self.__sizeof_entry__,
+                                  can_evict=lambda entry: entry.record.state in FINISHED_STATES)
+        self.idempotency = BoundedStore(max_bytes, ttl=ttl, max_entries=100000)  # key: task_id
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def __sizeof_entry__(entry):
+        result = entry.record.result
+        return (TASK_OVERHEAD_BYTES + sum(len(data) for data in (entry.blobs or {}).values())
+                + (len(result) if isinstance(result, str) else 0))
+
+    def create(self, record, idempotency_key=None, lease=None):
+        with self.lock:
+            if idempotency_key is not None:
+                existing = self.idempotency.get(idempotency_key)
+                if existing is not None and existing in self.tasks:
+                    return existing
+                self.idempotency[idempotency_key] = record['id']
+            now = time.time()
+            self.tasks[record['id']] = MemoryEntry(MemoryRecord(**{
+                'cancel_requested': False, 'created_at': now, 'updated_at': now,
+                **{name: value for name, value in record.items() if name in RECORD_FIELDS},
+                'lease_expires': now + (lease or 0)}))
+        return record['id']
+
+    def update(self, task_id, **fields):
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is None:
+                return
+            entry.record = entry.record._replace(**self.__fields__(fields), updated_at=time.time())
+            self.tasks.set(task_id, entry)  # Re-account its size (the result may be attached now)
+
+    def finish(self, task_id, owner, **fields):
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is None or entry.record.owner != owner or entry.record.state in FINISHED_STATES:
+                return False
+        self.update(task_id, **fields)
+        return True
+
+    def set_progress(self, updates):
+        for task_id, fields in updates.items():
+            with self.lock:
+                entry = self.tasks.get(task_id)
+                if entry is not None and entry.record.state not in FINISHED_STATES:
+                    entry.record = entry.record._replace(**self.__fields__(fields))
+
+    @staticmethod
+    def __fields__(fields):
+        return {name: value for name, value in fields.items() if name in RECORD_FIELDS}
+
+    def get(self, task_id):
+        entry = self.tasks.get(task_id)
+        return entry.record if entry is not None else None
+
+    def delete(self, task_id):
+        self.tasks.pop(task_id)
+
+    def put_blob(self, task_id, name, data):
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is not None:
+                entry.blobs = {**(entry.blobs or {}), name: data}  # Kept by reference: results aren't copied
+                self.tasks.set(task_id, entry)
+
+    def get_blob(self, task_id, name):
+        entry = self.tasks.get(task_id)
+        return entry.blobs.get(name) if entry is not None and entry.blobs is not None else None
+
+    def renew(self, owner, task_ids, lease):
+        expires = time.time() + lease
+        canceled = []
+        with self.lock:
+            for task_id in task_ids:
+                entry = self.tasks.get(task_id)
+                if entry is not None and entry.record.owner == owner:
+                    entry.record = entry.record._replace(lease_expires=expires)
+                    if entry.record.cancel_requested:
+                        canceled.append(task_id)
+        return canceled
+
+    def request_cancel(self, task_id):
+        self.update(task_id, cancel_requested=True)
+
+    def claim_expired(self, owner, lease):
+        return []  # Only this process ever sees these records, and it doesn't outlive itself
+
+    def purge(self):
+        pass  # BoundedStore expires entries as it goes
+
+    def stats(self):
+        return {'backend': self.kind, **self.tasks.stats()}
+
+    def close(self):
+        pass
+
+
+class SqliteTaskState:
+    """
+    Records in one SQLite file (WAL mode), so every worker process on the host sees the same tasks.
+    Blobs go to their own table, so reading a status never loads a result.
+    Finished tasks are deleted ttl seconds after they finished (purge()).
+    """
+    kind = 'sqlite'
+    shared = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            id TEXT PRIMARY KEY, idempotency_key TEXT UNIQUE, state TEXT NOT NULL, progress REAL DEFAULT 0,
+            error TEXT, pool TEXT, owner TEXT, attempts INTEGER DEFAULT 1, result TEXT, result_mime TEXT,
+            result_digest TEXT, cancel_requested INTEGER DEFAULT 0, preview_seq INTEGER DEFAULT 0,
+            preview_mime TEXT, lease_expires REAL, created_at REAL, updated_at REAL);
+        CREATE INDEX IF NOT EXISTS tasks_by_state ON tasks (state, lease_expires);
+        CREATE TABLE IF NOT EXISTS blobs (task_id TEXT, name TEXT, data BLOB, PRIMARY KEY (task_id, name));
+    """
+
+    def __init__(self, path, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()  # One connection per thread
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.__connection__().executescript(self.SCHEMA)
+        self.__migrate__()
+
+    def __migrate__(self):
+        # Databases created by an older version lack the newer columns
+        connection = self.__connection__()
+        columns = {row['name'] for row in connection.execute("PRAGMA table_info(tasks)")}
+        for column, definition in (('preview_seq', 'INTEGER DEFAULT 0'), ('preview_mime', 'TEXT')):
+            if column not in columns:
+                try:
+                    connection.execute(f"ALTER TABLE tasks ADD COLUMN {column} {definition}")
+                except sqlite3.OperationalError:
+                    pass  # Added by another worker meanwhile
+
+    def __connection__(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # Autocommit: every statement is its own (short) transaction; busy writers wait up to 30s
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")  # Readers don't block the writer
+            connection.execute("PRAGMA synchronous=NORMAL")  # No fsync per commit; a crash may lose the last ones
+            connection.row_factory = sqlite3.Row
+            self.local.connection = connection
+        return connection
+
+    @staticmethod
+    def __record__(row):
+        record = {name: row[name] for name in RECORD_FIELDS}
+        record['result'] = json.loads(record['result']) if record['result'] is not None else None
+        record['cancel_requested'] = bool(record['cancel_requested'])
+        return record
+
+    def create(self, record, idempotency_key=None, lease=None):
+        now = time.time()
+        row = {**record, 'result': json.dumps(record.get('result')), 'idempotency_key': idempotency_key,
+               'lease_expires': now + (lease or 0), 'created_at': now, 'updated_at': now}
+        names = [name for name in (*RECORD_FIELDS, 'idempotency_key', 'lease_expires') if name in row]
+        inserted = self.__connection__().execute(
+            f"INSERT INTO tasks ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) "
+            f"ON CONFLICT (idempotency_key) DO NOTHING", [row[name] for name in names]).rowcount
+        if inserted:
+            return record['id']
+        existing = self.__connection__().execute("SELECT id FROM tasks WHERE idempotency_key = ?",
+                                                 (idempotency_key,)).fetchone()
+        return existing['id'] if existing is not None else self.create(record, idempotency_key, lease)
+
+    def update(self, task_id, **fields):
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'])
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{name} = ?" for name in fields if name in RECORD_FIELDS)
+        self.__connection__().execute(f"UPDATE tasks SET {assignments} WHERE id = ?",
+                                      [*(value for name, value in fields.items() if name in RECORD_FIELDS), task_id])
+
+    def finish(self, task_id, owner, **fields):
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'])
+        fields['updated_at'] = time.time()
+        connection = self.__connection__()
+        finished = bool(connection.execute(
+            f"UPDATE tasks SET {', '.join(f'{name} = ?' for name in fields)} "
+            f"WHERE id = ? AND owner = ? AND state NOT IN ('COMPLETED', 'FAILED', 'CANCELED')",
+            [*fields.values(), task_id, owner]).rowcount)
+        if finished:
+            connection.execute("DELETE FROM blobs WHERE task_id = ? AND name = 'preview'", (task_id,))
+        return finished
+
+    def set_progress(self, updates):
+        # One transaction for the whole batch; finished tasks are left alone (a final state always wins)
+        connection = self.__connection__()
+        with connection:
+            connection.execute("BEGIN")
+            connection.executemany(
+                "UPDATE tasks SET state = ?, progress = ?, preview_seq = COALESCE(?, preview_seq), "
+                "preview_mime = COALESCE(?, preview_mime) "
+                "WHERE id = ? AND state NOT IN ('COMPLETED', 'FAILED', 'CANCELED')",
+                [(fields['state'], fields['progress'], fields.get('preview_seq'), fields.get('preview_mime'), task_id)
+                 for task_id, fields in updates.items()])
+
+    def get(self, task_id):
+        row = self.__connection__().execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return self.__record__(row) if row is not None else None
+
+    def delete(self, task_id):
+        connection = self.__connection__()
+        connection.execute("DELETE FROM blobs WHERE task_id = ?", (task_id,))
+        connection.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+
+    def put_blob(self, task_id, name, data):
+        self.__connection__().execute("INSERT OR REPLACE INTO blobs (task_id, name, data) VALUES (?, ?, ?)",
+                                      (task_id, name, sqlite3.Binary(data)))
+
+    def get_blob(self, task_id, name):
+        row = self.__connection__().execute("SELECT data FROM blobs WHERE task_id = ? AND name = ?",
+                                            (task_id, name)).fetchone()
+        return bytes(row['data']) if row is not None else None
+
+    def renew(self, owner, task_ids, lease):
+        if not task_ids:
+            return []
+        connection = self.__connection__()
+        placeholders = ', '.join('?' * len(task_ids))
+        connection.execute(f"UPDATE tasks SET lease_expires = ? WHERE owner = ? AND id IN ({placeholders})",
+                           [time.time() + lease, owner, *task_ids])
+        rows = connection.execute(f"SELECT id FROM tasks WHERE owner = ? AND cancel_requested = 1 "
+                                  f"AND id IN ({placeholders})", [owner, *task_ids]).fetchall()
+        return [row['id'] for row in rows]
+
+    def request_cancel(self, task_id):
+        self.update(task_id, cancel_requested=1)
+
+    def claim_expired(self, owner, lease):
+        connection = self.__connection__()
+        now = time.time()
+        rows = connection.execute("SELECT id FROM tasks WHERE state IN ('PENDING', 'PROGRESS') AND lease_expires < ?",
+                                  (now,)).fetchall()
+        claimed = []
+        for row in rows:
+            # Compare-and-set on the lease: of several replicas reaping at once, exactly one wins
+            if connection.execute("UPDATE tasks SET owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                                  "WHERE id = ? AND lease_expires < ?", (owner, now + lease, row['id'], now)).rowcount:
+                claimed.append(self.get(row['id']))
+        return claimed
+
+    def purge(self):
+        connection = self.__connection__()
+        cutoff = time.time() - self.ttl
+        with connection:
+            connection.execute("BEGIN")
+            connection.execute("DELETE FROM blobs WHERE task_id IN (SELECT id FROM tasks WHERE updated_at < ? "
+                               "AND state IN ('COMPLETED', 'FAILED', 'CANCELED'))", (cutoff,))
+            connection.execute("DELETE FROM tasks WHERE updated_at < ? "
+                               "AND state IN ('COMPLETED', 'FAILED', 'CANCELED')", (cutoff,))
+
+    def stats(self):
+        rows = self.__connection__().execute("SELECT state, COUNT(*) AS n FROM tasks GROUP BY state").fetchall()
+        return {'backend': self.kind, 'entries': sum(row['n'] for row in rows),
+                **{f"state_{row['state'].lower()}": row['n'] for row in rows}}
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+class RespError(Exception):
+    """Error reply from a RESP server."""
+
+
+class RespClient:
+    """
+    Minimal client for the Redis protocol (RESP2): just what RespTaskState needs, so a shared
+    backend needs no extra dependency. One connection per thread; pipeline() sends a batch of
+    commands in one round trip.
+    """
+    def __init__(self, host='localhost', port=6379, db=0, timeout=5.0):
+        self.address = (host, port)
+        self.db = db
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def __connection__(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            sock = socket.create_connection(self.address, timeout=self.timeout)
+            connection = self.local.connection = (sock, sock.makefile('rb'))
+            if self.db:
+                self.__send__([('SELECT', self.db)])
+        return connection
+
+    @staticmethod
+    def __encode__(command):
+        parts = [f"*{len(command)}\r\n".encode()]
+        for arg in command:
+            data = arg if isinstance(arg, (bytes, memoryview)) else str(arg).encode('utf-8')
+            parts += [f"${len(data)}\r\n".encode(), data, b"\r\n"]
+        return b"".join(parts)
+
+    def __read__(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("RESP server closed the connection")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode('utf-8')
+        if kind == b'-':
+            return RespError(payload.decode('utf-8'))
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(payload)
+            return None if length < 0 else [self.__read__(reader) for _ in range(length)]
+        raise RespError(f"Unexpected reply {line!r}")
+
+    def __send__(self, commands):
+        sock, reader = self.__connection__()
+        try:
+            sock.sendall(b"".join(self.__encode__(command) for command in commands))
+            replies = [self.__read__(reader) for _ in commands]
+        except (OSError, ConnectionError):
+            self.local.connection = None  # Reconnect next time
+            sock.close()
+            raise
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def execute(self, *command):
+        return self.__send__([command])[0]
+
+    def pipeline(self, commands):
+        return self.__send__(commands) if commands else []
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection[0].close()
+            self.local.connection = None
+
+
+class RespTaskState:
+    """
+    Records in a Redis-protocol server, shared by any number of hosts.
+    Keys (under prefix): task:<id> hash of JSON-encoded fields, blob:<id>:<name>, idem:<key> -> id,
+    lease:<id> -> owner with a TTL (the lease is alive while the key exists), and the set 'active'
+    of unfinished task IDs that claim_expired scans. Finished tasks expire ttl seconds after finishing.
+    """
+    kind = 'resp'
+    shared = True
+
+    def __init__(self, client, ttl=3600, prefix='hairsfe:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def __key__(self, *parts):
+        return self.prefix + ':'.join(parts)
+
+    @staticmethod
+    def __record__(values):
+        if not values:
+            return None
+        fields = dict(zip(values[::2], values[1::2]))
+        return {name: json.loads(fields[name.encode()]) if name.encode() in fields else None
+                for name in RECORD_FIELDS}
+
+    def create(self, record, idempotency_key=None, lease=None):
+        task_id = record['id']
+        if idempotency_key is not None:
+            if not self.client.execute('SET', self.__key__('idem', idempotency_key), task_id, 'NX', 'EX', self.ttl):
+                existing = self.client.execute('GET', self.__key__('idem', idempotency_key))
+                if existing is not None and self.client.execute('EXISTS', self.__key__('task', existing.decode())):
+                    return existing.decode()
+                self.client.execute('SET', self.__key__('idem', idempotency_key), task_id, 'EX', self.ttl)
+        now = time.time()
+        fields = {'cancel_requested': False, 'created_at': now, 'updated_at': now, **record}
+        self.client.pipeline([
+            ('HSET', self.__key__('task', task_id), *(item for name, value in fields.items()
+                                                      for item in (name, json.dumps(value)))),
+            ('SET', self.__key__('lease', task_id), record.get('owner') or '', 'PX', int((lease or 0) * 1000) or 1),
+            ('SADD', self.__key__('active'), task_id),
+        ])
+        return task_id
+
+    def update(self, task_id, **fields):
+        fields['updated_at'] = time.time()
+        commands = [('HSET', self.__key__('task', task_id), *(item for name, value in fields.items()
+                                                              for item in (name, json.dumps(value))))]
+        if fields.get('state') in FINISHED_STATES:
+            commands += [('SREM', self.__key__('active'), task_id),
+                         ('DEL', self.__key__('lease', task_id)),
+                         ('EXPIRE', self.__key__('task', task_id), self.ttl),
+                         ('EXPIRE', self.__key__('blob', task_id, 'result'), self.ttl),
+                         ('DEL', self.__key__('blob', task_id, 'job'), self.__key__('blob', task_id, 'preview'))]
+        self.client.pipeline(commands)
+
+    def finish(self, task_id, owner, **fields):
+        # Check-then-set, not atomic: a reclaim landing in between is not caught (leases make that rare)
+        current_owner, state = self.client.execute('HMGET', self.__key__('task', task_id), 'owner', 'state')
+        if current_owner is None or json.loads(current_owner) != owner or json.loads(state) in FINISHED_STATES:
+            return False
+        self.update(task_id, **fields)
+        return True
+
+    def set_progress(self, updates):
+        # Only tasks still marked active: a final state written meanwhile always wins
+        task_ids = list(updates)
+        active = self.client.pipeline([('SISMEMBER', self.__key__('active'), task_id) for task_id in task_ids])
+        self.client.pipeline([('HSET', self.__key__('task', task_id), *(item for name, value in updates[task_id].items()
+                                                                        for item in (name, json.dumps(value))))
+                              for task_id, is_active in zip(task_ids, active) if is_active])
+
+    def get(self, task_id):
+        return self.__record__(self.client.execute('HGETALL', self.__key__('task', task_id)))
+
+    def delete(self, task_id):
+        self.client.pipeline([('DEL', self.__key__('task', task_id), self.__key__('lease', task_id),
+                               self.__key__('blob', task_id, 'result'), self.__key__('blob', task_id, 'job'),
+                               self.__key__('blob', task_id, 'preview')),
+                              ('SREM', self.__key__('active'), task_id)])
+
+    def put_blob(self, task_id, name, data):
+        self.client.execute('SET', self.__key__('blob', task_id, name), bytes(data))
+
+    def get_blob(self, task_id, name):
+        return self.client.execute('GET', self.__key__('blob', task_id, name))
+
+    def renew(self, owner, task_ids, lease):
+        if not task_ids:
+            return []
+        replies = self.client.pipeline([command for task_id in task_ids for command in (
+            ('GET', self.__key__('lease', task_id)), ('HGET', self.__key__('task', task_id), 'cancel_requested'))])
+        lease_ms = int(lease * 1000)
+        # Extend our own leases (and re-take lapsed ones nobody claimed yet)
+        self.client.pipeline([('SET', self.__key__('lease', task_id), owner, 'PX', lease_ms)
+                              for task_id, holder in zip(task_ids, replies[::2])
+                              if holder is None or holder.decode() == owner])
+        return [task_id for task_id, canceled in zip(task_ids, replies[1::2])
+                if canceled is not None and json.loads(canceled)]
+
+    def request_cancel(self, task_id):
+        self.client.execute('HSET', self.__key__('task', task_id), 'cancel_requested', json.dumps(True))
+
+    def claim_expired(self, owner, lease):
+        task_ids = [task_id.decode() for task_id in self.client.execute('SMEMBERS', self.__key__('active'))]
+        alive = self.client.pipeline([('EXISTS', self.__key__('lease', task_id)) for task_id in task_ids])
+        claimed = []
+        for task_id, is_alive in zip(task_ids, alive):
+            if is_alive or not self.client.execute('SET', self.__key__('lease', task_id), owner, 'NX',
+                                                   'PX', int(lease * 1000)):
+                continue  # Still leased, or another replica just claimed it
+            record = self.get(task_id)
+            if record is None or record['state'] in FINISHED_STATES:
+                self.client.pipeline([('SREM', self.__key__('active'), task_id),
+                                      ('DEL', self.__key__('lease', task_id))])
+                continue
+            self.client.pipeline([('HSET', self.__key__('task', task_id), 'owner', json.dumps(owner)),
+                                  ('HINCRBY', self.__key__('task', task_id), 'attempts', 1)])
+            claimed.append(self.get(task_id))
+        return claimed
+
+    def purge(self):
+        pass  # Finished records carry a TTL
+
+    def stats(self):
+        return {'backend': self.kind, 'state_active': self.client.execute('SCARD', self.__key__('active'))}
+
+    def close(self):
+        self.client.close()
+
+
+def make_task_state(url='memory', max_bytes=256 * 1024 * 1024, ttl=3600):
+    """
+    :param url: 'memory', 'sqlite:///<path>' (relative; 'sqlite:////<path>' for an absolute one) or
+                'redis://<host>:<port>/<db>'.
+    :param max_bytes: Memory budget of the 'memory' backend.
+    :param ttl: Seconds finished tasks are kept.
+    """
+    parsed = urlparse(url or 'memory')
+    if parsed.scheme in ('', 'memory'):
+        return MemoryTaskState(max_bytes, ttl=ttl)
+    if parsed.scheme == 'sqlite':
+        path = url.split('://', 1)[1]  # As written: urlparse would make 'sqlite:///rel.db' absolute
+        return SqliteTaskState(path[1:] if path.startswith('/') else path, ttl=ttl)
+    if parsed.scheme in ('redis', 'resp'):
+        db = int(parsed.path.lstrip('/') or 0)
+        return RespTaskState(RespClient(parsed.hostname or 'localhost', parsed.port or 6379, db), ttl=ttl)
+    raise ValueError(f"Unknown task state backend '{url}'")
@@ -1,113 +1,664 @@
 # server_tasks.py
 import concurrent.futures
+import functools
+import json
+import os
+import socket
 import threading
 import uuid
 import time  # If needed for simulation
 
+from server_admission import AdmissionQueue, QueueFullError
+from server_executors import TaskRevokedError, make_backend
+from server_images import ImageResult
+from server_metrics import (CANCEL_SECONDS, PHASE_SECONDS, TASK_SECONDS, TASKS_ACTIVE, TASKS_FINISHED,
+                            TASKS_PENDING, span)
+from server_model_haircolor import ModelHairColor
+from server_model_hair_reshape import ModelHairReshape
 from server_model_hairtransfer import ModelHairTransfer
-from old_test_server.server_model_profile import ModelProfile
+from server_registry import ModelRegistry
+from server_model_profile import ModelProfile
+from server_sources import check_source_id
+from server_task_records import LiveTask, TaskTable
+from server_task_state import FINISHED_STATES, MemoryTaskState
 
-# Registry for models (expand as needed)
-MODEL_REGISTRY = {
-    'model_ht': ModelHairTransfer(),
-    'model_profile': ModelProfile(),  # Placeholder for other models
+# Registry for models (expand as needed). Models are built on first use or by
+# MODEL_REGISTRY.warm_up(), so importing this module stays cheap.
+MODEL_REGISTRY = ModelRegistry({
+    'model_ht': ModelHairTransfer,
+    'model_profile': ModelProfile,  # Placeholder for other models
+    'model_haircolor': ModelHairColor,
+    'model_hair_reshape': ModelHairReshape,
+})
+
+# Worker pool per model, so one slow model can't starve the others.
+# 'thread' suits blocking I/O and GPU inference that releases the GIL; 'process' gives CPU-bound
+# models their own interpreters, with the model loaded once per worker; 'async' runs the model's
+# run_async on the shared event loop, so remote jobs don't hold a worker while they wait.
+# 'batch' collects jobs for up to max_wait seconds (up to max_batch_size, grouped by a params key)
+# and runs them through the model's run_batch.
+# Every pool sits behind an AdmissionQueue: max_queue jobs may wait (more are rejected with 429), and
+# max_inflight (default: what the backend can run at once) are handed to the backend.
+EXECUTOR_CONFIG = {
+    'model_ht': {'kind': 'batch', 'max_workers': 2, 'max_batch_size': 8, 'max_wait': 0.05,
+                 'group_by': 'source_image_id', 'max_queue': 256},
+    'model_profile': {'kind': 'async', 'max_queue': 256, 'max_inflight': 32},
+    # Colours for one source are batched: one hair mask, one vectorized recolour for all of them
+    'model_haircolor': {'kind': 'batch', 'max_workers': 2, 'max_batch_size': 16, 'max_wait': 0.02,
+                        'group_by': 'source_image_id', 'max_queue': 256},
+    # CPU-bound per job (mask decode, NumPy edit and blend, JPEG encode) with nothing shared between jobs:
+    # worker processes, so concurrent edits don't queue on the GIL
+    'model_hair_reshape': {'kind': 'process', 'max_workers': 2, 'max_queue': 64},
 }
+DEFAULT_EXECUTOR = {'kind': 'thread', 'max_workers': 4, 'max_queue': 64}  # Pool for anything submitted without a known pool
+DEFAULT_MAX_QUEUE = 64
+ASYNC_MAX_INFLIGHT = 64  # Async jobs are cheap to hold; the remote client's own limits still apply
+
+# A canceled job that hasn't stopped after this many seconds is reported canceled anyway and its
+# admission slot is given to the next job; whatever it returns later is discarded
+CANCEL_DEADLINE_SECONDS = 5.0
+# Shared state backends only: how often progress is written out, leases renewed, cancel requests from
+# other replicas picked up and orphaned tasks reclaimed; a replica silent for LEASE_SECONDS is presumed dead
+SYNC_SECONDS = 0.5
+LEASE_SECONDS = 15.0
+MAX_TASK_ATTEMPTS = 2  # Runs of one task, counting reruns after its replica died
+PURGE_SECONDS = 60.0
 
-class TaskRevokedError(Exception):
-    pass
+def status_of(record, position=None):
+    """
+    Client-facing status of a task record (a live task's snapshot or a state backend record).
+    :param position: Admission queue position of a pending task, if known.
+    """
+    state = record['state']
+    if state == 'PENDING':
+        return {'status': 'Pending', 'progress': 0, 'done': False, **(position or {})}
+    elif state == 'PROGRESS':
+        status = {'status': 'In Progress', 'progress': record['progress'], 'done': False}
+        if record.get('preview_seq'):
+            # Latest low-resolution preview; the version changes with every new one
+            status['preview_url'] = f"/preview/{record['id']}?v={record['preview_seq']}"
+        return status
+    elif state == 'FAILED':
+        return {'status': 'Failed', 'error': record['error'], 'done': True}
+    elif state == 'CANCELED':
+        return {'status': 'Canceled', 'done': True}
+    elif state == 'COMPLETED':
+        result = record.get('result')
+        mime = result.mime if isinstance(result, ImageResult) else record.get('result_mime')
+        if mime is not None:
+            # Binary results are fetched separately instead of being base64'd into the JSON
+            return {'status': 'Completed', 'result_url': f"/result/{record['id']}", 'result_type': mime,
+                    'done': True, 'progress': 100}
+        return {'status': 'Completed', 'result': result, 'done': True, 'progress': 100}
 
 class TaskManager:
-    def __init__(self):
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)  # Adjustable
-        self.tasks = {}  # task_id: dict of task info
-        self.lock = threading.Lock()  # Global lock for tasks dict
+    def __init__(self, max_task_bytes=256 * 1024 * 1024, task_ttl=3600, executor_config=None,
+                 cancel_deadline=CANCEL_DEADLINE_SECONDS, state=None, lease_seconds=LEASE_SECONDS,
+                 sync_interval=SYNC_SECONDS):
+        """
+        :param max_task_bytes, task_ttl: Limits of the default in-memory state backend.
+        :param state: Task state backend (see server_task_state.make_task_state); a shared one lets
+                      several replicas serve each other's tasks.
+        """
+        self.executor_config = EXECUTOR_CONFIG if executor_config is None else executor_config
+        self.cancel_deadline = cancel_deadline
+        self.backends = {}  # pool name: backend, created on first use
+        self.admission_queues = {}  # pool name: AdmissionQueue, created with the backend
+        self.backends_lock = threading.Lock()
+        # Task records (state, progress, results) live in the state backend; self.tasks only holds the
+        # tasks running here (snapshots, futures, cancel events) and drops them once their final state is stored.
+        # Status reads of those take no lock at all (see server_task_records)
+        self.state = state if state is not None else MemoryTaskState(max_task_bytes, ttl=task_ttl)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"  # This replica, for leases
+        self.lease_seconds = lease_seconds
+        self.tasks = TaskTable()  # task_id: LiveTask
+        self.subscribers = {}  # task_id: set of TaskSubscriber, notified on every state change
+        self.subscribers_lock = threading.Lock()
+        self.watched = {}  # task_id: last status pushed, for subscribed tasks running on another replica
+        self.progress_updates = {}  # task_id: {'state', 'progress'[, 'preview']} not yet written to a shared backend
+        self.sync_lock = threading.Lock()  # Orders progress writes before final ones
+        self.sync_stop = threading.Event()
+        self.next_purge = time.monotonic() + PURGE_SECONDS
+        if self.state.shared:
+            threading.Thread(target=self.__sync_loop__, args=(sync_interval,), name='task-state-sync',
+                             daemon=True).start()
+
+    def backend(self, pool):
+        with self.backends_lock:
+            if pool not in self.backends:
+                config = self.executor_config.get(pool, DEFAULT_EXECUTOR)
+                self.backends[pool] = make_backend(config, name=pool or 'default',
+                                                   initializer=warm_worker, initargs=(pool,),
+                                                   run_batch=run_ml_batch)
+                self.admission_queues[pool] = AdmissionQueue(pool or 'default',
+                                                             config.get('max_queue', DEFAULT_MAX_QUEUE),
+                                                             self.__max_inflight__(config))
+            return self.backends[pool]
+
+    def admission(self, pool):
+        self.backend(pool)
+        return self.admission_queues[pool]
+
+    def spare_capacity(self, pool):
+        """
+        :return: Jobs the pool could start right now without delaying anyone (negative: jobs waiting).
+                 Batch pools count batches: their admission slots include places in batches already running.
+        """
+        backend = self.backend(pool)
+        spare = self.admission_queues[pool].spare()
+        return min(spare, backend.spare()) if backend.kind == 'batch' else spare
+
+    @staticmethod
+    def __max_inflight__(config):
+        if 'max_inflight' in config:
+            return config['max_inflight']
+        if config['kind'] == 'async':
+            return ASYNC_MAX_INFLIGHT
+        if config['kind'] == 'batch':
+            return config.get('max_workers', 1) * config.get('max_batch_size', 8)  # Room for full batches
+        return config.get('max_workers', 1)
+
+    def shutdown(self):
+        self.sync_stop.set()
+        with self.backends_lock:
+            for backend in self.backends.values():
+                backend.shutdown()
+            self.backends.clear()
 
-    def submit(self, fn, *args, **kwargs):
+    def submit(self, fn, *args, pool=None, on_done=None, priority='default', client='', idempotency_key=None,
+               recovery=None, **kwargs):
+        """
+        Run fn(*args, **kwargs, progress_callback=..., cancel_check_callback=...) on the backend of
+        the given pool (usually the model name, see EXECUTOR_CONFIG), once its admission queue lets it through.
+        :param on_done: Optional callable(task_id, state, result) run once the task has finished.
+        :param priority: 'interactive', 'default' or 'bulk' (see server_admission.PRIORITIES).
+        :param client: Who asked; queued jobs are shared out fairly between clients.
+        :param idempotency_key: Submitting again with the same key returns the first task instead of a new one.
+        :param recovery: (model_name, params) another replica reruns the task with (see ml_job) if this one
+                         dies; with shared state only, and params must be JSON. Other tasks are not rerun.
+        :return: task_id
+        :raises QueueFullError: The pool's queue is full; retry after e.retry_after seconds.
+        """
+        self.backend(pool)
         task_id = str(uuid.uuid4())
-        task = {
-            'state': 'PENDING',
-            'progress': 0,
-            'result': None,
-            'error': None,
-            'cancel_flag': False,
-            'lock': threading.Lock()  # Per-task lock
-        }
-
-        def progress_callback(progress):
-            with task['lock']:
-                task['progress'] = progress
-                if task['state'] == 'PENDING':
-                    task['state'] = 'PROGRESS'
-
-        def cancel_check_callback():
-            with task['lock']:
-                if task['cancel_flag']:
-                    raise TaskRevokedError("Task canceled")
-
-        def wrapped():
-            try:
-                result = fn(*args, **kwargs, progress_callback=progress_callback, cancel_check_callback=cancel_check_callback)
-                with task['lock']:
-                    task['state'] = 'COMPLETED'
-                    task['result'] = result
-            except TaskRevokedError:
-                with task['lock']:
-                    task['state'] = 'CANCELED'
-            except Exception as e:
-                with task['lock']:
-                    task['state'] = 'FAILED'
-                    task['error'] = str(e)
-
-        future = self.executor.submit(wrapped)
-        task['future'] = future
-
-        with self.lock:
-            self.tasks[task_id] = task
+        record = {'id': task_id, 'state': 'PENDING', 'progress': 0, 'pool': pool, 'owner': self.owner, 'attempts': 1}
+        existing = self.state.create(record, idempotency_key, lease=self.lease_seconds)
+        if existing != task_id:
+            return existing
+        if self.state.shared and recovery is not None:
+            self.__save_job__(task_id, recovery, priority, client)
+        try:
+            self.__dispatch__(task_id, fn, args, kwargs, pool, on_done, priority, client)
+        except Exception:
+            self.state.delete(task_id)  # Rejected: as if it was never submitted (frees the idempotency key)
+            raise
+        return task_id
+
+    def __save_job__(self, task_id, recovery, priority, client):
+        # What another replica needs to rerun the task if this one dies: plain JSON, never code, since every
+        # replica reads it back. Params that aren't JSON (e.g. multipart files) make the task unrecoverable
+        model_name, params = recovery
+        try:
+            job = json.dumps({'model': model_name, 'params': params, 'priority': priority, 'client': client})
+        except (TypeError, ValueError):
+            return
+        self.state.put_blob(task_id, 'job', job.encode('utf-8'))
+
+    def __dispatch__(self, task_id, fn, args, kwargs, pool, on_done, priority, client):
+        # Create the live task for a stored record and queue it for admission
+        task = LiveTask(task_id, pool, self.backend(pool), self.tasks.lock_for(task_id), (fn, args, kwargs), on_done,
+                        time.monotonic())
+        # Raises QueueFullError before anything runs
+        starts = self.admission_queues[pool].admit(task_id, functools.partial(self.__run__, task), priority, client)
+        self.tasks.add(task)
+        TASKS_PENDING.inc(pool=pool or 'default')
+        self.__start__(pool, starts)
+
+    def __run__(self, task):
+        # Admitted: hand the job to the pool's backend
+        backend = task.backend
+        task.dispatched_at = time.monotonic()
+        cancel_event = backend.make_cancel_event()  # Works across threads and processes
+        with task.lock:
+            task.cancel_event = cancel_event
+            canceled = task.cancel_requested_at is not None
+        if canceled:
+            cancel_event.set()
+        fn, args, kwargs = task.job
+        try:
+            future = backend.submit(fn, args, kwargs, functools.partial(self.__progress__, task), cancel_event)
+        except Exception as e:  # E.g. the backend is shutting down: fail the task, free the slot
+            future = concurrent.futures.Future()
+            future.set_exception(e)
+        task.future = future
+        if cancel_event.is_set():
+            future.cancel()  # Canceled while being dispatched
+        future.add_done_callback(functools.partial(self.__finish__, task))
+
+    def __progress__(self, task, progress, preview=None):
+        """
+        The job's progress_callback.
+        :param preview: Optional low-resolution ImageResult of the output so far (see
+                        server_images.make_preview); only the latest one is kept.
+        """
+        with task.lock:
+            snapshot = task.snapshot
+            if snapshot.state in FINISHED_STATES:
+                return  # Late progress message from a worker process
+            started = snapshot.state == 'PENDING'
+            changed = started or int(snapshot.progress) != int(progress) or preview is not None
+            if preview is not None:
+                snapshot = task.update(state='PROGRESS', progress=progress, preview=preview,
+                                       preview_seq=snapshot.preview_seq + 1)
+            else:
+                snapshot = task.update(state='PROGRESS', progress=progress)
+            if changed and self.state.shared:
+                with self.sync_lock:  # Written out by the next sync
+                    update = {**self.progress_updates.get(task.id, {}), 'state': 'PROGRESS', 'progress': progress}
+                    if preview is not None:  # A newer preview replaces one not written out yet
+                        update.update(preview=preview, preview_seq=snapshot.preview_seq, preview_mime=preview.mime)
+                    self.progress_updates[task.id] = update
+        if started:  # First report: the task left the queue
+            pool_name = task.pool or 'default'
+            PHASE_SECONDS.observe(time.monotonic() - task.submitted_at, phase='queue_wait', model=pool_name)
+            TASKS_PENDING.dec(pool=pool_name)
+            TASKS_ACTIVE.inc(pool=pool_name)
+        if changed:  # Sub-percent updates are not worth a push
+            self.__publish__(task.id, status_of(snapshot))
+
+    def __settle__(self, task, state, result=None, error=None, how=None):
+        """
+        The task's single exit; the first call wins, so a job forced out by the cancel deadline
+        can still come back later without effect.
+        :param how: For canceled tasks, how they stopped (time-to-cancel metric label).
+        :return: False if the task had already finished.
+        """
+        if isinstance(result, (bytes, bytearray)):
+            result = ImageResult(result, 'application/octet-stream')  # Raw bytes are served like images
+        with task.lock:
+            if task.snapshot.state in FINISHED_STATES:
+                return False
+            started = task.snapshot.state == 'PROGRESS'
+            snapshot = task.update(state=state, result=result, error=error, preview=None)  # Result supersedes previews
+        now = time.monotonic()
+        pool_name = task.pool or 'default'
+        if task.dispatched_at is not None:  # Free its admission slot (jobs dropped from the queue never had one)
+            self.__start__(task.pool, self.admission_queues[task.pool].release(now - task.dispatched_at))
+        (TASKS_ACTIVE if started else TASKS_PENDING).dec(pool=pool_name)
+        TASKS_FINISHED.inc(pool=pool_name, state=state)
+        TASK_SECONDS.observe(now - task.submitted_at, pool=pool_name, state=state)
+        if task.cancel_requested_at is not None:
+            CANCEL_SECONDS.observe(now - task.cancel_requested_at, pool=pool_name, how=how or state.lower())
+        if self.__store_final__(task.id, state, result, error):
+            self.tasks.pop(task.id)  # The stored record answers for it from now on
+        self.__publish__(task.id, status_of(snapshot))  # Final state (and the result) is pushed exactly once
+        if task.on_done is not None:
+            task.on_done(task.id, state, result)
+        return True
 
+    def __finish__(self, task, future):
+        try:
+            self.__settle__(task, 'COMPLETED', task.backend.result(future))
+        except concurrent.futures.CancelledError:
+            # Never started in the backend, or (async jobs) a running coroutine cancelled at its next await,
+            # which counts like a job that saw its token
+            with task.lock:
+                started = task.snapshot.state == 'PROGRESS'
+            self.__settle__(task, 'CANCELED', how='cooperative' if started else 'dequeued')
+        except TaskRevokedError:
+            self.__settle__(task, 'CANCELED', how='cooperative')  # The job saw its token and stopped
+        except Exception as e:
+            self.__settle__(task, 'FAILED', error=str(e))
+
+    def __store_final__(self, task_id, state, result, error):
+        """
+        Write a task's final state (binary results as a blob) to the state backend. Only the task's
+        current owner may: a replica presumed dead whose task was rerun elsewhere is ignored.
+        :return: False if that failed; the live task is then kept so this replica can still serve it.
+        """
+        fields = {'state': state, 'error': error, 'result': None, 'result_mime': None, 'result_digest': None}
+        try:
+            with self.sync_lock:  # After any pending progress write, never before
+                self.progress_updates.pop(task_id, None)
+                if self.state.shared and (self.state.get(task_id) or {}).get('owner') != self.owner:
+                    print(f"Task {task_id} was taken over by another server; dropping this run's {state.lower()} state")
+                    return True
+                if state == 'COMPLETED':
+                    fields['progress'] = 100
+                    if isinstance(result, ImageResult):
+                        self.state.put_blob(task_id, 'result', result.data)
+                        fields['result_mime'], fields['result_digest'] = result.mime, result.digest()
+                    else:
+                        fields['result'] = result
+                self.state.finish(task_id, self.owner, **fields)
+            return True
+        except Exception as e:
+            print(f"Storing the final state of task {task_id} failed: {e}")
+            return False
+
+    def __start__(self, pool, starts):
+        # Run start callables released by an admission queue, then tell waiting subscribers they moved up
+        for start in starts:
+            start()
+        if starts:
+            self.__publish_positions__(pool)
+
+    def __publish_positions__(self, pool):
+        with self.subscribers_lock:
+            task_ids = list(self.subscribers)
+        admission = self.admission_queues[pool]
+        for task_id in task_ids:
+            if admission.position(task_id) is not None:
+                self.__publish__(task_id, self.get_status(task_id))
+
+    def submit_completed(self, result):
+        """
+        Register a task that is already done (e.g. served from the result cache), so clients
+        can use the usual /status and /events flow.
+        :return: task_id
+        """
+        task_id = str(uuid.uuid4())
+        self.state.create({'id': task_id, 'state': 'PENDING', 'progress': 0, 'pool': None, 'owner': self.owner,
+                           'attempts': 1})
+        self.__store_final__(task_id, 'COMPLETED', result, None)
         return task_id
 
     def get_status(self, task_id):
-        with self.lock:
-            if task_id not in self.tasks:
-                return {'status': 'Unknown'}
-            task = self.tasks[task_id]
-
-        with task['lock']:
-            state = task['state']
-            print(state)
-            if state == 'PENDING':
-                return {'status': 'Pending', 'progress': 0, 'done': False}
-            elif state == 'PROGRESS':
-                return {'status': 'In Progress', 'progress': task['progress'], 'done': False}
-            elif state == 'FAILED':
-                return {'status': 'Failed', 'error': task['error'], 'done': True}
-            elif state == 'CANCELED':
-                return {'status': 'Canceled', 'done': True}
-            elif state == 'COMPLETED':
-                return {'status': 'Completed', 'result': task['result'], 'done': True, 'progress': 100}
+        task = self.tasks.get(task_id)
+        if task is not None:
+            return self.__status__(task)
+        record = self.state.get(task_id)  # Finished, or running on another replica
+        if record is None:
+            return {'status': 'Unknown'}
+        return status_of(record)
+
+    def __status__(self, task):
+        snapshot = task.snapshot  # One load: a consistent view, whatever the writers do meanwhile
+        position = None
+        if snapshot.state == 'PENDING':
+            admission = self.admission_queues.get(task.pool)
+            position = admission.position(task.id) if admission is not None else None
+        return status_of(snapshot, position)
+
+    def get_result(self, task_id):
+        """
+        :return: The result of a completed task, or None if unknown / not completed.
+        """
+        task = self.tasks.get(task_id)
+        if task is not None:
+            snapshot = task.snapshot
+            return snapshot.result if snapshot.state == 'COMPLETED' else None
+        record = self.state.get(task_id)
+        if record is None or record['state'] != 'COMPLETED':
+            return None
+        if record['result_mime'] is None:
+            return record['result']
+        data = self.state.get_blob(task_id, 'result')
+        return ImageResult(data, record['result_mime'], record['result_digest']) if data is not None else None
+
+    def get_preview(self, task_id):
+        """
+        :return: (ImageResult, version) of the latest preview of a running task, or None if it has none.
+        """
+        task = self.tasks.get(task_id)
+        if task is not None:
+            snapshot = task.snapshot
+            return (snapshot.preview, snapshot.preview_seq) if snapshot.preview is not None else None
+        record = self.state.get(task_id)  # Running on another replica
+        if record is None or record['state'] in FINISHED_STATES or not record.get('preview_seq'):
+            return None
+        data = self.state.get_blob(task_id, 'preview')
+        return (ImageResult(data, record['preview_mime']), record['preview_seq']) if data is not None else None
+
+    def stats(self):
+        return {**self.state.stats(), 'live': len(self.tasks)}
+
+    def subscribe(self, task_id, subscriber):
+        """
+        Register a TaskSubscriber for state changes of task_id.
+        The current status is pushed immediately, so a late subscriber still sees the result.
+        :return: False if the task is unknown.
+        """
+        is_local = task_id in self.tasks
+        if not is_local and self.state.get(task_id) is None:
+            return False
+        with self.subscribers_lock:
+            self.subscribers.setdefault(task_id, set()).add(subscriber)
+        status = self.get_status(task_id)
+        if not is_local and not status.get('done', True):
+            with self.subscribers_lock:  # Runs on another replica: the sync loop polls it for us
+                self.watched.setdefault(task_id, status)
+        subscriber.push(task_id, status)
+        return True
+
+    def unsubscribe(self, task_id, subscriber):
+        with self.subscribers_lock:
+            subscribers = self.subscribers.get(task_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers[task_id]
+                    self.watched.pop(task_id, None)
+
+    def __publish__(self, task_id, status):
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers.get(task_id, ()))
+        for subscriber in subscribers:
+            subscriber.push(task_id, status)
 
     def cancel(self, task_id):
-        with self.lock:
-            if task_id not in self.tasks:
+        task = self.tasks.get(task_id)
+        if task is None:
+            record = self.state.get(task_id)
+            if record is None:
                 raise ValueError("Task not found")
-            task = self.tasks[task_id]
-
-        with task['lock']:
-            if task['state'] in ('COMPLETED', 'FAILED', 'CANCELED'):
+            if record['state'] in FINISHED_STATES:
                 return {"status": "Task already finished or canceled"}
-            task['cancel_flag'] = True
-            task['future'].cancel()  # Attempt to cancel, may not work if running
+            self.state.request_cancel(task_id)  # Its replica picks this up on its next sync
+            return {"status": "Cancel requested"}
 
+        with task.lock:
+            if task.snapshot.state in FINISHED_STATES:
+                return {"status": "Task already finished or canceled"}
+            if task.cancel_requested_at is None:
+                task.cancel_requested_at = time.monotonic()
+            cancel_event, future = task.cancel_event, task.future
+        if cancel_event is not None:
+            cancel_event.set()  # Running jobs see it through their CancelToken
+        if future is None:
+            if self.admission_queues[task.pool].remove(task_id):
+                self.__settle__(task, 'CANCELED', how='admission')  # Still waiting for admission: it never runs
+                return {"status": "Canceled"}
+        elif future.cancel():  # Still queued in the backend (async jobs: the coroutine gets cancelled)
+            return {"status": "Canceled"}
+        # Running: give it cancel_deadline seconds to notice, then stop waiting for it
+        timer = threading.Timer(self.cancel_deadline, self.__settle__, args=(task, 'CANCELED'), kwargs={'how': 'deadline'})
+        timer.daemon = True
+        timer.start()
         return {"status": "Cancel requested"}
 
+    def __sync_loop__(self, interval):
+        while not self.sync_stop.wait(interval):
+            try:
+                self.sync()
+            except Exception as e:  # Backend briefly unreachable: try again next round
+                print(f"Task state sync failed: {e}")
+
+    def sync(self):
+        """
+        One round of upkeep with a shared state backend: write out progress, renew the leases of
+        the tasks running here (and act on cancel requests other replicas left on them), rerun
+        tasks whose replica died, and push updates of remote tasks to local subscribers.
+        """
+        with self.sync_lock:
+            updates, self.progress_updates = self.progress_updates, {}
+            for task_id, fields in updates.items():
+                preview = fields.pop('preview', None)
+                if preview is not None:  # Blob first, so a record never points at a missing preview
+                    self.state.put_blob(task_id, 'preview', preview.data)
+            if updates:
+                self.state.set_progress(updates)
+        live = self.tasks.ids()
+        for task_id in self.state.renew(self.owner, live, self.lease_seconds):
+            try:
+                self.cancel(task_id)
+            except ValueError:
+                pass  # Finished meanwhile
+        for record in self.state.claim_expired(self.owner, self.lease_seconds):
+            self.__recover__(record)
+        self.__poll_watched__()
+        if time.monotonic() >= self.next_purge:
+            self.next_purge = time.monotonic() + PURGE_SECONDS
+            self.state.purge()
+
+    def __recover__(self, record):
+        # A task whose replica stopped renewing its lease (crashed or hung), now leased to us
+        task_id = record['id']
+        job = self.state.get_blob(task_id, 'job') if record['attempts'] <= MAX_TASK_ATTEMPTS else None
+        if job is None:
+            self.state.update(task_id, state='FAILED', error="Task lost: the server running it stopped responding")
+            return
+        try:
+            job = json.loads(job)
+            model_name, params = job['model'], job['params']
+            if model_name not in MODEL_REGISTRY or not isinstance(params, dict):
+                raise ValueError(f"Unknown model {model_name!r}")
+            fn, job_params = ml_job(self, model_name, params)
+        except (ValueError, KeyError, TypeError) as e:
+            self.state.update(task_id, state='FAILED', error=f"Task lost and could not be rerun: {e}")
+            return
+        print(f"Rerunning task {task_id} (attempt {record['attempts']}) after its server stopped responding")
+        self.state.update(task_id, state='PENDING', progress=0)
+        try:
+            self.__dispatch__(task_id, fn, (model_name, job_params), {}, model_name, None,
+                              job.get('priority', 'default'), job.get('client', ''))
+        except QueueFullError as e:
+            self.state.update(task_id, state='FAILED', error=f"Task lost and could not be rerun: {e}")
+        if record['cancel_requested']:
+            self.cancel(task_id)
+
+    def __poll_watched__(self):
+        with self.subscribers_lock:
+            watched = dict(self.watched)
+        for task_id, last_status in watched.items():
+            record = self.state.get(task_id)
+            status = status_of(record) if record is not None else {'status': 'Unknown', 'done': True}
+            with self.subscribers_lock:
+                if task_id not in self.watched:
+                    continue  # Unsubscribed meanwhile
+                if status['done']:
+                    del self.watched[task_id]
+                else:
+                    self.watched[task_id] = status
+            if status != last_status:
+                self.__publish__(task_id, status)
+
+def warm_worker(model_name):
+    # Runs once in every process-pool worker, so the model is loaded before the first job arrives
+    if model_name in MODEL_REGISTRY:
+        MODEL_REGISTRY[model_name]
+
+def resolve_params(params, with_image=True):
+    # Models that take an 'image' can be given the ID of an already-uploaded source instead of the bytes.
+    # with_image=False leaves out the PIL copy (jobs pickled to worker processes: the array is enough)
+    if 'image' in params or 'image_array' in params or 'source_image_id' not in params:
+        return params  # Resolved already (e.g. by the parent of a worker process)
+    source = MODEL_REGISTRY['model_ht'].source_images.get(check_source_id(params['source_image_id']))
+    if source is None:
+        return params
+    # Ready-made model-input arrays: 'image' is a PIL view of them, 'image_array' the uint8 array itself
+    if not with_image:
+        return {**params, 'image_array': source.array()}
+    return {**params, 'image': source.image(), 'image_array': source.array()}
+
 def run_ml_task(model_name, params, progress_callback, cancel_check_callback):
     if model_name not in MODEL_REGISTRY:
         raise ValueError("Invalid model")
 
     model = MODEL_REGISTRY[model_name]
 
+    progress_callback(0)  # Marks the task as started (ends its queue wait)
     try:
-        result = model.run(params, progress_callback, cancel_check_callback)
+        with span('inference', model=model_name):
+            result = model.run(resolve_params(params), progress_callback, cancel_check_callback)
         return result
+    except TaskRevokedError:
+        raise  # Canceled, not failed
     except Exception as e:
         raise ValueError(f"Task failed: {str(e)}")
+
+def run_ml_batch(jobs):
+    """
+    Batched counterpart of run_ml_task for BatchScheduler: jobs carry the same
+    (model_name, params) args, all for one model.
+    :return: One result or exception per job.
+    """
+    model_name = jobs[0].args[0]
+    if model_name not in MODEL_REGISTRY:
+        raise ValueError("Invalid model")
+
+    model = MODEL_REGISTRY[model_name]
+    for job in jobs:
+        job.progress_callback(0)  # Marks the task as started (ends its queue wait)
+    with span('inference', model=model_name):
+        results = model.run_batch([resolve_params(job.args[1]) for job in jobs],
+                                  [job.progress_callback for job in jobs],
+                                  [job.cancel_check_callback for job in jobs])
+    return [ValueError(f"Task failed: {str(result)}")
+            if isinstance(result, Exception) and not isinstance(result, TaskRevokedError) else result
+            for result in results]
+
+async def run_ml_task_async(model_name, params, progress_callback, cancel_check_callback):
+    if model_name not in MODEL_REGISTRY:
+        raise ValueError("Invalid model")
+
+    model = MODEL_REGISTRY[model_name]
+
+    progress_callback(0)  # Marks the task as started (ends its queue wait)
+    try:
+        with span('inference', model=model_name):
+            return await model.run_async(resolve_params(params), progress_callback, cancel_check_callback)
+    except TaskRevokedError:
+        raise  # Canceled, not failed
+    except Exception as e:
+        raise ValueError(f"Task failed: {str(e)}")
+
+def start_ml_task(task_manager, model_name, params, result_cache=None, priority='default', client='',
+                  idempotency_key=None):
+    """
+    Submit a model run on that model's pool; 'async' pools get the coroutine version.
+    With a ResultCache, repeated requests are answered from it and identical in-flight
+    requests share one task.
+    :param priority, client, idempotency_key: See TaskManager.submit.
+    :return: task_id
+    :raises QueueFullError: The model's queue is full.
+    """
+    def submit(on_done=None):
+        return submit_ml_task(task_manager, model_name, params, on_done=on_done, priority=priority, client=client,
+                              idempotency_key=idempotency_key)
+
+    if result_cache is None:
+        return submit()
+    return result_cache.start(task_manager, result_cache.key(model_name, params), submit,
+                              task_manager.submit_completed)
+
+def submit_ml_task(task_manager, model_name, params, on_done=None, priority='default', client='',
+                   idempotency_key=None):
+    """
+    Submit a model run as is, without the result cache (see start_ml_task).
+    :return: task_id
+    :raises QueueFullError: The model's queue is full.
+    """
+    fn, job_params = ml_job(task_manager, model_name, params)
+    return task_manager.submit(fn, model_name, job_params, pool=model_name, on_done=on_done, priority=priority,
+                               client=client, idempotency_key=idempotency_key, recovery=(model_name, params))
+
+def ml_job(task_manager, model_name, params):
+    """
+    The function a model run is submitted with, and its params, for that model's pool.
+    :return: (fn, params); fn takes (model_name, params, progress_callback, cancel_check_callback).
+    """
+    kind = task_manager.backend(model_name).kind
+    fn = run_ml_task_async if kind == 'async' else run_ml_task
+    # Worker processes have no access to this process' source store, so they get the prepared arrays
+    return fn, resolve_params(params, with_image=False) if kind == 'process' else params
@@ -0,0 +1,163 @@
+# server_uploads.py
+# Request bodies read as they stream in, instead of buffered whole before the handler runs:
+# - size limits are checked against Content-Length before anything is read, and against the running
+#   total on every chunk, so an oversized upload is refused without being buffered;
+# - every file is sha256-hashed chunk by chunk, so its ID is ready when its last byte arrives.
+# Accepts multipart/form-data (files plus small fields), or a raw body, which is one file named 'file'
+# with the request's Content-Type.
+import hashlib
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+MAX_UPLOAD_BYTES = 32 * 1024 * 1024  # Per file
+MAX_FIELD_BYTES = 1024 * 1024  # Per non-file multipart field (e.g. the 'params' JSON of /start)
+MAX_FILES = 4
+MAX_PARAMS_BYTES = MAX_UPLOAD_BYTES * 4 // 3 + MAX_FIELD_BYTES  # JSON params may carry a data-URL image
+MULTIPART_OVERHEAD_BYTES = 64 * 1024  # Boundaries and part headers, on top of the content limits
+
+
+class UploadTooLargeError(ValueError):
+    """A body or file over the size limits; maps to HTTP 413."""
+
+
+class Upload:
+    """One uploaded file, read in full, with the sha256 of its bytes."""
+    __slots__ = ('name', 'filename', 'content_type', 'data', 'digest')
+
+    def __init__(self, name, filename, content_type, data, digest):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.data = data
+        self.digest = digest
+
+    def __len__(self):
+        return len(self.data)
+
+
+class MultipartReader:
+    """
+    Incremental multipart/form-data parser: feed() it chunks as they arrive, then finish().
+    Files end up in files ({name: Upload}), other fields in fields ({name: str}); a repeated name keeps the last.
+    """
+    def __init__(self, boundary, max_bytes=MAX_UPLOAD_BYTES, max_files=MAX_FILES):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.fields = {}
+        self.files = {}
+        self.headers = {}
+        self.header_field = b''
+        self.header_value = b''
+        self.part = None  # Current part: name, filename, content type, chunks, size, hasher (files only)
+        self.parser = MultipartParser(boundary, {
+            'on_part_begin': self.__part_begin__,
+            'on_header_field': self.__header_field__,
+            'on_header_value': self.__header_value__,
+            'on_header_end': self.__header_end__,
+            'on_headers_finished': self.__headers_finished__,
+            'on_part_data': self.__part_data__,
+            'on_part_end': self.__part_end__,
+        })
+
+    def feed(self, chunk):
+        self.parser.write(chunk)
+
+    def finish(self):
+        self.parser.finalize()
+        if self.part is not None:
+            raise ValueError("Multipart body ended inside a part")
+
+    def __part_begin__(self):
+        self.headers = {}
+
+    def __header_field__(self, data, start, end):
+        self.header_field += data[start:end]
+
+    def __header_value__(self, data, start, end):
+        self.header_value += data[start:end]
+
+    def __header_end__(self):
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field, self.header_value = b'', b''
+
+    def __headers_finished__(self):
+        _, options = parse_options_header(self.headers.get(b'content-disposition'))
+        if b'name' not in options:
+            raise ValueError("Multipart part without a name")
+        filename = options.get(b'filename')
+        if filename is not None and len(self.files) >= self.max_files:
+            raise UploadTooLargeError(f"More than {self.max_files} files")
+        content_type = self.headers.get(b'content-type', b'application/octet-stream').decode('latin-1')
+        self.part = {'name': options[b'name'].decode('utf-8'), 'filename': filename and filename.decode('utf-8'),
+                     'content_type': content_type, 'chunks': [], 'size': 0,
+                     'hasher': hashlib.sha256() if filename is not None else None}
+
+    def __part_data__(self, data, start, end):
+        part = self.part
+        part['size'] += end - start
+        limit = self.max_bytes if part['hasher'] is not None else MAX_FIELD_BYTES
+        if part['size'] > limit:
+            raise UploadTooLargeError(f"Part '{part['name']}' is over the {limit} byte limit")
+        chunk = data[start:end]
+        if part['hasher'] is not None:
+            part['hasher'].update(chunk)  # Releases the GIL on large chunks
+        part['chunks'].append(chunk)
+
+    def __part_end__(self):
+        part, self.part = self.part, None
+        data = b''.join(part['chunks'])
+        if part['hasher'] is None:
+            self.fields[part['name']] = data.decode('utf-8')
+        else:
+            self.files[part['name']] = Upload(part['name'], part['filename'], part['content_type'], data,
+                                              part['hasher'].hexdigest())
+
+
+def __check_length__(request, limit):
+    length = request.headers.get('content-length')
+    if length is not None and length.isdigit() and int(length) > limit:
+        raise UploadTooLargeError(f"Body of {length} bytes is over the {limit} byte limit")
+
+
+async def read_body(request, max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Read a raw body as it streams in.
+    :return: Upload named 'file', with the request's Content-Type.
+    :raises UploadTooLargeError: Over max_bytes (before reading, when Content-Length says so).
+    """
+    __check_length__(request, max_bytes)
+    hasher, chunks, size = hashlib.sha256(), [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise UploadTooLargeError(f"Body is over the {max_bytes} byte limit")
+        hasher.update(chunk)
+        chunks.append(chunk)
+    content_type = request.headers.get('content-type') or 'application/octet-stream'
+    return Upload('file', None, content_type.split(';')[0].strip(), b''.join(chunks), hasher.hexdigest())
+
+
+async def read_upload(request, max_bytes=MAX_UPLOAD_BYTES, max_files=MAX_FILES):
+    """
+    Read a multipart/form-data or raw upload as it streams in.
+    :param max_bytes: Limit per file.
+    :return: (fields, files): {name: str}, {name: Upload}.
+    :raises UploadTooLargeError: Over the limits (before reading, when Content-Length says so).
+    :raises ValueError: Malformed body.
+    """
+    content_type, options = parse_options_header(request.headers.get('content-type'))
+    if content_type != b'multipart/form-data':
+        return {}, {'file': await read_body(request, max_bytes)}
+    if not options.get(b'boundary'):
+        raise ValueError("multipart/form-data without a boundary")
+    limit = max_bytes * max_files + MAX_FIELD_BYTES + MULTIPART_OVERHEAD_BYTES
+    __check_length__(request, limit)
+    reader = MultipartReader(options[b'boundary'], max_bytes, max_files)
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise UploadTooLargeError(f"Body is over the {limit} byte limit")
+        reader.feed(chunk)
+    reader.finish()
+    return reader.fields, reader.files
@@ -1,54 +1,218 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
 import os
-from PIL import Image
+import time
+from PIL import Image, features
 
+MANIFEST_NAME = ".manifest.json"
 
-def convert_png_to_jpeg(directory):
+# Output format: (file extension, PIL format name, save options)
+OUTPUT_FORMATS = {
+    'jpeg': ('.jpg', 'JPEG', lambda quality: {'quality': quality, 'optimize': True}),
+    'webp': ('.webp', 'WEBP', lambda quality: {'quality': quality, 'method': 4}),
+    'avif': ('.avif', 'AVIF', lambda quality: {'quality': quality}),
+}
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def to_rgb(img):
+    # Convert to RGB if necessary (handles PNGs with transparency)
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        return background
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+
+def convert_one(src_path, out_base, formats, thumbnail_sizes, quality, previous_hash=None):
+    """
+    Convert one source image to every requested format, plus a thumbnail per size.
+    Runs in a worker process.
+    :param out_base: Output path without extension; thumbnails get a _<size> suffix.
+    :param previous_hash: Hash recorded in the manifest; if the content still matches and all
+                          outputs exist, nothing is written.
+    :return: (content hash, output paths, bytes written, converted?)
+    """
+    content_hash = file_sha256(src_path)
+    outputs = [out_base + OUTPUT_FORMATS[fmt][0] for fmt in formats]
+    outputs += [f"{out_base}_{size}{OUTPUT_FORMATS[fmt][0]}" for size in thumbnail_sizes for fmt in formats]
+    if content_hash == previous_hash and all(os.path.exists(path) for path in outputs):
+        return content_hash, outputs, 0, False  # Touched but unchanged
+
+    os.makedirs(os.path.dirname(out_base), exist_ok=True)
+    written = 0
+    with Image.open(src_path) as img:
+        img = to_rgb(img)
+        variants = [('', img)]
+        for size in thumbnail_sizes:
+            thumb = img.copy()
+            thumb.thumbnail((size, size))
+            variants.append((f"_{size}", thumb))
+        for suffix, variant in variants:
+            for fmt in formats:
+                extension, pil_format, options = OUTPUT_FORMATS[fmt]
+                output_path = out_base + suffix + extension
+                tmp_path = output_path + ".tmp"
+                variant.save(tmp_path, pil_format, **options(quality))
+                os.replace(tmp_path, output_path)  # Never leave a half-written asset behind
+                written += os.path.getsize(output_path)
+    return content_hash, outputs, written, True
+
+
+def load_manifest(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def find_sources(directory, output_dir, extensions, recursive):
+    output_dir = os.path.abspath(output_dir)
+    for root, dirs, files in os.walk(directory):
+        # Never descend into our own output
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) != output_dir)
+        for filename in sorted(files):
+            if filename.lower().endswith(extensions):
+                yield os.path.relpath(os.path.join(root, filename), directory)
+        if not recursive:
+            return
+
+
+def convert_png_to_jpeg(directory, output_dir=None, formats=('jpeg',), thumbnail_sizes=(), quality=95,
+                        recursive=False, workers=None, force=False, extensions=('.png',)):
+    """
+    Convert every image in a directory (optionally a whole tree) using a process pool.
+    A manifest in the output directory records each source's mtime, size and content hash, so
+    later runs only convert new or changed files.
+    :param formats: Any of 'jpeg', 'webp', 'avif'.
+    :param thumbnail_sizes: Longest side of the extra downscaled copies written per source.
+    :param workers: Worker processes (default: CPU count); 1 converts in this process.
+    :param force: Ignore the manifest and convert everything.
+    :return: Summary dict with counts and throughput, or None if the directory is invalid.
+    """
     # Ensure the directory exists
     if not os.path.isdir(directory):
         print(f"Error: {directory} is not a valid directory")
-        return
+        return None
+    for fmt in formats:
+        if fmt not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {fmt}")
+        if fmt in ('webp', 'avif') and not features.check(fmt):
+            raise ValueError(f"This Pillow build has no {fmt} support")
 
     # Create output directory if it doesn't exist
-    output_dir = os.path.join(directory, "converted_jpegs")
+    output_dir = output_dir or os.path.join(directory, "converted_jpegs")
     os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = {} if force else load_manifest(manifest_path)
+    # Outputs depend on the settings too, so a settings change re-converts everything
+    settings = {'formats': list(formats), 'thumbnail_sizes': list(thumbnail_sizes), 'quality': quality}
+    if manifest.get('settings') != settings:
+        manifest = {}
+    entries = manifest.get('files', {})
 
-    # Supported image extensions
-    valid_extensions = ('.png', '.PNG')
+    start_time = time.perf_counter()
+    summary = {'converted': 0, 'unchanged': 0, 'skipped': 0, 'failed': 0, 'input_bytes': 0, 'output_bytes': 0}
+    jobs = {}  # relative path: (mtime, size)
+    for rel_path in find_sources(directory, output_dir, tuple(ext.lower() for ext in extensions), recursive):
+        stat = os.stat(os.path.join(directory, rel_path))
+        entry = entries.get(rel_path)
+        if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size \
+                and all(os.path.exists(path) for path in entry['outputs']):
+            summary['skipped'] += 1  # Same mtime and size: not even hashed
+            continue
+        jobs[rel_path] = (stat.st_mtime, stat.st_size)
 
-    # Iterate through all files in the directory
-    for filename in os.listdir(directory):
-        if filename.lower().endswith(valid_extensions):
-            try:
-                # Open the image
-                img_path = os.path.join(directory, filename)
-                img = Image.open(img_path)
+    def record(rel_path, result):
+        content_hash, outputs, written, converted = result
+        mtime, size = jobs[rel_path]
+        entries[rel_path] = {'mtime': mtime, 'size': size, 'sha256': content_hash, 'outputs': outputs}
+        summary['converted' if converted else 'unchanged'] += 1
+        if converted:
+            summary['input_bytes'] += size
+            summary['output_bytes'] += written
+            print(f"Converted {rel_path}")
 
-                # Convert to RGB if necessary (handles PNGs with transparency)
-                if img.mode in ('RGBA', 'LA'):
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    background.paste(img, mask=img.split()[-1])
-                    img = background
-                elif img.mode != 'RGB':
-                    img = img.convert('RGB')
+    def job_args(rel_path):
+        out_base = os.path.join(output_dir, os.path.splitext(rel_path)[0])
+        previous_hash = entries.get(rel_path, {}).get('sha256')
+        return (os.path.join(directory, rel_path), out_base, tuple(formats), tuple(thumbnail_sizes), quality,
+                previous_hash)
 
-                # Create output filename
-                output_filename = os.path.splitext(filename)[0] + '.jpg'
-                output_path = os.path.join(output_dir, output_filename)
+    if workers == 1:
+        for rel_path in jobs:
+            try:
+                record(rel_path, convert_one(*job_args(rel_path)))
+            except Exception as e:
+                summary['failed'] += 1
+                print(f"Error converting {rel_path}: {str(e)}")
+    elif jobs:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(convert_one, *job_args(rel_path)): rel_path for rel_path in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                rel_path = futures[future]
+                try:
+                    record(rel_path, future.result())
+                except Exception as e:
+                    summary['failed'] += 1
+                    print(f"Error converting {rel_path}: {str(e)}")
 
-                # Save as JPEG
-                img.save(output_path, 'JPEG', quality=95)
-                print(f"Converted {filename} to {output_filename}")
+    # Forget sources that disappeared
+    sources = set(find_sources(directory, output_dir, tuple(ext.lower() for ext in extensions), recursive))
+    entries = {rel_path: entry for rel_path, entry in entries.items() if rel_path in sources}
+    save_manifest(manifest_path, {'settings': settings, 'files': entries})
 
-                # Close the image
-                img.close()
+    elapsed = time.perf_counter() - start_time
+    summary['seconds'] = round(elapsed, 3)
+    summary['files_per_second'] = round(summary['converted'] / elapsed, 2) if elapsed else 0.0
+    summary['input_mb_per_second'] = round(summary['input_bytes'] / elapsed / 1e6, 2) if elapsed else 0.0
+    print(f"Conversion complete! {summary['converted']} converted, {summary['unchanged']} unchanged, "
+          f"{summary['skipped']} skipped, {summary['failed']} failed in {elapsed:.2f}s "
+          f"({summary['files_per_second']} files/s, {summary['input_mb_per_second']} MB/s)")
+    return summary
 
-            except Exception as e:
-                print(f"Error converting {filename}: {str(e)}")
 
-    print("Conversion complete!")
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-convert PNG images (e.g. the hair-style catalogue) to JPEG/WebP/AVIF.")
+    parser.add_argument("directory", nargs="?", help="Directory containing PNG files")
+    parser.add_argument("-o", "--output-dir", help="Output directory (default: <directory>/converted_jpegs)")
+    parser.add_argument("-f", "--format", dest="formats", action="append", choices=sorted(OUTPUT_FORMATS),
+                        help="Output format; repeat for several (default: jpeg)")
+    parser.add_argument("-t", "--thumbnail", dest="thumbnail_sizes", action="append", type=int, default=[],
+                        help="Also write a thumbnail with this longest side; repeat for several")
+    parser.add_argument("-q", "--quality", type=int, default=95)
+    parser.add_argument("-r", "--recursive", action="store_true", help="Convert the whole directory tree")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--force", action="store_true", help="Ignore the manifest and convert everything")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    # Specify the directory containing PNG files
+    directory_path = args.directory or input("Enter the directory path containing PNG files: ")
+    summary = convert_png_to_jpeg(directory_path, output_dir=args.output_dir, formats=tuple(args.formats or ('jpeg',)),
+                                  thumbnail_sizes=tuple(args.thumbnail_sizes), quality=args.quality,
+                                  recursive=args.recursive, workers=args.workers, force=args.force)
+    if args.json and summary is not None:
+        print(json.dumps(summary, indent=2))
 
 
 if __name__ == "__main__":
-    # Specify the directory containing PNG files
-    directory_path = input("Enter the directory path containing PNG files: ")
-    convert_png_to_jpeg(directory_path)
\ No newline at end of file
+    main()